@@ -0,0 +1,400 @@
+#!/usr/bin/env python3
+#
+# router-bot
+# Copyright (C) 2017 quasiyoke
+#
+# You should have received a copy of the GNU Affero General Public License v3
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Measures router-bot's throughput under load of simulated humans and client bots.
+
+Humans post updates to the webhook of router-bot's `Server`, so updates go through `Bot` and `HumanHandler` like in
+production. Every human does /start, passes setup wizard and then for every round: /begin, waits for partner,
+exchanges messages with her and does /end. Messages to humans are sent by telepot to the local stand-in for Telegram
+Bot API which measures end-to-end relay latency.
+
+Client bots are `ClientBot` rows with `--bot-capacity`, so waiting humans are matched with them like in production.
+Messages which router-bot delivers to client bots are received in-process: every bot answers every message of a human
+by sending a message with `chat_id` of the human's chat through `Server._handle_send_message`. Latencies of relaying
+messages to bots and of bots' answers are measured separately.
+
+The DB is a temporary SQLite file installed by `Db` like in production.
+
+"""
+
+import asyncio
+import datetime
+import itertools
+import json
+import os
+import resource
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import aiohttp
+import aiohttp.web
+import telepot.aio.api
+from aiohttp.test_utils import TestServer
+from docopt import docopt
+from router_bot.bot import Bot
+from router_bot.client_bot import ClientBot
+from router_bot.client_bot_service import ClientBotService
+from router_bot.db import Db
+from router_bot.db_executor import DbExecutor
+from router_bot.send_scheduler import SendScheduler
+from router_bot.server import Server
+from router_bot.stats import Stats
+from router_bot.stats_service import StatsService
+from router_bot.talk import Talk
+from router_bot.talk_service import TalkService
+from router_bot.user import User
+from router_bot.user_service import UserService
+from telegram_bot_server import DictConfiguration as ServerConfiguration, SimpleUpdateService
+
+DOC = '''Load benchmark
+
+Usage:
+  load.py [--humans=N] [--bots=N] [--bot-capacity=N] [--rounds=N] [--messages=N] [--think-time=SECONDS]
+          [--timeout=SECONDS] [--workers=N] [--output=PATH]
+
+Options:
+  --humans=N             Number of simulated humans [default: 100].
+  --bots=N               Number of simulated client bots [default: 10].
+  --bot-capacity=N       Number of simultaneous talks of every client bot [default: 5].
+  --rounds=N             Number of talks every human tries to have [default: 3].
+  --messages=N           Number of messages every human sends during one talk [default: 10].
+  --think-time=SECONDS   Pause of human before every message [default: 0.01].
+  --timeout=SECONDS      Maximal time to wait for partner or partner's messages [default: 5].
+  --workers=N            Number of DbExecutor threads [default: 0].
+  --output=PATH          Where to save JSON results [default: load.json].
+'''
+MATCH_NOTIFICATIONS = ('Your partner is here.', 'Here\'s another user.')
+MESSAGE_PREFIX = 'm '
+BOT_MESSAGE_PREFIX = 'm bot '
+TOKEN = '123456789:ABCDEFGHIJKLMNOPQRSTUVWXYZ123456789'
+WEBHOOK_SECRET = 'benchmark'
+
+
+class TelegramStandIn:
+    """Local stand-in for Telegram Bot API. Delivers messages sent by router-bot to humans' inboxes.
+
+    """
+
+    def __init__(self):
+        self.inboxes = {}
+        # Maps text of the message to the time when it was sent by human or client bot.
+        self.sent_at = {}
+        self.latencies = []
+        self.bot_answers_latencies = []
+        self._messages_ids = itertools.count(1)
+        self.app = aiohttp.web.Application()
+        self.app.router.add_route('POST', '/bot{token}/{method}', self._handle)
+
+    async def _handle(self, request):
+        data = await request.post()
+        result = True
+        if request.match_info['method'] == 'sendMessage':
+            chat_id = int(data['chat_id'])
+            text = data['text']
+            sent_at = self.sent_at.pop(text, None)
+            if sent_at is not None:
+                latencies = self.bot_answers_latencies if text.startswith(BOT_MESSAGE_PREFIX) else self.latencies
+                latencies.append(time.monotonic() - sent_at)
+            self.inboxes[chat_id].put_nowait(text)
+            result = {
+                'message_id': next(self._messages_ids),
+                'chat': {'id': chat_id, 'type': 'private'},
+                'date': int(time.time()),
+                'text': text,
+                }
+        return aiohttp.web.json_response({'ok': True, 'result': result})
+
+
+class SimulatedHuman:
+    def __init__(self, telegram_id, session, webhook_url, telegram, updates_ids, arguments):
+        self._telegram_id = telegram_id
+        self._session = session
+        self._webhook_url = webhook_url
+        self._telegram = telegram
+        self._updates_ids = updates_ids
+        self._messages_ids = itertools.count(1)
+        self._arguments = arguments
+        self.inbox = asyncio.Queue()
+        telegram.inboxes[telegram_id] = self.inbox
+        self.matches_count = 0
+        self.sent_count = 0
+        self.received_count = 0
+
+    async def run(self):
+        await self._send('/start')
+        # Setup wizard asks novices about languages and sex.
+        await self._send('English')
+        await self._send('Not specified')
+        for i in range(self._arguments['rounds']):
+            self._clear_inbox()
+            await self._send('/begin')
+            if not await self._wait(lambda text: any(s in text for s in MATCH_NOTIFICATIONS), 1):
+                await self._send('/end')
+                continue
+            self.matches_count += 1
+            messages_count = self._arguments['messages']
+            receiving = asyncio.ensure_future(self._wait(lambda text: text.startswith(MESSAGE_PREFIX), messages_count))
+            for j in range(messages_count):
+                await asyncio.sleep(self._arguments['think_time'])
+                text = f'{MESSAGE_PREFIX}{self._telegram_id} {i} {j}'
+                self._telegram.sent_at[text] = time.monotonic()
+                await self._send(text)
+                self.sent_count += 1
+            await receiving
+            await self._send('/end')
+
+    def _clear_inbox(self):
+        while not self.inbox.empty():
+            self.inbox.get_nowait()
+
+    async def _send(self, text):
+        message = {
+            'message_id': next(self._messages_ids),
+            'from': {'id': self._telegram_id, 'is_bot': False, 'first_name': 'Human'},
+            'chat': {'id': self._telegram_id, 'type': 'private', 'first_name': 'Human'},
+            'date': int(time.time()),
+            'text': text,
+            }
+        if text.startswith('/'):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text)}]
+        update = {'update_id': next(self._updates_ids), 'message': message}
+        async with self._session.post(self._webhook_url, data=json.dumps(update)) as response:
+            await response.read()
+
+    async def _wait(self, is_expected, count):
+        """
+        Returns:
+            `True` if `count` expected messages were received before timeout.
+
+        """
+        deadline = time.monotonic() + self._arguments['timeout']
+        while count:
+            try:
+                text = await asyncio.wait_for(self.inbox.get(), max(0, deadline - time.monotonic()))
+            except asyncio.TimeoutError:
+                return False
+            if is_expected(text):
+                count -= 1
+                if text.startswith(MESSAGE_PREFIX):
+                    self.received_count += 1
+        return True
+
+
+class SimulatedClientBots:
+    """Receives messages which router-bot delivers to client bots and answers them through the server.
+
+    """
+
+    def __init__(self, telegram, arguments):
+        self._telegram = telegram
+        self._arguments = arguments
+        self.server = None
+        self.latencies = []
+        self.received_count = 0
+        self.answers_count = 0
+        self.failed_answers_count = 0
+        # Maps bot ID to the set of IDs of humans' chats whose talks were begun and weren't ended.
+        self._talks = {}
+        self.max_talks_count = 0
+        self._answering = set()
+
+    async def send_message(self, bot, chat, from_dict, text):
+        """Replaces `ClientBot.send_message`.
+
+        """
+        talks = self._talks.setdefault(bot.bot_id, set())
+        if text == '/start':
+            talks.add(chat['id'])
+            self.max_talks_count = max(self.max_talks_count, len(talks))
+            return
+        if text == '/end':
+            talks.discard(chat['id'])
+            return
+        sent_at = self._telegram.sent_at.pop(text, None)
+        if sent_at is not None:
+            self.latencies.append(time.monotonic() - sent_at)
+        self.received_count += 1
+        # Bot answers asynchronously like real bot answers after delivery of the update.
+        answering = asyncio.ensure_future(self._answer(bot, chat['id'], text))
+        self._answering.add(answering)
+        answering.add_done_callback(self._answering.discard)
+
+    async def _answer(self, bot, chat_id, text):
+        await asyncio.sleep(self._arguments['think_time'])
+        text = BOT_MESSAGE_PREFIX + text[len(MESSAGE_PREFIX):]
+        self._telegram.sent_at[text] = time.monotonic()
+        try:
+            await self.server._handle_send_message(SimulatedRequest(bot, text, chat_id))
+        except aiohttp.web.HTTPException:
+            self.failed_answers_count += 1
+        else:
+            self.answers_count += 1
+
+
+class SimulatedRequest:
+    def __init__(self, bot, text, chat_id):
+        self.bot = bot
+        self.data = {'text': text, 'chat_id': chat_id}
+
+
+class BenchmarkConfiguration:
+    token = TOKEN
+    webhook_secret = WEBHOOK_SECRET
+
+    def __init__(self, webhook_url):
+        self.webhook_url = webhook_url
+
+
+class DbConfiguration:
+    database_engine = 'sqlite'
+    database_pragmas = {}
+    database_pool = None
+
+    def __init__(self, path, executor_workers):
+        self.database_name = path
+        self.database_executor_workers = executor_workers
+
+
+def init_db(path, arguments):
+    db = Db(DbConfiguration(path, arguments['workers']))
+    db.install()
+    # Existing stats prevent StatsService from aggregating talks at start.
+    Stats.create(data_json='{}')
+    # Rows are inserted without `ClientBot.save()` which needs services.
+    for bot_id in range(1, arguments['bots'] + 1):
+        ClientBot.insert(
+            user=User.create(),
+            bot_id=bot_id,
+            secret='benchmark',
+            webhook='http://localhost/',
+            capacity=arguments['bot_capacity'],
+            ).execute()
+    return db
+
+
+async def measure(arguments):
+    loop = asyncio.get_event_loop()
+    telegram = TelegramStandIn()
+    telegram_server = TestServer(telegram.app, loop=loop)
+    await telegram_server.start_server(loop=loop)
+    telegram_url = str(telegram_server.make_url('')).rstrip('/')
+    telepot.aio.api._methodurl = lambda req, **user_kw: f'{telegram_url}/bot{req[0]}/{req[1]}'
+
+    client_bots = SimulatedClientBots(telegram, arguments)
+
+    async def send_message(bot, chat, from_dict, text):
+        await client_bots.send_message(bot, chat, from_dict, text)
+
+    ClientBot.send_message = send_message
+
+    UserService()
+    TalkService()
+    StatsService()
+    SendScheduler(global_rate=1e6, chat_rate=1e6, chat_burst=1000)
+    tasks = [asyncio.ensure_future(SendScheduler.get_instance().run())]
+    # Webhook URL isn't known before the server is started, so it's set later.
+    configuration = BenchmarkConfiguration(webhook_url='http://localhost')
+    bot = Bot(configuration)
+    update_service = SimpleUpdateService()
+    server = Server(
+        bot=bot,
+        bot_service=ClientBotService(update_service=update_service),
+        configuration=ServerConfiguration({'port': 0}),
+        update_service=update_service,
+        )
+    client_bots.server = server
+    router_server = TestServer(server._app, loop=loop)
+    await router_server.start_server(loop=loop)
+    bot._webhook_url = str(router_server.make_url('')).rstrip('/')
+    tasks.append(asyncio.ensure_future(bot.run()))
+
+    webhook_url = bot._webhook_url + Bot.WEBHOOK_PATH.format(secret=WEBHOOK_SECRET)
+    updates_ids = itertools.count(1)
+    async with aiohttp.ClientSession(loop=loop) as session:
+        humans = [
+            SimulatedHuman(telegram_id, session, webhook_url, telegram, updates_ids, arguments)
+            for telegram_id in range(1000001, 1000001 + arguments['humans'])
+            ]
+        started = time.monotonic()
+        await asyncio.gather(*(human.run() for human in humans))
+        duration = time.monotonic() - started
+
+    # telepot's message loop swallows cancellation, so tasks aren't awaited.
+    for task in tasks:
+        task.cancel()
+    await router_server.close()
+    await telegram_server.close()
+    bots_users_ids = [bot.user_id for bot in ClientBot.select()]
+    matches_count = Talk.select().count()
+    sent_count = sum(human.sent_count for human in humans) + client_bots.answers_count
+    relayed_count = len(telegram.latencies) + len(client_bots.latencies) + len(telegram.bot_answers_latencies)
+    return {
+        'humans': arguments['humans'],
+        'bots': arguments['bots'],
+        'bot_capacity': arguments['bot_capacity'],
+        'rounds': arguments['rounds'],
+        'messages': arguments['messages'],
+        'duration': duration,
+        'matches': matches_count,
+        'matches_per_second': matches_count / duration,
+        'bot_matches': Talk.select()
+            .where((Talk.partner1 << bots_users_ids) | (Talk.partner2 << bots_users_ids))
+            .count() if bots_users_ids else 0,
+        'bot_max_talks': client_bots.max_talks_count,
+        'sent_messages': sent_count,
+        'relayed_messages': relayed_count,
+        'lost_messages': sent_count - relayed_count,
+        'relayed_messages_per_second': relayed_count / duration,
+        **get_percentiles('relay_latency', telegram.latencies),
+        **get_percentiles('bot_relay_latency', client_bots.latencies),
+        **get_percentiles('bot_answer_latency', telegram.bot_answers_latencies),
+        'failed_bot_answers': client_bots.failed_answers_count,
+        # On Linux `ru_maxrss` is in kilobytes.
+        'peak_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        'created': datetime.datetime.utcnow().isoformat(),
+        }
+
+
+def get_percentiles(name, latencies):
+    latencies = sorted(latencies)
+    return {
+        f'{name}_p50': latencies[len(latencies) // 2] if latencies else None,
+        f'{name}_p99': latencies[int(len(latencies) * 0.99)] if latencies else None,
+        }
+
+
+def main():
+    arguments = docopt(DOC)
+    arguments = {
+        'humans': int(arguments['--humans']),
+        'bots': int(arguments['--bots']),
+        'bot_capacity': int(arguments['--bot-capacity']),
+        'rounds': int(arguments['--rounds']),
+        'messages': int(arguments['--messages']),
+        'think_time': float(arguments['--think-time']),
+        'timeout': float(arguments['--timeout']),
+        'workers': int(arguments['--workers']),
+        'output': arguments['--output'],
+        }
+    with tempfile.TemporaryDirectory() as directory:
+        db = init_db(os.path.join(directory, 'router-bot.db'), arguments)
+        DbExecutor(max_workers=arguments['workers'], release_connection=db.release_connection)
+        result = asyncio.get_event_loop().run_until_complete(measure(arguments))
+        DbExecutor.get_instance().shutdown()
+        db.flush()
+    with open(arguments['output'], 'w') as f:
+        json.dump(result, f, indent=4, sort_keys=True)
+    for key, value in sorted(result.items()):
+        print(f'{key:<30}{value}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+#
+# router-bot
+# Copyright (C) 2017 quasiyoke
+#
+# You should have received a copy of the GNU Affero General Public License v3
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Measures event loop lag caused by blocking DB operations with and without DbExecutor.
+
+Every simulated DB operation blocks its thread for QUERY_TIME seconds like a slow MySQL round trip does. Meanwhile
+a probe coroutine wakes up every millisecond and records how late it was woken.
+
+"""
+
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from docopt import docopt
+from router_bot.db_executor import DbExecutor
+
+DOC = '''Loop lag benchmark
+
+Usage:
+  loop_lag.py [--queries=N] [--concurrency=N] [--query-time=SECONDS] [--workers=N]
+
+Options:
+  --queries=N            Total number of simulated DB operations [default: 200].
+  --concurrency=N        Number of coroutines performing operations [default: 20].
+  --query-time=SECONDS   Duration of one operation [default: 0.005].
+  --workers=N            Number of DbExecutor threads for the "after" run [default: 8].
+'''
+PROBE_INTERVAL = 0.001
+
+
+def blocking_query(query_time):
+    time.sleep(query_time)
+
+
+async def probe(lags, is_finished):
+    loop = asyncio.get_event_loop()
+    while not is_finished.is_set():
+        expected = loop.time() + PROBE_INTERVAL
+        await asyncio.sleep(PROBE_INTERVAL)
+        lags.append(max(0, loop.time() - expected))
+
+
+async def client(db_executor, queries_count, query_time):
+    for i in range(queries_count):
+        await db_executor.run(blocking_query, query_time)
+
+
+async def measure(db_executor, queries, concurrency, query_time):
+    lags = []
+    is_finished = asyncio.Event()
+    probe_task = asyncio.ensure_future(probe(lags, is_finished))
+    started = time.monotonic()
+    await asyncio.gather(*[
+        client(db_executor, queries // concurrency, query_time)
+        for i in range(concurrency)
+        ])
+    duration = time.monotonic() - started
+    is_finished.set()
+    await probe_task
+    lags.sort()
+    return {
+        'duration': duration,
+        'lag_p50': lags[len(lags) // 2] if lags else 0,
+        'lag_p99': lags[int(len(lags) * 0.99)] if lags else 0,
+        'lag_max': lags[-1] if lags else 0,
+        }
+
+
+def main():
+    arguments = docopt(DOC)
+    queries = int(arguments['--queries'])
+    concurrency = int(arguments['--concurrency'])
+    query_time = float(arguments['--query-time'])
+    workers = int(arguments['--workers'])
+    loop = asyncio.get_event_loop()
+    print(f'{"mode":<18}{"duration, s":>12}{"lag p50, ms":>13}{"lag p99, ms":>13}{"lag max, ms":>13}')
+    for title, max_workers in (('inline (before)', 0), (f'{workers} workers (after)', workers)):
+        db_executor = DbExecutor(max_workers=max_workers)
+        result = loop.run_until_complete(measure(db_executor, queries, concurrency, query_time))
+        db_executor.shutdown()
+        print(
+            f'{title:<18}{result["duration"]:>12.3f}{result["lag_p50"] * 1000:>13.2f}'
+            f'{result["lag_p99"] * 1000:>13.2f}{result["lag_max"] * 1000:>13.2f}'
+            )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+#
+# router-bot
+# Copyright (C) 2017 quasiyoke
+#
+# You should have received a copy of the GNU Affero General Public License v3
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Counts DB round trips needed to begin and to end a talk.
+
+"Before" run reproduces statements which were issued by `User.end_talk` and `User.set_partner` earlier: every lookup
+of the partner selected the talk and both its partners, and the talk and users were saved by separate autocommit
+full-row UPDATEs. Notifications of partners are left out of both runs. "After" run uses `TalkService.change_talk`.
+Every executed statement and every commit is counted as a round trip, like it would be for MySQL. Benchmark uses
+in-memory SQLite, so timings show only the client side overhead and SQLite's "BEGIN" statements aren't counted because
+MySQL connection doesn't need them.
+
+"""
+
+import asyncio
+import datetime
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from docopt import docopt
+from peewee import DoesNotExist, SqliteDatabase
+from router_bot import client_bot, human, stats, talk, user
+from router_bot.client_bot import ClientBot
+from router_bot.human import Human
+from router_bot.stats import Stats
+from router_bot.stats_service import StatsService
+from router_bot.talk import Talk
+from router_bot.talk_service import TalkService
+from router_bot.user import User
+from router_bot.user_service import UserService
+
+DOC = '''Talk transitions benchmark
+
+Usage:
+  talk_transitions.py [--transitions=N]
+
+Options:
+  --transitions=N   Number of talks to begin and to end in every run [default: 1000].
+'''
+
+
+class CountingDatabase(SqliteDatabase):
+    def __init__(self, *args, **kwargs):
+        super(CountingDatabase, self).__init__(*args, **kwargs)
+        self.round_trips_count = 0
+
+    def commit(self):
+        self.round_trips_count += 1
+        super(CountingDatabase, self).commit()
+
+    def execute_sql(self, sql, *args, **kwargs):
+        if not sql.startswith('BEGIN'):
+            self.round_trips_count += 1
+        return super(CountingDatabase, self).execute_sql(sql, *args, **kwargs)
+
+
+def create_users(count):
+    now = datetime.datetime.utcnow()
+    return [User.create(looking_for_partner_from=now) for i in range(count)]
+
+
+def get_talk_before(user):
+    """Former `Talk.get_talk`.
+
+    """
+    try:
+        talk = Talk.get(((Talk.partner1 == user) | (Talk.partner2 == user)) & (Talk.end == None))
+    except DoesNotExist:
+        return None
+    user_service = UserService.get_instance()
+    talk.partner1 = user_service.get_cached_user(talk.partner1)
+    talk.partner2 = user_service.get_cached_user(talk.partner2)
+    return talk
+
+
+def get_partner_before(user):
+    """Former `User.get_partner`.
+
+    """
+    talk = get_talk_before(user)
+    return None if talk is None else talk.get_partner(user)
+
+
+def set_partner_before(user, partner):
+    """Former `User.set_partner` without kicking of the former partner.
+
+    """
+    current_partner = get_partner_before(user)
+    if current_partner == partner:
+        user.save()
+        return
+    if current_partner is not None:
+        # Partner's partner was checked before kicking.
+        get_partner_before(current_partner)
+        talk = get_talk_before(user)
+        if talk is not None:
+            talk.end = datetime.datetime.utcnow()
+            talk.save()
+    if partner is not None:
+        Talk.create(
+            partner1=user,
+            partner2=partner,
+            searched_since=partner.looking_for_partner_from,
+            )
+        if user.looking_for_partner_from is not None:
+            user.looking_for_partner_from = None
+        partner.looking_for_partner_from = None
+        partner.save()
+    user.save()
+
+
+async def begin_before(talk_service, user1, user2):
+    set_partner_before(user1, user2)
+
+
+async def end_before(talk_service, user1, user2):
+    # Former `User.end_talk` checked whether the user is chatting before `set_partner`.
+    get_partner_before(user1)
+    set_partner_before(user1, None)
+
+
+async def begin_after(talk_service, user1, user2):
+    await talk_service.change_talk(user1, partner=user2)
+
+
+async def end_after(talk_service, user1, user2):
+    await talk_service.change_talk(user1, talk_service.get_talk(user1))
+
+
+async def measure(db, begin, end, transitions):
+    talk_service = TalkService.get_instance()
+    users = create_users(transitions * 2)
+    pairs = [(users[i], users[i + 1]) for i in range(0, len(users), 2)]
+    result = {}
+    for title, transit in (('begin', begin), ('end', end)):
+        db.round_trips_count = 0
+        started = time.monotonic()
+        for user1, user2 in pairs:
+            await transit(talk_service, user1, user2)
+        result[title] = (db.round_trips_count / transitions, (time.monotonic() - started) / transitions)
+    return result
+
+
+def main():
+    arguments = docopt(DOC)
+    transitions = int(arguments['--transitions'])
+    db = CountingDatabase(':memory:')
+    for module in (client_bot, human, stats, talk, user):
+        module.database_proxy.initialize(db)
+    db.create_tables((User, ClientBot, Human, Stats, Talk))
+    # Existing stats prevent StatsService from aggregating talks at start.
+    Stats.create(data_json='{}')
+    StatsService()
+    UserService()
+    TalkService()
+    loop = asyncio.get_event_loop()
+    print(f'{"mode":<10}{"transition":<12}{"round trips":>13}{"time, ms":>10}')
+    for title, begin, end in (('before', begin_before, end_before), ('after', begin_after, end_after)):
+        result = loop.run_until_complete(measure(db, begin, end, transitions))
+        for transition, (round_trips, duration) in result.items():
+            print(f'{title:<10}{transition:<12}{round_trips:>13.1f}{duration * 1000:>10.3f}')
+
+
+if __name__ == '__main__':
+    main()
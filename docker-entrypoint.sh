@@ -1,4 +1,5 @@
 #!/usr/bin/env bash
 
 /router_bot_runner.py install /configuration/configuration.json
+/router_bot_runner.py migrate /configuration/configuration.json
 /router_bot_runner.py /configuration/configuration.json
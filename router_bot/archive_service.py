@@ -0,0 +1,85 @@
+# router-bot
+# Copyright (C) 2017 quasiyoke
+#
+# You should have received a copy of the GNU Affero General Public License v3
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import datetime
+import logging
+from .db_executor import DbExecutor
+from .talk import ArchivedTalk, Talk
+from peewee import fn
+
+LOGGER = logging.getLogger('router_bot.archive_service')
+
+
+class ArchiveService:
+    """Periodically moves talks which ended long ago from `Talk` to `ArchivedTalk`, so lookups of current talks and
+    aggregation of recent stats work with the small table.
+
+    """
+
+    def __init__(self, age, interval=60 * 60, batch_size=1000):
+        """
+        Args:
+            age (float): Seconds since the end after which the talk is archived.
+            interval (float): Seconds between archivations.
+            batch_size (int): Maximal number of talks moved in one transaction.
+
+        """
+        self._age = datetime.timedelta(seconds=age)
+        self._interval = interval
+        self._batch_size = batch_size
+
+    async def run(self):
+        while True:
+            before = datetime.datetime.utcnow() - self._age
+            archived_count = 0
+            while True:
+                batch_count = await DbExecutor.get_instance().run(self._archive_batch, before, self._batch_size)
+                archived_count += batch_count
+                if batch_count < self._batch_size:
+                    break
+            if archived_count:
+                LOGGER.info('%d talks were archived', archived_count)
+            await asyncio.sleep(self._interval)
+
+    @staticmethod
+    def _archive_batch(before, batch_size):
+        """Blocking. Moves talks which ended before the moment to the archive in one transaction.
+
+        Returns:
+            Number of archived talks.
+
+        """
+        fields = (
+            Talk.id,
+            Talk.partner1,
+            Talk.partner1_sent,
+            Talk.partner2,
+            Talk.partner2_sent,
+            Talk.searched_since,
+            Talk.begin,
+            Talk.end,
+            )
+        with Talk._meta.database.atomic():
+            # The latest talk is never archived: after restart the DB may assign its ID to the next talk.
+            max_id = Talk.select(fn.MAX(Talk.id)).scalar()
+            if max_id is None:
+                return 0
+            talks_ids = [
+                talk.id
+                for talk in Talk.select(Talk.id)
+                .where((Talk.end < before) & (Talk.id < max_id))
+                .order_by(Talk.id)
+                .limit(batch_size)
+                ]
+            if not talks_ids:
+                return 0
+            ArchivedTalk.insert_from(
+                [getattr(ArchivedTalk, field.name) for field in fields],
+                Talk.select(*fields).where(Talk.id << talks_ids),
+                ).execute()
+            Talk.delete().where(Talk.id << talks_ids).execute()
+        return len(talks_ids)
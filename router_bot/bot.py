@@ -5,6 +5,7 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import asyncio
+import collections
 import logging
 import telepot
 from .admin_handler import AdminHandler
@@ -17,6 +18,14 @@ LOGGER = logging.getLogger('router_bot.bot')
 
 
 class Bot:
+    """Receives updates from Telegram using long polling or, if webhook is configured, from the server's webhook
+    handler.
+
+    """
+    WEBHOOK_PATH = '/telegram/{secret}'
+    # Number of the latest updates' IDs remembered to skip updates which were delivered twice.
+    WEBHOOK_UPDATES_IDS_COUNT = 10000
+
     def __init__(self, configuration):
         user_service = UserService.get_instance()
         admins_telegram_ids = user_service.admins_telegram_ids
@@ -41,7 +50,44 @@ class Bot:
                     ),
                 ],
             )
+        self._webhook_url = configuration.webhook_url
+        self._webhook_secret = configuration.webhook_secret
+        self._updates = asyncio.Queue()
+        self._updates_ids = set()
+        self._updates_ids_order = collections.deque()
+
+    def feed_update(self, update):
+        """Puts update received by the webhook to the queue of updates.
+
+        Returns:
+            `False` if such update was received already.
+
+        """
+        update_id = update['update_id']
+        if update_id in self._updates_ids:
+            LOGGER.debug('Update %d was received twice', update_id)
+            return False
+        self._updates_ids.add(update_id)
+        self._updates_ids_order.append(update_id)
+        if len(self._updates_ids_order) > type(self).WEBHOOK_UPDATES_IDS_COUNT:
+            self._updates_ids.discard(self._updates_ids_order.popleft())
+        self._updates.put_nowait(update)
+        return True
+
+    def get_webhook_secret(self):
+        return self._webhook_secret
+
+    def is_webhook_enabled(self):
+        return self._webhook_url is not None
 
     async def run(self):
-        LOGGER.info('Listening')
-        await self._delegator_bot.message_loop()
+        if not self.is_webhook_enabled():
+            # Webhook could be set by previous run. Telegram refuses `getUpdates` while it's set.
+            await self._delegator_bot.deleteWebhook()
+            LOGGER.info('Listening')
+            await self._delegator_bot.message_loop()
+            return
+        webhook_url = self._webhook_url.rstrip('/') + type(self).WEBHOOK_PATH.format(secret=self._webhook_secret)
+        await self._delegator_bot.setWebhook(webhook_url)
+        LOGGER.info('Listening to the webhook')
+        await self._delegator_bot.message_loop(source=self._updates)
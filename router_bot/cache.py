@@ -0,0 +1,113 @@
+# router-bot
+# Copyright (C) 2017 quasiyoke
+#
+# You should have received a copy of the GNU Affero General Public License v3
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import collections
+import logging
+import time
+
+LOGGER = logging.getLogger('router_bot.cache')
+
+
+class LruCache:
+    """Mapping which evicts least recently used entries when it's full and entries which weren't used for `ttl`
+    seconds. Pinned entries are never evicted.
+
+    Pinned entries which are met during eviction are moved aside and don't count against `max_size`, so eviction
+    doesn't walk through them again when they fill the cache. One of them is rechecked on every insertion and is
+    returned to the LRU order when it isn't pinned anymore.
+
+    """
+
+    def __init__(self, max_size, ttl, is_pinned=None):
+        """
+        Args:
+            max_size (int): Maximal number of entries. Pinned entries can exceed it.
+            ttl (float): Seconds after last usage of the entry when it can be evicted.
+            is_pinned (callable): Takes the value and returns `True` if the entry shouldn't be evicted.
+
+        """
+        self._max_size = max_size
+        self._ttl = ttl
+        self._is_pinned = is_pinned
+        # Maps key to the pair `[value, time of last usage]`. Entries are ordered by time of last usage.
+        self._entries = collections.OrderedDict()
+        # Pinned entries moved aside by eviction, in order of their rechecking.
+        self._pinned_entries = collections.OrderedDict()
+        self._hits_count = 0
+        self._misses_count = 0
+        self._evictions_count = 0
+
+    def __contains__(self, key):
+        return key in self._entries or key in self._pinned_entries
+
+    def __len__(self):
+        return len(self._entries) + len(self._pinned_entries)
+
+    def discard(self, key):
+        self._entries.pop(key, None)
+        self._pinned_entries.pop(key, None)
+
+    def get(self, key):
+        """
+        Raises:
+            KeyError if there's no such entry.
+
+        """
+        try:
+            entry = self._entries[key]
+        except KeyError:
+            try:
+                entry = self._pinned_entries[key]
+            except KeyError:
+                self._misses_count += 1
+                raise
+        else:
+            self._entries.move_to_end(key)
+        self._hits_count += 1
+        entry[1] = time.monotonic()
+        return entry[0]
+
+    def get_stats(self):
+        return {
+            'size': len(self),
+            'hits': self._hits_count,
+            'misses': self._misses_count,
+            'evictions': self._evictions_count,
+            }
+
+    def put(self, key, value):
+        now = time.monotonic()
+        self._pinned_entries.pop(key, None)
+        self._entries[key] = [value, now]
+        self._entries.move_to_end(key)
+        self._recheck_pinned_entry(now)
+        self._evict(now)
+
+    def _evict(self, now):
+        # Every checked entry leaves the LRU order, so the loop takes amortized constant time per insertion.
+        while self._entries:
+            key, entry = next(iter(self._entries.items()))
+            if len(self._entries) <= self._max_size and now - entry[1] < self._ttl:
+                break
+            del self._entries[key]
+            if self._is_pinned is not None and self._is_pinned(entry[0]):
+                # Pinned entry is considered as used now.
+                entry[1] = now
+                self._pinned_entries[key] = entry
+                continue
+            self._evictions_count += 1
+
+    def _recheck_pinned_entry(self, now):
+        if not self._pinned_entries:
+            return
+        key, entry = next(iter(self._pinned_entries.items()))
+        if self._is_pinned(entry[0]):
+            self._pinned_entries.move_to_end(key)
+            return
+        del self._pinned_entries[key]
+        # The entry was pinned until now, so it's considered as used now.
+        entry[1] = now
+        self._entries[key] = entry
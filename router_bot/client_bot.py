@@ -4,6 +4,7 @@
 # You should have received a copy of the GNU Affero General Public License v3
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import asyncio
 import datetime
 import logging
 from .error import MissingPartnerError, UserError, HumanSenderError
@@ -19,16 +20,92 @@ database_proxy = Proxy()
 
 
 class ClientBot(BaseClientBot, Model):
+    """Client bot talks with humans like another human does. Every human is shown to the bot as a separate private chat,
+    so the bot can have up to `capacity` talks simultaneously.
+
+    """
     user = ForeignKeyField(User, primary_key=True, related_name='client_bots')
     bot_id = IntegerField(unique=True)
     secret = CharField(max_length=60)
     webhook = CharField(max_length=127)
+    # Maximal number of simultaneous talks.
+    capacity = IntegerField(default=1)
+
+    # Seconds to wait for delivery of one message to the bot.
+    SENDING_TIMEOUT = 10
 
     class Meta:
         database = database_proxy
 
+    def delete_instance(self, *args, **kwargs):
+        from .client_bot_service import ClientBotService
+        from .user_service import UserService
+        result = super(ClientBot, self).delete_instance(*args, **kwargs)
+        ClientBotService.invalidate()
+        UserService.get_instance().discard_concrete_user(self)
+        return result
+
+    def save(self, *args, **kwargs):
+        from .client_bot_service import ClientBotService
+        from .user_service import UserService
+        result = super(ClientBot, self).save(*args, **kwargs)
+        ClientBotService.invalidate()
+        UserService.get_instance().discard_concrete_user(self)
+        return result
+
+    async def notify_partner_found(self, partner):
+        """
+        Raises:
+            UserError If the bot can't be notified.
+
+        """
+        await self._send_from(partner, '/start')
+
+    async def notify_talk_was_finished(self, by_self, partner):
+        """
+        Args:
+            by_self (bool): Whether the talk was finished by the bot.
+            partner (User): Partner of the finished talk.
+
+        Raises:
+            UserError If the bot can't be notified.
+
+        """
+        await self._send_from(partner, '/end')
+
+    async def send(self, message, sender):
+        """
+        Args:
+            sender (User): Partner who has sent the message.
+
+        Raises:
+            UserError if can't send message because of unsupported content type or if the bot is unavailable.
+
+        """
+        if message.type != 'text':
+            raise UserError(f'Can\'t send content of type {message.type} to client bot {self.bot_id}.')
+        await self._send_from(sender, message.text)
+
     async def set_webhook(self, url):
         is_changed = await super(ClientBot, self).set_webhook(url)
         if is_changed:
             self.save()
         return is_changed
+
+    async def _send_from(self, partner, text):
+        """Delivers the text to the bot as if the partner has sent it from her private chat.
+
+        Raises:
+            UserError if the bot is unavailable.
+
+        """
+        human = await partner.get_concrete_user()
+        chat = {'id': human.telegram_id, 'type': 'private'}
+        from_dict = {'id': human.telegram_id, 'is_bot': False, 'first_name': 'Human'}
+        try:
+            await asyncio.wait_for(
+                self.send_message(chat=chat, from_dict=from_dict, text=text),
+                type(self).SENDING_TIMEOUT,
+                )
+        except Exception as err:
+            raise UserError(f'Can\'t send message to client bot {self.bot_id}: {err}') from err
@@ -6,14 +6,23 @@
 
 import logging
 from .client_bot import ClientBot
+from .db_executor import DbExecutor
 from .error import HumanSenderServiceError
 from .human_sender import HumanSender
+from .user import User
 from telegram_bot_server import BotService, BotServiceError
 
 LOGGER = logging.getLogger('router_bot.client_bot_service')
 
 
 class ClientBotService(BotService):
+    """Keeps registry of client bots in memory. Registry is reloaded from the DB after any bot was saved or deleted.
+
+    """
+    # Maps bot ID to the bot. `None` means that registry should be reloaded.
+    _bots = None
+    _bots_version = 0
+
     def __init__(self, *args, **kwargs):
         """
         Args:
@@ -26,7 +35,7 @@ class ClientBotService(BotService):
         super(ClientBotService, self).__init__(bot_cls=ClientBot, *args, **kwargs)
 
     async def get_all_bots(self):
-        return ClientBot.select()
+        return list((await self._get_bots()).values())
 
     async def get_bot(self, bot_id):
         """
@@ -37,4 +46,55 @@ class ClientBotService(BotService):
             Bot instance or `None`.
 
         """
-        return ClientBot.get(bot_id)
+        return (await self._get_bots()).get(bot_id)
+
+    @classmethod
+    async def get_free_bot(cls, reserved=None, excluded_ids=()):
+        """
+        Args:
+            reserved (dict): Maps bot's user ID to the number of talks which are being begun with the bot.
+            excluded_ids (iterable): Users' IDs of bots which shouldn't be returned.
+
+        Returns:
+            Bot with the most free capacity or `None` if all bots are busy.
+
+        """
+        from .talk_service import TalkService
+        talk_service = TalkService.get_instance()
+        free_bot = None
+        max_free_capacity = 0
+        for bot in (await cls._get_bots()).values():
+            if bot.user_id in excluded_ids:
+                continue
+            # In database matching mode the index of talks is synchronized with the DB periodically, so free capacity is
+            # checked by the DB again when the talk is begun.
+            free_capacity = bot.capacity - talk_service.get_user_talks_count(bot.user_id)
+            if reserved is not None:
+                free_capacity -= reserved.get(bot.user_id, 0)
+            if free_capacity > max_free_capacity:
+                free_bot = bot
+                max_free_capacity = free_capacity
+        return free_bot
+
+    @classmethod
+    def invalidate(cls):
+        """Makes the registry to be reloaded on next request. Is called when some client bot was changed.
+
+        """
+        cls._bots_version += 1
+        cls._bots = None
+
+    @classmethod
+    async def _get_bots(cls):
+        bots = cls._bots
+        if bots is None:
+            version = cls._bots_version
+            bots = await DbExecutor.get_instance().run(cls._load_bots)
+            # Bots could be changed during loading. Then loaded registry is outdated already.
+            if version == cls._bots_version:
+                cls._bots = bots
+        return bots
+
+    @staticmethod
+    def _load_bots():
+        return {bot.bot_id: bot for bot in ClientBot.select(ClientBot, User).join(User)}
@@ -7,10 +7,13 @@
 import codecs
 import json
 import logging
+import string
 from .error import ConfigurationObtainingError
+from .transcript_recorder import FSYNC_POLICIES
 from telegram_bot_server import DictConfiguration as ServerConfiguration
 
 LOGGER = logging.getLogger('router_bot.configuration')
+WEBHOOK_SECRET_CHARS = frozenset(string.ascii_letters + string.digits + '-_')
 
 
 class Configuration:
@@ -27,13 +30,142 @@ class Configuration:
             raise ConfigurationObtainingError(f'Troubles with parsing \"{path}\"') from err
 
         try:
-            self.database_host = configuration_json['database']['host']
+            archive_json = configuration_json.get('archive')
+            if archive_json is None:
+                self.archive_age = None
+                self.archive_interval = None
+                self.archive_batch_size = None
+            else:
+                self.archive_age = float(archive_json['age'])
+                self.archive_interval = float(archive_json.get('interval', 60 * 60))
+                self.archive_batch_size = int(archive_json.get('batch_size', 1000))
+            self.database_engine = configuration_json['database'].get('engine', 'mysql')
             self.database_name = configuration_json['database']['name']
-            self.database_user = configuration_json['database']['user']
-            self.database_password = configuration_json['database']['password']
+            if self.database_engine == 'sqlite':
+                self.database_host = None
+                self.database_user = None
+                self.database_password = None
+            else:
+                self.database_host = configuration_json['database']['host']
+                self.database_user = configuration_json['database']['user']
+                self.database_password = configuration_json['database']['password']
+            self.database_pragmas = dict(configuration_json['database'].get('pragmas', {}))
+            self.database_executor_workers = int(configuration_json['database'].get('executor_workers', 0))
+            pool_json = configuration_json['database'].get('pool')
+            if pool_json is None:
+                self.database_pool = None
+            else:
+                self.database_pool = {
+                    'min_connections': int(pool_json.get('min_connections', 1)),
+                    'max_connections': int(pool_json.get('max_connections', 10)),
+                    'stale_timeout': int(pool_json.get('stale_timeout', 300)),
+                    'wait_timeout': int(pool_json.get('wait_timeout', 10)),
+                    }
+            idle_json = configuration_json.get('idle', {})
+            self.idle_talk_timeout = idle_json.get('talk_timeout')
+            if self.idle_talk_timeout is not None:
+                self.idle_talk_timeout = float(self.idle_talk_timeout)
+            self.idle_search_timeout = idle_json.get('search_timeout')
+            if self.idle_search_timeout is not None:
+                self.idle_search_timeout = float(self.idle_search_timeout)
             self.logging = configuration_json['logging']
+            logging_queue_json = configuration_json.get('logging_queue', {})
+            self.logging_queue_enabled = bool(logging_queue_json.get('enabled', True))
+            self.logging_sample_rate = float(logging_queue_json.get('sample_rate', 1))
+            self.logging_sampled_loggers = [str(logger) for logger in logging_queue_json.get('sampled_loggers', [])]
+            matching_json = configuration_json.get('matching', {})
+            self.matching_mode = matching_json.get('mode', 'memory')
+            self.matching_sync_interval = float(matching_json.get('sync_interval', 1))
             self.server = ServerConfiguration(configuration_json['server'])
+            sending_json = configuration_json.get('sending', {})
+            self.sending_global_rate = float(sending_json.get('global_rate', 30))
+            self.sending_chat_rate = float(sending_json.get('chat_rate', 1))
+            self.sending_chat_burst = int(sending_json.get('chat_burst', 1))
+            stats_json = configuration_json.get('stats', {})
+            self.stats_incremental = bool(stats_json.get('incremental', False))
+            talks_json = configuration_json.get('talks', {})
+            self.talks_write_behind = bool(talks_json.get('write_behind', False))
+            self.talks_flush_interval = float(talks_json.get('flush_interval', 5))
+            self.talks_max_loss_window = float(talks_json.get('max_loss_window', 30))
             self.token = configuration_json['token']
-        except (KeyError, TypeError) as err:
+            transcripts_json = configuration_json.get('transcripts')
+            if transcripts_json is None:
+                self.transcripts_directory = None
+            else:
+                self.transcripts_directory = transcripts_json['directory']
+                self.transcripts_buffer_size = int(transcripts_json.get('buffer_size', 10000))
+                self.transcripts_flush_interval = float(transcripts_json.get('flush_interval', 1))
+                self.transcripts_segment_size = int(transcripts_json.get('segment_size', 64 * 1024 * 1024))
+                self.transcripts_fsync = transcripts_json.get('fsync', 'batch')
+            webhook_json = configuration_json.get('webhook')
+            if webhook_json is None:
+                self.webhook_url = None
+                self.webhook_secret = None
+            else:
+                self.webhook_url = webhook_json['url']
+                self.webhook_secret = webhook_json['secret']
+        except (AttributeError, KeyError, TypeError, ValueError) as err:
             LOGGER.error('Troubles with obtaining parameters: %s', err)
             raise ConfigurationObtainingError(f'Troubles with obtaining parameters \"{err}\"') from err
+
+        if self.archive_age is not None and not (self.archive_age > 0 and self.archive_batch_size > 0):
+            reason = 'Archive\'s \"age\" and \"batch_size\" should be positive'
+            LOGGER.error(reason)
+            raise ConfigurationObtainingError(reason)
+
+        if self.database_engine not in ('mysql', 'sqlite'):
+            reason = 'DB \"engine\" should be \"mysql\" or \"sqlite\"'
+            LOGGER.error(reason)
+            raise ConfigurationObtainingError(reason)
+
+        if self.database_pool is not None and self.database_engine != 'mysql':
+            reason = 'DB \"pool\" is supported by \"mysql\" engine only'
+            LOGGER.error(reason)
+            raise ConfigurationObtainingError(reason)
+
+        if self.database_pool is not None and \
+                not 0 <= self.database_pool['min_connections'] <= self.database_pool['max_connections']:
+            reason = 'DB pool\'s \"min_connections\" should be between 0 and \"max_connections\"'
+            LOGGER.error(reason)
+            raise ConfigurationObtainingError(reason)
+
+        if any(timeout is not None and timeout <= 0 for timeout in (self.idle_talk_timeout, self.idle_search_timeout)):
+            reason = 'Idle \"talk_timeout\" and \"search_timeout\" should be positive'
+            LOGGER.error(reason)
+            raise ConfigurationObtainingError(reason)
+
+        if not 0 <= self.logging_sample_rate <= 1:
+            reason = 'Logging queue\'s \"sample_rate\" should be between 0 and 1'
+            LOGGER.error(reason)
+            raise ConfigurationObtainingError(reason)
+
+        if self.matching_mode not in ('memory', 'database'):
+            reason = 'Matching \"mode\" should be \"memory\" or \"database\"'
+            LOGGER.error(reason)
+            raise ConfigurationObtainingError(reason)
+
+        if self.matching_sync_interval <= 0:
+            reason = 'Matching \"sync_interval\" should be positive'
+            LOGGER.error(reason)
+            raise ConfigurationObtainingError(reason)
+
+        if self.transcripts_directory is not None and self.transcripts_fsync not in FSYNC_POLICIES:
+            reason = f'Transcripts\' \"fsync\" should be one of: {", ".join(FSYNC_POLICIES)}'
+            LOGGER.error(reason)
+            raise ConfigurationObtainingError(reason)
+
+        if self.transcripts_directory is not None and self.transcripts_buffer_size <= 0:
+            reason = 'Transcripts\' \"buffer_size\" should be positive'
+            LOGGER.error(reason)
+            raise ConfigurationObtainingError(reason)
+
+        if self.webhook_secret is not None and \
+                not (self.webhook_secret and all(c in WEBHOOK_SECRET_CHARS for c in self.webhook_secret)):
+            reason = 'Webhook\'s \"secret\" should consist of letters, digits, \"-\" and \"_\"'
+            LOGGER.error(reason)
+            raise ConfigurationObtainingError(reason)
+
+        if self.talks_max_loss_window < self.talks_flush_interval:
+            reason = 'Talks\' \"max_loss_window\" should be greater than or equal to \"flush_interval\"'
+            LOGGER.error(reason)
+            raise ConfigurationObtainingError(reason)
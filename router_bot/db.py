@@ -5,51 +5,269 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import logging
+import threading
+import time
 from .client_bot import ClientBot
-from .error import DbError
+from .error import DbError, TalkServiceError
 from .human import Human
+from .metrics import DB_QUERIES, DB_QUERIES_TIME
+from .migrations import get_hot_queries, LATEST_VERSION, MIGRATIONS
+from .schema_version import SchemaVersion
 from .stats import Stats
-from .talk import Talk
+from .talk import ArchivedTalk, Talk
+from .talk_service import TalkService
 from .user import User
-from peewee import DatabaseError, MySQLDatabase
+from peewee import DatabaseError, MySQLDatabase, SqliteDatabase
+from playhouse.migrate import SchemaMigrator
+from playhouse.pool import MaxConnectionsExceeded, PooledMySQLDatabase
 from playhouse.shortcuts import RetryOperationalError
-from router_bot import client_bot, human, stats, talk, user
+from router_bot import client_bot, human, schema_version, stats, talk, user
 
 LOGGER = logging.getLogger('router_bot.db')
+# Column type of `PreciseDateTimeField`. MySQL's `DATETIME` drops fractions of a second.
+MYSQL_FIELD_OVERRIDES = dict(MySQLDatabase.field_overrides, datetime_precise='DATETIME(6)')
 
 
-class RetryingDB(RetryOperationalError, MySQLDatabase):
+class MeasuringDB:
+    """Mixin which counts executed queries and their time.
+
+    """
+
+    def execute_sql(self, *args, **kwargs):
+        started = time.monotonic()
+        try:
+            return super(MeasuringDB, self).execute_sql(*args, **kwargs)
+        finally:
+            DB_QUERIES.inc()
+            DB_QUERIES_TIME.inc(amount=time.monotonic() - started)
+
+
+class RetryingDB(MeasuringDB, RetryOperationalError, MySQLDatabase):
     """Automatically reconnecting database class.
     @see http://docs.peewee-orm.com/en/latest/peewee/database.html#automatic-reconnect
 
     """
-    pass
+    field_overrides = MYSQL_FIELD_OVERRIDES
+
+
+class RetryingPooledDB(MeasuringDB, RetryOperationalError, PooledMySQLDatabase):
+    """Pool of automatically reconnecting connections. Every thread checks out its own connection, so the pool can be
+    used from DbExecutor's threads. Collects metrics of waiting for connections.
+    @see http://docs.peewee-orm.com/en/latest/peewee/database.html#connection-pooling
+
+    """
+    field_overrides = MYSQL_FIELD_OVERRIDES
+
+    def __init__(self, *args, min_connections=0, **kwargs):
+        self.min_connections = min_connections
+        self._metrics_lock = threading.Lock()
+        self._checkouts_count = 0
+        self._checkouts_time = 0
+        self._checkouts_max_time = 0
+        self._timeouts_count = 0
+        super(RetryingPooledDB, self).__init__(*args, **kwargs)
+
+    def connect(self):
+        started = time.monotonic()
+        try:
+            super(RetryingPooledDB, self).connect()
+        except MaxConnectionsExceeded:
+            with self._metrics_lock:
+                self._timeouts_count += 1
+            raise
+        checkout_time = time.monotonic() - started
+        with self._metrics_lock:
+            self._checkouts_count += 1
+            self._checkouts_time += checkout_time
+            self._checkouts_max_time = max(self._checkouts_max_time, checkout_time)
+
+    def fill(self):
+        """Opens connections until the pool has `min_connections` of them.
+
+        """
+        with self._conn_lock:
+            missing_count = self.min_connections - len(self._connections) - len(self._in_use)
+            connections = [self._connect(self.database, **self.connect_kwargs) for i in range(missing_count)]
+            for connection in connections:
+                self._close(connection)
+
+    def get_pool_stats(self):
+        with self._metrics_lock:
+            return {
+                'checkouts_count': self._checkouts_count,
+                'checkouts_average_time': self._checkouts_time / self._checkouts_count
+                if self._checkouts_count else 0,
+                'checkouts_max_time': self._checkouts_max_time,
+                'timeouts_count': self._timeouts_count,
+                'idle_connections_count': len(self._connections),
+                'used_connections_count': len(self._in_use),
+                }
+
+
+class SqliteDB(MeasuringDB, SqliteDatabase):
+    """Embedded database for single-node deployments. Every thread uses its own connection. WAL journal lets readers
+    work while another connection writes.
+
+    """
+    # SQLite keeps datetimes as text with fractions of a second.
+    field_overrides = dict(SqliteDatabase.field_overrides, datetime_precise='DATETIME')
+    PRAGMAS = (
+        ('journal_mode', 'wal'),
+        # Commits in WAL mode stay durable across application crashes with less fsyncs.
+        ('synchronous', 'normal'),
+        ('foreign_keys', 'on'),
+        # Milliseconds to wait for the write lock held by another connection.
+        ('busy_timeout', 10000),
+        # Negative value is in kibibytes.
+        ('cache_size', -16000),
+        ('temp_store', 'memory'),
+        )
+
+    def __init__(self, database, pragmas=None, **kwargs):
+        """
+        Args:
+            pragmas (dict): Overrides default `PRAGMAS`.
+
+        """
+        merged_pragmas = dict(type(self).PRAGMAS)
+        merged_pragmas.update(pragmas or {})
+        super(SqliteDB, self).__init__(database, pragmas=list(merged_pragmas.items()), **kwargs)
+
+    def transaction(self, transaction_type=None):
+        # Transactions read rows before updating them. Deferred transaction fails at once without waiting if another
+        # connection has written meanwhile, so the write lock is taken at the beginning.
+        return super(SqliteDB, self).transaction(transaction_type or 'IMMEDIATE')
 
 
 class Db:
     def __init__(self, configuration):
-        self._db = RetryingDB(
-            configuration.database_name,
-            host=configuration.database_host,
-            user=configuration.database_user,
-            password=configuration.database_password,
-            )
+        if configuration.database_engine == 'sqlite':
+            self._db = SqliteDB(configuration.database_name, pragmas=configuration.database_pragmas)
+        elif configuration.database_pool is None:
+            self._db = RetryingDB(
+                configuration.database_name,
+                host=configuration.database_host,
+                user=configuration.database_user,
+                password=configuration.database_password,
+                )
+        else:
+            self._db = RetryingPooledDB(
+                configuration.database_name,
+                host=configuration.database_host,
+                user=configuration.database_user,
+                password=configuration.database_password,
+                min_connections=configuration.database_pool['min_connections'],
+                max_connections=configuration.database_pool['max_connections'],
+                stale_timeout=configuration.database_pool['stale_timeout'],
+                timeout=configuration.database_pool['wait_timeout'],
+                )
+            if configuration.database_executor_workers >= configuration.database_pool['max_connections']:
+                LOGGER.warning(
+                    'DB pool has %d connections for %d executor workers and the event loop\'s thread. '
+                    'Some workers will wait for connections.',
+                    configuration.database_pool['max_connections'],
+                    configuration.database_executor_workers,
+                    )
         # Connect to database just to check if configuration has errors.
         try:
             self._db.connect()
+            if self.is_pooled():
+                self._db.fill()
         except DatabaseError as err:
             raise DbError(f'DatabaseError during connecting to database. {err}') from err
         client_bot.database_proxy.initialize(self._db)
         human.database_proxy.initialize(self._db)
+        schema_version.database_proxy.initialize(self._db)
         stats.database_proxy.initialize(self._db)
         talk.database_proxy.initialize(self._db)
         user.database_proxy.initialize(self._db)
 
     def install(self):
         try:
-            self._db.create_tables((User, ClientBot, Human, Stats, Talk))
+            self._db.create_tables((User, ClientBot, Human, Stats, Talk, ArchivedTalk, SchemaVersion))
+            # Created tables already have the latest schema.
+            SchemaVersion.create(version=LATEST_VERSION)
         except DatabaseError as err:
             raise DbError(f'DatabaseError during creating tables. {err}') from err
 
+    def migrate(self):
+        """Applies migrations which weren't applied to the DB yet.
+
+        Returns:
+            List of applied versions.
+
+        """
+        applied_versions = []
+        try:
+            self._db.create_tables((SchemaVersion, ), safe=True)
+            current_version = SchemaVersion.get_current()
+            migrator = SchemaMigrator.from_database(self._db)
+            for version, migration in MIGRATIONS:
+                if version <= current_version:
+                    continue
+                LOGGER.info('Applying migration %d', version)
+                migration(migrator)
+                SchemaVersion.create(version=version)
+                applied_versions.append(version)
+        except DatabaseError as err:
+            raise DbError(f'DatabaseError during migrating. {err}') from err
+        return applied_versions
+
+    def get_schema_version(self):
+        """
+        Returns:
+            Pair `(current version, latest version)`.
+
+        """
+        try:
+            current_version = SchemaVersion.get_current() if SchemaVersion.table_exists() else 0
+        except DatabaseError as err:
+            raise DbError(f'DatabaseError during obtaining schema version. {err}') from err
+        return current_version, LATEST_VERSION
+
+    def get_query_plans(self):
+        """
+        Returns:
+            List of triples `(title, SQL, plan)` for the hot queries. Plan is a list of dicts with columns of `EXPLAIN`
+            output.
+
+        """
+        explain = 'EXPLAIN QUERY PLAN' if isinstance(self._db, SqliteDatabase) else 'EXPLAIN'
+        plans = []
+        try:
+            for title, query in get_hot_queries():
+                sql, params = query.sql()
+                cursor = self._db.execute_sql(f'{explain} {sql}', params)
+                columns = [description[0] for description in cursor.description]
+                plans.append((title, sql, [dict(zip(columns, row)) for row in cursor.fetchall()]))
+        except DatabaseError as err:
+            raise DbError(f'DatabaseError during explaining queries. {err}') from err
+        return plans
+
+    def get_pool_stats(self):
+        """
+        Returns:
+            dict with metrics of the connections pool or `None` if the pool isn't used.
+
+        """
+        return self._db.get_pool_stats() if self.is_pooled() else None
+
+    def is_pooled(self):
+        return isinstance(self._db, RetryingPooledDB)
+
+    def release_connection(self):
+        """Returns connection of the current thread to the pool. Does nothing if the pool isn't used.
+
+        """
+        if self.is_pooled() and not self._db.is_closed():
+            self._db.close()
+
     def flush(self):
+        try:
+            talk_service = TalkService.get_instance()
+        except TalkServiceError:
+            # Talks weren't loaded, so there's nothing to flush.
+            pass
+        else:
+            talk_service.flush()
         self._db.close()
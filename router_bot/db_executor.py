@@ -0,0 +1,65 @@
+# router-bot
+# Copyright (C) 2017 quasiyoke
+#
+# You should have received a copy of the GNU Affero General Public License v3
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import functools
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+LOGGER = logging.getLogger('router_bot.db_executor')
+
+
+class DbExecutor:
+    """Runs blocking DB operations on a bounded pool of threads, so slow queries don't stall the event loop.
+
+    Peewee keeps a separate connection for every thread, so each worker uses its own connection. Without workers
+    operations are executed right in the event loop's thread.
+
+    """
+    _instance = None
+
+    def __init__(self, max_workers=0, release_connection=None):
+        """
+        Args:
+            max_workers (int): Number of threads. `0` means that operations will be executed synchronously.
+            release_connection (callable): Is called in worker thread after every operation to return the thread's
+                connection to the pool.
+
+        """
+        self._release_connection = release_connection
+        if max_workers:
+            self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        else:
+            self._executor = None
+        type(self)._instance = self
+
+    @classmethod
+    def get_instance(cls):
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance
+
+    async def run(self, function, *args, **kwargs):
+        """Executes `function(*args, **kwargs)` outside of the event loop and returns its result.
+
+        Function shouldn't change any state shared with the coroutines because it's executed in another thread.
+
+        """
+        if self._executor is None:
+            return function(*args, **kwargs)
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(self._call, function, args, kwargs))
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+
+    def _call(self, function, args, kwargs):
+        try:
+            return function(*args, **kwargs)
+        finally:
+            if self._release_connection is not None:
+                self._release_connection()
@@ -5,6 +5,10 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+class ClientBotCapacityError(Exception):
+    pass
+
+
 class ConfigurationObtainingError(Exception):
     pass
 
@@ -45,6 +49,14 @@ class UserServiceError(Exception):
     pass
 
 
+class TalkServiceError(Exception):
+    pass
+
+
+class TranscriptRecorderError(Exception):
+    pass
+
+
 class UnknownCommandError(Exception):
     def __init__(self, command):
         super(UnknownCommandError, self).__init__()
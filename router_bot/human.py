@@ -6,6 +6,7 @@
 
 import datetime
 import logging
+from .db_executor import DbExecutor
 from .error import DbError, HumanSenderError, MissingPartnerError, UserError
 from .stats_service import StatsService
 from .user import User
@@ -36,7 +37,8 @@ class Human(Model):
 
     @classmethod
     def create(cls, *args, **kwargs):
-        user = User.create()
+        # Specify all fields explicitly to let `user.save()` update them later.
+        user = User.create(looking_for_partner_from=None)
         return super().create(
             user=user,
             *args,
@@ -44,33 +46,74 @@ class Human(Model):
             )
 
     @classmethod
-    def get_or_create_human(self, telegram_id):
+    async def get_or_create_human(cls, telegram_id):
+        """Obtains human from the cache or from the DB.
+
+        Raises:
+            DbError
+
         """
+        user_service = UserService.get_instance()
+        try:
+            return user_service.get_cached_human(telegram_id)
+        except KeyError:
+            pass
+        human = await DbExecutor.get_instance().run(cls._get_or_create_human, telegram_id)
+        human.user = user_service.get_cached_user(human.user)
+        return user_service.cache_concrete_user(human)
+
+    @classmethod
+    def _get_or_create_human(cls, telegram_id):
+        """Blocking part of `get_or_create_human`. Obtains human together with her user.
+
         Raises:
             DbError
 
         """
         try:
             try:
-                human = Human.get(Human.telegram_id == telegram_id)
+                human = cls.select(cls, User) \
+                    .join(User) \
+                    .where(cls.telegram_id == telegram_id) \
+                    .get()
             except DoesNotExist:
-                human = Human.create(
+                human = cls.create(
                     telegram_id=telegram_id,
                     )
         except DatabaseError as err:
             raise DbError(f'Database problems during `get_or_create_human`: {err}') from err
-        human.user = UserService.get_instance().get_cached_user(human.user)
         return human
 
     @classmethod
-    def get_human(self, telegram_id):
+    async def get_human(cls, telegram_id):
+        """Obtains existing human from the cache or from the DB.
+
+        Raises:
+            DbError
+
         """
+        user_service = UserService.get_instance()
+        try:
+            return user_service.get_cached_human(telegram_id)
+        except KeyError:
+            pass
+        human = await DbExecutor.get_instance().run(cls._get_human, telegram_id)
+        human.user = user_service.get_cached_user(human.user)
+        return user_service.cache_concrete_user(human)
+
+    @classmethod
+    def _get_human(cls, telegram_id):
+        """Blocking part of `get_human`. Obtains human together with her user.
+
         Raises:
             DbError
 
         """
         try:
-            human = Human.get(Human.telegram_id == telegram_id)
+            human = cls.select(cls, User) \
+                .join(User) \
+                .where(cls.telegram_id == telegram_id) \
+                .get()
         except (DatabaseError, DoesNotExist) as err:
             raise DbError(f'Database problems during `get_human`: {err}') from err
         return human
@@ -78,6 +121,22 @@ class Human(Model):
     def get_sender(self):
         return HumanSenderService.get_instance().get_or_create_human_sender(self)
 
+    def is_full(self):
+        """
+        Returns:
+            `True` if all preferences of the human are set.
+
+        """
+        return self.user.languages_json is not None and self.user.sex is not None and self.user.partner_sex is not None
+
+    def is_novice(self):
+        """
+        Returns:
+            `True` if the human hasn't set any preferences yet.
+
+        """
+        return self.user.languages_json is None and self.user.sex is None and self.user.partner_sex is None
+
     async def notify_looking_for_partner(self):
         """
         Raises:
@@ -108,7 +167,8 @@ class Human(Model):
         sender = self.get_sender()
         sentences = []
 
-        if self.user.get_partner() is None:
+        # Talk with the partner could be created already.
+        if self.user.get_partner() in (None, partner):
             sentences.append('Your partner is here.')
         else:
             sentences.append('Here\'s another user.')
@@ -128,10 +188,14 @@ class Human(Model):
         try:
             await sender.send_notification(' '.join(sentences))
         except TelegramError as err:
-            raise UserError(f'Can\'t notify user {self.id}. {err}') from err
+            raise UserError(f'Can\'t notify user {self.user_id}. {err}') from err
 
-    async def notify_talk_was_finished(self, by_self):
+    async def notify_talk_was_finished(self, by_self, partner):
         """
+        Args:
+            by_self (bool): Whether the talk was finished by the human.
+            partner (User): Partner of the finished talk.
+
         Raises:
             UserError If human we're notifying has blocked the bot.
 
@@ -151,15 +215,17 @@ class Human(Model):
         except TelegramError as err:
             raise UserError(str(err)) from err
 
-    async def send(self, message):
+    async def send(self, message, sender):
         """
+        Args:
+            sender (User): Partner who has sent the message.
+
         Raises:
             UserError if can't send message because of unknown content type.
             TelegramError if user has blocked the bot.
 
         """
-        sender = self.get_sender()
         try:
-            await sender.send(message)
+            await self.get_sender().send(message)
         except HumanSenderError as err:
             raise UserError(f'Can\'t send content: {err}') from err
@@ -15,7 +15,11 @@ from .error import DbError, MissingPartnerError, PartnerObtainingError, \
 from .human import Human
 from .human_sender import HumanSender
 from .human_sender_service import HumanSenderService
+from .human_setup_wizard import HumanSetupWizard
+from .logging_pipeline import SAMPLED
 from .message import Message
+from .metrics import CHAT_MESSAGE_LATENCY, COMMANDS, ERRORS
+from .reaper import Reaper
 from .user_service import UserService
 from .util import __version__
 from telepot.exception import TelegramError
@@ -28,30 +32,41 @@ class HumanHandler(telepot.aio.helper.UserHandler):
         super(HumanHandler, self).__init__(seed_tuple, *args, **kwargs)
         bot, initial_msg, seed = seed_tuple
         self._from_id = initial_msg['from']['id']
+        # Human is obtained from the DB asynchronously during handling of the first message.
+        self._human = None
+        self._sender = None
+        self._wizard = None
+
+    async def _obtain_human(self):
+        if self._human is not None:
+            return
         try:
-            self._human = Human.get_or_create_human(self._from_id)
+            self._human = await Human.get_or_create_human(self._from_id)
         except DbError as err:
             LOGGER.error('Problems with obtaining the human: %s', err)
-            sys.exit('Problems with obtaining the human: {err}')
-        self._sender = HumanSenderService.get_instance(bot). \
+            sys.exit(f'Problems with obtaining the human: {err}')
+        self._sender = HumanSenderService.get_instance(self.bot). \
             get_or_create_human_sender(self._human)
+        self._wizard = HumanSetupWizard(self._human)
 
     async def handle_command(self, message):
         handler_name = '_handle_command_' + message.command
         try:
             handler = getattr(self, handler_name)
         except AttributeError as err:
+            COMMANDS.inc('unknown')
             raise UnknownCommandError(message.command) from err
+        COMMANDS.inc(message.command)
         await handler(message)
 
     async def _handle_command_begin(self, message):
         try:
             await UserService.get_instance().match_partner(self._human.user)
         except PartnerObtainingError:
-            LOGGER.debug('Looking for partner: %d', self._human.user.id)
+            LOGGER.debug('Looking for partner: %d', self._human.user.id, extra=SAMPLED)
             await self._human.user.set_looking_for_partner()
         except UserServiceError as err:
-            LOGGER.warning('Can\'t set partner for %d. %s', self._human.id, err)
+            LOGGER.warning('Can\'t set partner for %d. %s', self._human.user_id, err)
 
     async def _handle_command_end(self, message):
         partner = self._human.user.get_partner()
@@ -59,6 +74,7 @@ class HumanHandler(telepot.aio.helper.UserHandler):
             '/end: %d -x-> %s',
             self._human.user_id,
             'none' if partner is None else partner.id,
+            extra=SAMPLED,
             )
         await self._human.user.end_talk()
 
@@ -67,7 +83,8 @@ class HumanHandler(telepot.aio.helper.UserHandler):
             await self._sender.send_notification(
                 '*Help*\n\n'
                 'Use /begin to start looking for a conversational partner, once '
-                'you\'re matched you can use /end to finish the conversation.\n\n'
+                'you\'re matched you can use /end to finish the conversation. Use /setup to change your languages '
+                'and preferences about partner\'s sex.\n\n'
                 'If you have any suggestions or require help, visit [Conversational Intelligence Challenge website]'
                 '(http://convai.io). When asking questions, please provide this number: {0}.\n\n'
                 'You\'re welcome to inspect and improve [router-bot v. {1} source code]'
@@ -79,8 +96,12 @@ class HumanHandler(telepot.aio.helper.UserHandler):
         except TelegramError as err:
             LOGGER.warning('Handle /help command. Can\'t notify user. %s', err)
 
+    async def _handle_command_setup(self, message):
+        LOGGER.debug('/setup: %d', self._human.user.id)
+        await self._wizard.activate()
+
     async def _handle_command_start(self, message):
-        LOGGER.debug('/start: %d', self._human.user.id)
+        LOGGER.debug('/start: %d', self._human.user.id, extra=SAMPLED)
         try:
             await self._sender.send_notification(
                 '*Manual*\n\nHi, I’m Conversational Intelligence Challenge master-bot. Use /begin to start looking '
@@ -92,43 +113,55 @@ class HumanHandler(telepot.aio.helper.UserHandler):
     async def on_close(self, error):
         pass
 
+    @CHAT_MESSAGE_LATENCY.timed
     async def on_chat_message(self, message_dict):
         content_type, chat_type, chat_id = telepot.glance(message_dict)
 
         if chat_type != 'private':
             return
 
+        await self._obtain_human()
+        Reaper.get_instance().touch_user(self._human.user_id)
+
         try:
             message = Message(message_dict)
         except UnsupportedContentError:
+            ERRORS.inc('UnsupportedContentError')
             await self._sender.send_notification('Messages of this type aren\'t supported.')
             return
 
         if message.command:
+            if await self._wizard.handle_command(message):
+                return
             try:
                 await self.handle_command(message)
             except UnknownCommandError:
                 await self._sender.send_notification('Unknown command. Look /help for the full list of commands.')
         else:
+            if await self._wizard.handle(message):
+                return
             try:
                 await self._human.user.send_to_partner(message)
             except MissingPartnerError:
                 pass
             except UserError:
+                ERRORS.inc('UserError')
                 await self._sender.send_notification('Messages of this type aren\'t supported.')
             except TelegramError:
+                ERRORS.inc('TelegramError')
                 LOGGER.warning(
                     'Send message. Can\'t send to partner: %d -> %d',
-                    self._human.id,
-                    self._human.get_partner().id,
+                    self._human.user_id,
+                    self._human.user.get_partner().id,
                     )
                 await self._sender.send_notification(
                     'Your partner has blocked me! How did you do that?!',
                     )
-                await self._human.end_talk()
+                await self._human.user.end_talk()
 
     async def on_edited_chat_message(self, message_dict):
         LOGGER.info('User tried to edit their message.')
+        await self._obtain_human()
         await self._sender.send_notification(
             'Messages editing isn\'t supported',
             )
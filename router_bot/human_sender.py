@@ -9,6 +9,7 @@ import logging
 import re
 import telepot
 from .error import HumanSenderError
+from .send_scheduler import PRIORITY_MESSAGE, PRIORITY_NOTIFICATION, SendScheduler
 
 LOGGER = logging.getLogger('router_bot.human_sender')
 
@@ -24,6 +25,10 @@ class HumanSender(telepot.helper.Sender):
         self._bot = bot
         self._user = user
 
+    @property
+    def human(self):
+        return self._user
+
     @classmethod
     def _escape_markdown(cls, s):
         """
@@ -47,7 +52,12 @@ class HumanSender(telepot.helper.Sender):
         except KeyError:
             raise HumanSenderError(f'Unsupported content_type: {message.type}')
         else:
-            await getattr(self, method_name)(**message.sending_kwargs)
+            await SendScheduler.get_instance().send(
+                self._user.telegram_id,
+                getattr(self, method_name),
+                dict(message.sending_kwargs),
+                priority=PRIORITY_MESSAGE,
+                )
 
     async def send_notification(self, message, *args, disable_notification=None, disable_web_page_preview=None,
                                 reply_markup=None):
@@ -64,10 +74,15 @@ class HumanSender(telepot.helper.Sender):
                     ],
                 'one_time_keyboard': True,
                 }
-        await self.sendMessage(
-            f'*ConvAI:* {message}',
-            disable_notification=disable_notification,
-            disable_web_page_preview=disable_web_page_preview,
-            parse_mode='Markdown',
-            reply_markup=reply_markup,
+        await SendScheduler.get_instance().send(
+            self._user.telegram_id,
+            self.sendMessage,
+            {
+                'text': f'*ConvAI:* {message}',
+                'disable_notification': disable_notification,
+                'disable_web_page_preview': disable_web_page_preview,
+                'parse_mode': 'Markdown',
+                'reply_markup': reply_markup,
+                },
+            priority=PRIORITY_NOTIFICATION,
             )
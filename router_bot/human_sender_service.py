@@ -5,6 +5,7 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import logging
+from .cache import LruCache
 from .error import HumanSenderServiceError
 from .human_sender import HumanSender
 
@@ -12,11 +13,17 @@ LOGGER = logging.getLogger('router_bot.human_sender_service')
 
 
 class HumanSenderService:
+    CACHE_MAX_SIZE = 10000
+    CACHE_TTL = 60 * 60
     _instance = None
 
     def __init__(self, bot):
         self._bot = bot
-        self._human_senders = {}
+        self._human_senders = LruCache(
+            type(self).CACHE_MAX_SIZE,
+            type(self).CACHE_TTL,
+            is_pinned=self._is_pinned,
+            )
 
     @classmethod
     def get_instance(cls, bot=None):
@@ -31,12 +38,22 @@ class HumanSenderService:
         return cls._instance
 
     def get_cache_size(self):
-        return len(self._human_senders)
+        """
+        Returns:
+            dict with size of the cache and numbers of its hits, misses and evictions.
+
+        """
+        return self._human_senders.get_stats()
 
     def get_or_create_human_sender(self, human):
         try:
-            human_sender = self._human_senders[human.telegram_id]
+            human_sender = self._human_senders.get(human.telegram_id)
         except KeyError:
             human_sender = HumanSender(self._bot, human)
-            self._human_senders[human.telegram_id] = human_sender
+            self._human_senders.put(human.telegram_id, human_sender)
         return human_sender
+
+    @staticmethod
+    def _is_pinned(human_sender):
+        from .user_service import UserService
+        return UserService.get_instance().is_pinned(human_sender.human.user_id)
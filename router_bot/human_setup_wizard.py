@@ -9,12 +9,59 @@ import logging
 import re
 import sys
 import telepot
+from .db_executor import DbExecutor
 from .error import MissingPartnerError, UserError
 from .human_sender_service import HumanSenderService
+from .user import LANGUAGES_CHOICES, SEX_CHOICES, User
+from .user_service import UserService
 from .wizard import Wizard
 from telepot.exception import TelegramError
 
 LOGGER = logging.getLogger('router_bot.human_setup_wizard')
+LANGUAGES_KEYBOARD = {
+    'keyboard': [
+        {name: language for language, name in LANGUAGES_CHOICES[i:i + 2]}
+        for i in range(0, len(LANGUAGES_CHOICES), 2)
+        ],
+    }
+SEX_KEYBOARD = {
+    'keyboard': [
+        {name: sex for sex, name in SEX_CHOICES[:2]},
+        {name: sex for sex, name in SEX_CHOICES[2:]},
+        ],
+    }
+# Maps lowercased names and codes of languages to their codes.
+LANGUAGES_BY_NAMES = dict(
+    [(name.lower(), language) for language, name in LANGUAGES_CHOICES] +
+    [(language, language) for language, name in LANGUAGES_CHOICES]
+    )
+# Maps lowercased names of sexes to their codes.
+SEXES_BY_NAMES = {name.lower(): sex for sex, name in SEX_CHOICES}
+LANGUAGES_SEPARATOR_RE = re.compile('[\\s,;]+')
+
+
+def parse_languages(text):
+    """
+    Returns:
+        List of codes of languages enumerated in the text without duplicates.
+
+    Raises:
+        ValueError if some language is unknown or there're no languages in the text.
+
+    """
+    languages = []
+    for name in LANGUAGES_SEPARATOR_RE.split(text.strip().lower()):
+        if not name:
+            continue
+        try:
+            language = LANGUAGES_BY_NAMES[name]
+        except KeyError as err:
+            raise ValueError(f'Unknown language: {name}') from err
+        if language not in languages:
+            languages.append(language)
+    if not languages:
+        raise ValueError('No languages were specified.')
+    return languages
 
 
 class HumanSetupWizard(Wizard):
@@ -22,21 +69,21 @@ class HumanSetupWizard(Wizard):
 
     """
 
-    def __init__(self, user):
+    def __init__(self, human):
         super(HumanSetupWizard, self).__init__()
-        self._user = user
-        self._sender = HumanSenderService.get_instance().get_or_create_human_sender(user)
+        self._human = human
+        self._sender = HumanSenderService.get_instance().get_or_create_human_sender(human)
 
     async def activate(self):
-        self._user.wizard = 'setup'
-        self._user.wizard_step = 'languages'
-        self._user.save()
+        self._human.wizard = 'setup'
+        self._human.wizard_step = 'languages'
+        await DbExecutor.get_instance().run(self._human.save)
         await self._prompt()
 
     async def deactivate(self):
-        self._user.wizard = 'none'
-        self._user.wizard_step = None
-        self._user.save()
+        self._human.wizard = 'none'
+        self._human.wizard_step = None
+        await DbExecutor.get_instance().run(self._human.save)
         try:
             await self._sender.send_notification(
                 'Thank you. Use /begin to start looking for a conversational partner, '
@@ -51,25 +98,57 @@ class HumanSetupWizard(Wizard):
         @returns `True` if message was interpreted in this method. `False` if message still needs
             interpretation.
         """
-        if self._user.wizard == 'none':  # Wizard isn't active. Check if we should activate it.
-            if self._user.is_novice():
+        if self._human.wizard == 'none':  # Wizard isn't active. Check if we should activate it.
+            if self._human.is_novice():
                 await self.activate()
                 return True
             else:
                 return False
-        elif self._user.wizard != 'setup':
+        elif self._human.wizard != 'setup':
             return False
+        user = self._human.user
+        text = message.text or ''
         try:
-            if self._user.wizard_step == 'languages':
-                pass
-            elif self._user.wizard_step == 'sex':
-                pass
-            elif self._user.wizard_step == 'partner_sex':
-                pass
+            if self._human.wizard_step == 'languages':
+                try:
+                    languages = parse_languages(text)
+                except ValueError as e:
+                    await self._sender.send_notification(
+                        'Can\'t recognize languages: {0}. Enter names of languages you speak separated by commas '
+                        'or choose one of them.',
+                        e,
+                        )
+                    await self._prompt()
+                    return True
+                user.set_languages(languages)
+                await self._save_user_preferences()
+                await self._set_wizard_step('sex')
+            elif self._human.wizard_step == 'sex':
+                try:
+                    user.sex = SEXES_BY_NAMES[text.strip().lower()]
+                except KeyError:
+                    await self._prompt()
+                    return True
+                if user.sex == 'not_specified':
+                    # Human who hasn't specified her sex can't choose partner's sex.
+                    user.partner_sex = 'not_specified'
+                    await self._save_user_preferences()
+                    await self.deactivate()
+                else:
+                    await self._save_user_preferences()
+                    await self._set_wizard_step('partner_sex')
+            elif self._human.wizard_step == 'partner_sex':
+                try:
+                    user.partner_sex = SEXES_BY_NAMES[text.strip().lower()]
+                except KeyError:
+                    await self._prompt()
+                    return True
+                await self._save_user_preferences()
+                await self.deactivate()
             else:
                 LOGGER.warning(
                     'Undknown wizard_step value was found: \"%s\"',
-                    self._user.wizard_step,
+                    self._human.wizard_step,
                 )
         except TelegramError as e:
             LOGGER.warning('handle() Can not notify user. %s', e)
@@ -80,11 +159,11 @@ class HumanSetupWizard(Wizard):
         @returns `True` if command was interpreted in this method. `False` if command still needs
             interpretation.
         """
-        if self._user.wizard == 'none':
+        if self._human.wizard == 'none':
             # Wizard isn't active. Check if we should activate it.
             return (await self.handle(message)) and message.command != 'start'
-        elif self._user.is_full():
-            if self._user.wizard == 'setup':
+        elif self._human.is_full():
+            if self._human.wizard == 'setup':
                 await self.deactivate()
             return False
         else:
@@ -98,10 +177,13 @@ class HumanSetupWizard(Wizard):
             return True
 
     async def _prompt(self):
-        wizard_step = self._user.wizard_step
+        wizard_step = self._human.wizard_step
         try:
             if wizard_step == 'languages':
-                pass
+                await self._sender.send_notification(
+                    'Enter languages you speak separated by commas, e.g. \"English, Russian\", or choose one of them.',
+                    reply_markup=LANGUAGES_KEYBOARD,
+                    )
             elif wizard_step == 'sex':
                 await self._sender.send_notification(
                     'Set up your sex. If you pick \"Not Specified\" you can\'t choose '
@@ -115,3 +197,17 @@ class HumanSetupWizard(Wizard):
                     )
         except TelegramError as e:
             LOGGER.warning('_prompt() Can not notify user. %s', e)
+
+    async def _save_user_preferences(self):
+        """Saves only preferences, so `looking_for_partner_from` changed meanwhile isn't overwritten. Waiting queue is
+        synchronized with new preferences.
+
+        """
+        user = self._human.user
+        await DbExecutor.get_instance().run(user.save, only=[User.languages_json, User.sex, User.partner_sex])
+        UserService.get_instance().update_waiting_user(user)
+
+    async def _set_wizard_step(self, wizard_step):
+        self._human.wizard_step = wizard_step
+        await DbExecutor.get_instance().run(self._human.save)
+        await self._prompt()
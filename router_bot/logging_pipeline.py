@@ -0,0 +1,132 @@
+# router-bot
+# Copyright (C) 2017 quasiyoke
+#
+# You should have received a copy of the GNU Affero General Public License v3
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Handlers configured by `logging.config.dictConfig` are moved to background threads: loggers get `QueueHandler`
+instead of them, so writing of records doesn't block the event loop. Per-message events are logged with `extra=SAMPLED`
+and only the configured part of them is passed to the queue.
+
+"""
+
+import datetime
+import json
+import logging
+import logging.handlers
+import queue
+import threading
+
+LOGGER = logging.getLogger('router_bot.logging_pipeline')
+# Extra attributes of per-message records which should be sampled.
+SAMPLED = {'sampled': True}
+# Attributes which every record has. Other attributes are extra ones.
+RECORD_ATTRIBUTES = frozenset(logging.makeLogRecord({}).__dict__) | {'asctime', 'message', 'sampled'}
+EXCEPTION_FORMATTER = logging.Formatter()
+
+
+class SamplingFilter(logging.Filter):
+    """Passes `rate` part of sampled records: records logged with `extra=SAMPLED` and records of sampled loggers.
+    Other records are always passed.
+
+    """
+
+    def __init__(self, rate=1, loggers=()):
+        """
+        Args:
+            rate (float): Part of sampled records to pass, from 0 to 1.
+            loggers (iterable): Names of loggers whose records (including records of their children) are sampled,
+                e.g. "peewee" which logs every query.
+
+        """
+        super(SamplingFilter, self).__init__()
+        self._rate = rate
+        self._loggers = tuple(loggers)
+        self._credit = 0
+        # Records are filtered in the threads which log them, e.g. in the event loop's thread and in DB executor's
+        # threads.
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if not (getattr(record, 'sampled', False) or self._is_sampled_logger(record.name)):
+            return True
+        # Accumulating credit passes exactly `rate` part of records evenly.
+        with self._lock:
+            self._credit += self._rate
+            if self._credit >= 1:
+                self._credit -= 1
+                return True
+        return False
+
+    def _is_sampled_logger(self, name):
+        return any(name == logger or name.startswith(logger + '.') for logger in self._loggers)
+
+
+class QueueHandler(logging.handlers.QueueHandler):
+    """Merges arguments into the message, because they could be changed before the record is handled. Unlike
+    the standard handler, keeps exception's text apart from the message, so target handlers format it themselves.
+
+    """
+
+    def prepare(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = EXCEPTION_FORMATTER.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats records as JSON objects with "time", "level", "logger", "message" and extra attributes, one per line.
+
+    """
+
+    def format(self, record):
+        data = {
+            'time': datetime.datetime.utcfromtimestamp(record.created).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            }
+        if record.exc_info:
+            data['exception'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            data['exception'] = record.exc_text
+        for key, value in record.__dict__.items():
+            if key not in RECORD_ATTRIBUTES:
+                data[key] = value
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+def enqueue_handlers(sample_rate=1, sampled_loggers=()):
+    """Should be called after `logging.config.dictConfig`. Replaces handlers of every logger with `QueueHandler` whose
+    records are handled by the same handlers in the background thread.
+
+    Args:
+        sample_rate (float): Part of sampled records to pass to the queue.
+        sampled_loggers (iterable): Names of loggers whose records are sampled.
+
+    Returns:
+        List of started `QueueListener`. They should be stopped on shutdown to write the rest of records.
+
+    """
+    loggers = [logging.getLogger()] + [
+        logger
+        for logger in logging.Logger.manager.loggerDict.values()
+        if isinstance(logger, logging.Logger)
+        ]
+    listeners = []
+    for logger in loggers:
+        if not logger.handlers:
+            continue
+        records_queue = queue.Queue()
+        queue_handler = QueueHandler(records_queue)
+        queue_handler.addFilter(SamplingFilter(sample_rate, sampled_loggers))
+        listener = logging.handlers.QueueListener(records_queue, *logger.handlers, respect_handler_level=True)
+        logger.handlers = [queue_handler]
+        listener.start()
+        listeners.append(listener)
+    LOGGER.debug('Handlers of %d loggers were moved to background threads', len(listeners))
+    return listeners
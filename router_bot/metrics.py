@@ -0,0 +1,321 @@
+# router-bot
+# Copyright (C) 2017 quasiyoke
+#
+# You should have received a copy of the GNU Affero General Public License v3
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""In-memory metrics which are exposed in Prometheus text format.
+
+Recording only updates a few numbers under uncontended lock, so metrics can be recorded on hot paths. Gauges are
+obtained from the services when metrics are rendered.
+
+"""
+
+import bisect
+import functools
+import logging
+import threading
+import time
+
+LOGGER = logging.getLogger('router_bot.metrics')
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+LATENCY_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    labels = ','.join(
+        '{0}="{1}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in pairs
+        )
+    return '{' + labels + '}'
+
+
+class Counter:
+    def __init__(self, name, description, labels=()):
+        self._name = name
+        self._description = description
+        self._labels = labels
+        self._lock = threading.Lock()
+        # Maps tuple of labels' values to the value.
+        self._values = {}
+        if not labels:
+            self._values[()] = 0
+
+    def inc(self, *labels_values, amount=1):
+        with self._lock:
+            self._values[labels_values] = self._values.get(labels_values, 0) + amount
+
+    def render(self):
+        lines = [
+            f'# HELP {self._name} {self._description}',
+            f'# TYPE {self._name} counter',
+            ]
+        with self._lock:
+            values = list(self._values.items())
+        for labels_values, value in sorted(values):
+            lines.append(f'{self._name}{_format_labels(self._labels, labels_values)} {value}')
+        return lines
+
+
+class Gauge:
+    """Gauge which obtains its values from the callback during rendering.
+
+    """
+
+    def __init__(self, name, description, get_values, labels=()):
+        """
+        Args:
+            get_values (callable): Returns dict which maps tuple of labels' values to the value.
+
+        """
+        self._name = name
+        self._description = description
+        self._get_values = get_values
+        self._labels = labels
+
+    def render(self):
+        lines = [
+            f'# HELP {self._name} {self._description}',
+            f'# TYPE {self._name} gauge',
+            ]
+        try:
+            values = self._get_values()
+        except Exception as err:
+            LOGGER.warning('Can\'t obtain values of %s: %s', self._name, err)
+            return lines
+        for labels_values, value in sorted(values.items()):
+            lines.append(f'{self._name}{_format_labels(self._labels, labels_values)} {value}')
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, description, buckets=LATENCY_BUCKETS):
+        self._name = name
+        self._description = description
+        self._buckets = buckets
+        self._lock = threading.Lock()
+        # Last count is for values greater than all buckets.
+        self._counts = [0] * (len(buckets) + 1)
+        self._sum = 0
+
+    def observe(self, value):
+        index = bisect.bisect_left(self._buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+
+    def render(self):
+        lines = [
+            f'# HELP {self._name} {self._description}',
+            f'# TYPE {self._name} histogram',
+            ]
+        with self._lock:
+            counts = list(self._counts)
+            values_sum = self._sum
+        accumulated = 0
+        for bucket, count in zip(self._buckets + ('+Inf', ), counts):
+            accumulated += count
+            lines.append(f'{self._name}_bucket{_format_labels((), (), (("le", bucket), ))} {accumulated}')
+        lines.append(f'{self._name}_sum {values_sum}')
+        lines.append(f'{self._name}_count {accumulated}')
+        return lines
+
+    def timed(self, coroutine_function):
+        """Decorator which observes execution time of the coroutine function.
+
+        """
+        @functools.wraps(coroutine_function)
+        async def wrapper(*args, **kwargs):
+            started = time.monotonic()
+            try:
+                return await coroutine_function(*args, **kwargs)
+            finally:
+                self.observe(time.monotonic() - started)
+        return wrapper
+
+
+class Metrics:
+    _instance = None
+
+    def __init__(self):
+        self._metrics = []
+
+    @classmethod
+    def get_instance(cls):
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance
+
+    def add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        lines.append('')
+        return '\n'.join(lines)
+
+
+_metrics = Metrics.get_instance()
+CHAT_MESSAGE_LATENCY = _metrics.add(Histogram(
+    'router_bot_chat_message_seconds',
+    'Time of handling of human\'s chat message.',
+    ))
+MATCH_PARTNER_LATENCY = _metrics.add(Histogram(
+    'router_bot_match_partner_seconds',
+    'Time of looking for partner.',
+    ))
+SEND_TO_PARTNER_LATENCY = _metrics.add(Histogram(
+    'router_bot_send_to_partner_seconds',
+    'Time of relaying of a message to the partner.',
+    ))
+SEND_LATENCY = _metrics.add(Histogram(
+    'router_bot_send_seconds',
+    'Time from enqueuing of a message to Telegram till its sending.',
+    ))
+COMMANDS = _metrics.add(Counter(
+    'router_bot_commands_total',
+    'Number of handled commands.',
+    labels=('command', ),
+    ))
+ERRORS = _metrics.add(Counter(
+    'router_bot_errors_total',
+    'Number of handled errors.',
+    labels=('type', ),
+    ))
+DB_QUERIES = _metrics.add(Counter(
+    'router_bot_db_queries_total',
+    'Number of executed DB queries.',
+    ))
+DB_QUERIES_TIME = _metrics.add(Counter(
+    'router_bot_db_queries_seconds_total',
+    'Total time of DB queries execution.',
+    ))
+
+
+def add_services_gauges(db=None):
+    """Adds gauges of services' state. Should be called after services are initialized.
+
+    Args:
+        db (Db): DB whose connections pool should be measured.
+
+    """
+    from .error import HumanSenderServiceError, TranscriptRecorderError
+    from .human_sender_service import HumanSenderService
+    from .reaper import Reaper
+    from .send_scheduler import SendScheduler
+    from .talk_service import TalkService
+    from .transcript_recorder import TranscriptRecorder
+    from .user_service import UserService
+
+    def get_caches_stats():
+        user_service = UserService.get_instance()
+        caches_stats = {
+            'users': user_service.get_cache_size(),
+            'concrete_users': user_service.get_concrete_users_cache_size(),
+            'humans': user_service.get_humans_cache_size(),
+            }
+        try:
+            caches_stats['human_senders'] = HumanSenderService.get_instance().get_cache_size()
+        except HumanSenderServiceError:
+            pass
+        return caches_stats
+
+    def get_caches_values(key):
+        return {(cache, ): stats[key] for cache, stats in get_caches_stats().items()}
+
+    _metrics.add(Gauge(
+        'router_bot_waiting_users',
+        'Number of users looking for partner.',
+        lambda: {(): UserService.get_instance().get_waiting_users_count()},
+        ))
+    _metrics.add(Gauge(
+        'router_bot_talks',
+        'Number of active talks.',
+        lambda: {(): TalkService.get_instance().get_talks_count()},
+        ))
+    _metrics.add(Gauge(
+        'router_bot_sending_queue_size',
+        'Number of messages waiting to be sent to Telegram.',
+        lambda: {(): SendScheduler.get_instance().get_queue_size()},
+        ))
+    _metrics.add(Gauge(
+        'router_bot_sending_jobs',
+        'Number of messages sent to Telegram, coalesced with others and retried after "Too Many Requests".',
+        lambda: {
+            ('sent', ): SendScheduler.get_instance().get_stats()['sent_count'],
+            ('coalesced', ): SendScheduler.get_instance().get_stats()['coalesced_count'],
+            ('retried', ): SendScheduler.get_instance().get_stats()['retries_count'],
+            },
+        labels=('kind', ),
+        ))
+    _metrics.add(Gauge(
+        'router_bot_reaped',
+        'Number of idle talks which were ended and idle searches which were stopped.',
+        lambda: {
+            ('talk', ): Reaper.get_instance().get_stats()['reaped_talks_count'],
+            ('search', ): Reaper.get_instance().get_stats()['reaped_users_count'],
+            },
+        labels=('kind', ),
+        ))
+    try:
+        transcript_recorder = TranscriptRecorder.get_instance()
+    except TranscriptRecorderError:
+        pass
+    else:
+        _metrics.add(Gauge(
+            'router_bot_transcripts_buffer_size',
+            'Number of transcripts\' records waiting to be written.',
+            lambda: {(): transcript_recorder.get_buffer_size()},
+            ))
+        _metrics.add(Gauge(
+            'router_bot_transcripts_dropped',
+            'Number of transcripts\' records dropped because they couldn\'t be written.',
+            lambda: {(): transcript_recorder.get_dropped_count()},
+            ))
+    if db is not None and db.is_pooled():
+        _metrics.add(Gauge(
+            'router_bot_db_pool_connections',
+            'Number of connections in the DB pool.',
+            lambda: {
+                ('idle', ): db.get_pool_stats()['idle_connections_count'],
+                ('used', ): db.get_pool_stats()['used_connections_count'],
+                },
+            labels=('state', ),
+            ))
+        _metrics.add(Gauge(
+            'router_bot_db_pool_checkouts',
+            'Number of connections checked out from the DB pool.',
+            lambda: {(): db.get_pool_stats()['checkouts_count']},
+            ))
+        _metrics.add(Gauge(
+            'router_bot_db_pool_checkout_seconds',
+            'Time of waiting for a connection from the DB pool.',
+            lambda: {
+                ('average', ): db.get_pool_stats()['checkouts_average_time'],
+                ('max', ): db.get_pool_stats()['checkouts_max_time'],
+                },
+            labels=('stat', ),
+            ))
+        _metrics.add(Gauge(
+            'router_bot_db_pool_timeouts',
+            'Number of timeouts of waiting for a connection from the DB pool.',
+            lambda: {(): db.get_pool_stats()['timeouts_count']},
+            ))
+    for key, description in (
+            ('size', 'Number of entries in the cache.'),
+            ('hits', 'Number of cache hits.'),
+            ('misses', 'Number of cache misses.'),
+            ('evictions', 'Number of entries evicted from the cache.'),
+            ):
+        _metrics.add(Gauge(
+            f'router_bot_cache_{key}',
+            description,
+            functools.partial(get_caches_values, key),
+            labels=('cache', ),
+            ))
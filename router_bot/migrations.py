@@ -0,0 +1,96 @@
+# router-bot
+# Copyright (C) 2017 quasiyoke
+#
+# You should have received a copy of the GNU Affero General Public License v3
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Migrations of the DB schema. Every migration is a function which takes `SchemaMigrator` and brings the schema from
+previous version to its version. `Db.install` creates the schema of the latest version, so
+every change of the models should be accompanied by the migration.
+
+"""
+
+import logging
+from .client_bot import ClientBot
+from .talk import ArchivedTalk, Talk
+from .talk_service import TalkService
+from .user import User
+from playhouse.migrate import migrate, MySQLMigrator
+
+LOGGER = logging.getLogger('router_bot.migrations')
+
+
+def _add_talks_partners_indexes(migrator):
+    # Talk of the user is looked for by either partner among not ended talks.
+    migrate(
+        migrator.add_index(Talk._meta.db_table, ('partner1_id', 'end'), False),
+        migrator.add_index(Talk._meta.db_table, ('partner2_id', 'end'), False),
+        )
+
+
+def _add_users_looking_for_partner_from_index(migrator):
+    # Waiting users are matched in order of waiting.
+    migrate(
+        migrator.add_index(User._meta.db_table, ('looking_for_partner_from', ), False),
+        )
+
+
+def _create_archived_talks(migrator):
+    ArchivedTalk.create_table()
+
+
+def _add_client_bots_capacity(migrator):
+    migrate(
+        migrator.add_column(ClientBot._meta.db_table, 'capacity', ClientBot.capacity),
+        )
+
+
+def _add_users_preferences(migrator):
+    migrate(
+        migrator.add_column(User._meta.db_table, 'languages_json', User.languages_json),
+        migrator.add_column(User._meta.db_table, 'sex', User.sex),
+        migrator.add_column(User._meta.db_table, 'partner_sex', User.partner_sex),
+        )
+
+
+def _add_talks_fractional_seconds(migrator):
+    # Durations of talks are calculated by the DB. SQLite keeps fractions of a second already.
+    if not isinstance(migrator, MySQLMigrator):
+        return
+    for model in (Talk, ArchivedTalk):
+        modifications = ', '.join(
+            f'MODIFY `{field.db_column}` DATETIME(6) {"NULL" if field.null else "NOT NULL"}'
+            for field in (model.searched_since, model.begin, model.end)
+            )
+        migrator.database.execute_sql(f'ALTER TABLE `{model._meta.db_table}` {modifications}')
+
+
+# Pairs `(version, migration)` in order of application.
+MIGRATIONS = (
+    (1, _add_talks_partners_indexes),
+    (2, _add_users_looking_for_partner_from_index),
+    (3, _create_archived_talks),
+    (4, _add_client_bots_capacity),
+    (5, _add_users_preferences),
+    (6, _add_talks_fractional_seconds),
+    )
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def get_hot_queries():
+    """
+    Returns:
+        Pairs `(title, query)` of the most frequent queries whose plans should use indexes.
+
+    """
+    return (
+        ('Talk of the user', Talk.select().where(((Talk.partner1 == 1) | (Talk.partner2 == 1)) & (Talk.end == None))),
+        ('Not ended talks', Talk.get_not_ended_talks()),
+        (
+            'Waiting users',
+            User.select()
+            .where((User.looking_for_partner_from != None) & (User.id != 1))
+            .order_by(User.looking_for_partner_from)
+            .limit(TalkService.CLAIM_CANDIDATES_COUNT),
+            ),
+        )
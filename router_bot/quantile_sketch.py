@@ -0,0 +1,109 @@
+# router-bot
+# Copyright (C) 2017 quasiyoke
+#
+# You should have received a copy of the GNU Affero General Public License v3
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import math
+
+LOGGER = logging.getLogger('router_bot.quantile_sketch')
+
+
+class QuantileSketch:
+    """Streaming sketch of non-negative values which estimates quantiles with bounded relative error.
+
+    Values are counted in logarithmic bins: bin `i` contains values from `gamma ** (i - 1)` to `gamma ** i`. So the
+    sketch takes little space, can be serialized to JSON and two sketches with the same accuracy can be merged by
+    summing their bins.
+
+    """
+    RELATIVE_ACCURACY = .01
+
+    def __init__(self, relative_accuracy=RELATIVE_ACCURACY):
+        self._relative_accuracy = relative_accuracy
+        self._gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self._gamma)
+        self._bins = {}
+        self._zero_count = 0
+        self._count = 0
+        self._sum = 0
+        self._min = None
+        self._max = None
+
+    def __len__(self):
+        return self._count
+
+    def add(self, value):
+        if value <= 0:
+            value = 0
+            self._zero_count += 1
+        else:
+            index = math.ceil(math.log(value) / self._log_gamma)
+            self._bins[index] = self._bins.get(index, 0) + 1
+        self._count += 1
+        self._sum += value
+        self._min = value if self._min is None else min(self._min, value)
+        self._max = value if self._max is None else max(self._max, value)
+
+    @classmethod
+    def from_dict(cls, data):
+        sketch = cls(relative_accuracy=data['relative_accuracy'])
+        sketch._bins = {int(index): count for index, count in data['bins'].items()}
+        sketch._zero_count = data['zero_count']
+        sketch._count = data['count']
+        sketch._sum = data['sum']
+        sketch._min = data['min']
+        sketch._max = data['max']
+        return sketch
+
+    def get_quantile(self, quantile):
+        """
+        Args:
+            quantile (float): Number from 0 to 1.
+
+        Returns:
+            Estimation of the value or `None` if the sketch is empty.
+
+        """
+        if not self._count:
+            return None
+        rank = quantile * (self._count - 1)
+        accumulated = self._zero_count
+        if accumulated > rank:
+            return 0
+        for index in sorted(self._bins):
+            accumulated += self._bins[index]
+            if accumulated > rank:
+                value = 2 * self._gamma ** index / (self._gamma + 1)
+                return min(max(value, self._min), self._max)
+        return self._max
+
+    def merge(self, other):
+        """Adds all values of other sketch to this one.
+
+        Raises:
+            ValueError if sketches have different accuracy.
+
+        """
+        if other._relative_accuracy != self._relative_accuracy:
+            raise ValueError('Can\'t merge sketches with different accuracy.')
+        for index, count in other._bins.items():
+            self._bins[index] = self._bins.get(index, 0) + count
+        self._zero_count += other._zero_count
+        self._count += other._count
+        self._sum += other._sum
+        if other._min is not None:
+            self._min = other._min if self._min is None else min(self._min, other._min)
+            self._max = other._max if self._max is None else max(self._max, other._max)
+
+    def to_dict(self):
+        return {
+            'relative_accuracy': self._relative_accuracy,
+            'bins': {str(index): count for index, count in self._bins.items()},
+            'zero_count': self._zero_count,
+            'count': self._count,
+            'sum': self._sum,
+            'min': self._min,
+            'max': self._max,
+            }
@@ -0,0 +1,160 @@
+# router-bot
+# Copyright (C) 2017 quasiyoke
+#
+# You should have received a copy of the GNU Affero General Public License v3
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import heapq
+import itertools
+import logging
+
+LOGGER = logging.getLogger('router_bot.reaper')
+
+
+class Reaper:
+    """Ends talks without messages for `talk_timeout` seconds and stops looking for partner for users who have done
+    nothing for `search_timeout` seconds.
+
+    Last activity of every talk and waiting user is kept in memory. Every one of them has single entry in the heap of
+    deadlines. When the deadline comes and there was some activity meanwhile, the entry is moved to the actual deadline,
+    so activity itself costs only an update of the timestamp and the DB is never scanned.
+
+    """
+    _instance = None
+
+    def __init__(self, talk_timeout=None, search_timeout=None):
+        """
+        Args:
+            talk_timeout (float): Seconds without messages after which the talk is ended. `None` disables ending of
+                talks.
+            search_timeout (float): Seconds of inactivity after which the user stops looking for partner. `None`
+                disables stopping of looking for partner.
+
+        """
+        self._loop = asyncio.get_event_loop()
+        self._talk_timeout = talk_timeout
+        self._search_timeout = search_timeout
+        # Heap of entries `(deadline, seq, kind, ID)` where kind is "talk" or "user".
+        self._deadlines = []
+        self._seq = itertools.count()
+        # Maps talk ID to the list `[last activity, talk]`.
+        self._talks = {}
+        # Maps user ID to the list `[last activity, user, looking_for_partner_from]`.
+        self._users = {}
+        self._wakeup = asyncio.Event()
+        self._reaped_talks_count = 0
+        self._reaped_users_count = 0
+        type(self)._instance = self
+
+    @classmethod
+    def get_instance(cls):
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance
+
+    def add_talk(self, talk):
+        """Starts tracking of the talk which has just begun or was loaded.
+
+        """
+        if self._talk_timeout is None or talk.id in self._talks:
+            return
+        now = self._loop.time()
+        self._talks[talk.id] = [now, talk]
+        self._push(now + self._talk_timeout, 'talk', talk.id)
+
+    def add_waiting_user(self, user):
+        """Starts tracking of the user who is looking for partner. Beginning of new search is activity.
+
+        """
+        if self._search_timeout is None:
+            return
+        now = self._loop.time()
+        activity = self._users.get(user.id)
+        if activity is None:
+            self._users[user.id] = [now, user, user.looking_for_partner_from]
+            self._push(now + self._search_timeout, 'user', user.id)
+        elif activity[2] != user.looking_for_partner_from:
+            activity[0] = now
+            activity[2] = user.looking_for_partner_from
+
+    def get_stats(self):
+        return {
+            'talks_count': len(self._talks),
+            'users_count': len(self._users),
+            'reaped_talks_count': self._reaped_talks_count,
+            'reaped_users_count': self._reaped_users_count,
+            }
+
+    def touch_talk(self, talk):
+        activity = self._talks.get(talk.id)
+        if activity is not None:
+            activity[0] = self._loop.time()
+
+    def touch_user(self, user_id):
+        activity = self._users.get(user_id)
+        if activity is not None:
+            activity[0] = self._loop.time()
+
+    async def run(self):
+        while True:
+            now = self._loop.time()
+            while self._deadlines and self._deadlines[0][0] <= now:
+                deadline, seq, kind, entity_id = heapq.heappop(self._deadlines)
+                try:
+                    if kind == 'talk':
+                        await self._reap_talk(entity_id, now)
+                    else:
+                        await self._reap_user(entity_id, now)
+                except Exception as err:
+                    LOGGER.error('Can\'t reap %s %d: %s', kind, entity_id, err)
+            self._wakeup.clear()
+            timeout = self._deadlines[0][0] - self._loop.time() if self._deadlines else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def _push(self, deadline, kind, entity_id):
+        entry = (deadline, next(self._seq), kind, entity_id)
+        heapq.heappush(self._deadlines, entry)
+        if self._deadlines[0] is entry:
+            # The reaper could sleep till later deadline.
+            self._wakeup.set()
+
+    async def _reap_talk(self, talk_id, now):
+        from .talk_service import TalkService
+        last_activity, talk = self._talks[talk_id]
+        current_talk = TalkService.get_instance().get_talk(talk.partner1, talk.partner2)
+        if current_talk is None or current_talk.id != talk_id:
+            # The talk has ended already.
+            del self._talks[talk_id]
+            return
+        deadline = last_activity + self._talk_timeout
+        if deadline > now:
+            self._push(deadline, 'talk', talk_id)
+            return
+        del self._talks[talk_id]
+        LOGGER.info('Talk %d is idle, ending it', talk_id)
+        self._reaped_talks_count += 1
+        # Client bot can have several talks, so the talk is ended by the partner for whom this talk is the only one.
+        for user in (talk.partner1, talk.partner2):
+            user_talk = user.get_talk()
+            if user_talk is not None and user_talk.id == talk_id:
+                await user.end_talk()
+                break
+
+    async def _reap_user(self, user_id, now):
+        last_activity, user, looking_for_partner_from = self._users[user_id]
+        if user.looking_for_partner_from is None or user.get_talk() is not None:
+            # The user has stopped looking for partner already.
+            del self._users[user_id]
+            return
+        deadline = last_activity + self._search_timeout
+        if deadline > now:
+            self._push(deadline, 'user', user_id)
+            return
+        del self._users[user_id]
+        LOGGER.info('User %d is waiting idly, stopping looking for partner', user_id)
+        self._reaped_users_count += 1
+        await user.end_talk()
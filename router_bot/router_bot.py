@@ -9,17 +9,29 @@
 """
 
 import asyncio
+import datetime
+import json
 import logging
 import logging.config
 import sys
+from .archive_service import ArchiveService
 from .bot import Bot
 from .client_bot_service import ClientBotService
 from .configuration import Configuration
 from .db import Db
-from .error import ConfigurationObtainingError, DbError
+from .db_executor import DbExecutor
+from .error import ConfigurationObtainingError, DbError, TranscriptRecorderError
 from .human_sender_service import HumanSenderService
+from .logging_pipeline import enqueue_handlers
+from .metrics import add_services_gauges
+from .reaper import Reaper
+from .send_scheduler import SendScheduler
 from .server import Server
-from .stats_service import StatsService
+from .stats_service import SKETCHED_VALUES, StatsService
+from .talk_service import TalkService
+from .talks_exporter import FORMATS, TalksExporter
+from .transcript_recorder import TranscriptReader, TranscriptRecorder
+from .user_service import UserService
 from .util import __version__
 from docopt import docopt
 from router_bot import user, user_service
@@ -30,28 +42,59 @@ DOC = '''router-bot
 Usage:
   router_bot CONFIGURATION
   router_bot install CONFIGURATION
+  router_bot migrate [--check] CONFIGURATION
+  router_bot export [--format=FORMAT] [--after=DATETIME] [--before=DATETIME] [--archived] [--output=PATH]
+                    CONFIGURATION
+  router_bot transcript TALK_ID CONFIGURATION
+  router_bot percentiles [--after=DATETIME] [--before=DATETIME] CONFIGURATION
   router_bot -h | --help | --version
 
 Arguments:
   CONFIGURATION  Path to configuration.json file.
+  TALK_ID        ID of the talk whose transcript should be printed.
+
+Options:
+  --check              Print schema version and plans of the hot queries instead of migrating.
+  --format=FORMAT      Format of exported talks: jsonl or csv [default: jsonl].
+  --after=DATETIME     Export talks which began at this UTC moment or later, e.g. 2017-10-01 or 2017-10-01T12:00:00.
+                       For percentiles: use stats created later than this UTC moment.
+  --before=DATETIME    Export talks which began earlier than this UTC moment. For percentiles: use stats created at
+                       this UTC moment or earlier.
+  --archived           Export archived talks too.
+  --output=PATH        File to export talks to instead of standard output.
 '''
+DATETIME_FORMATS = ('%Y-%m-%d', '%Y-%m-%dT%H:%M:%S')
 LOGGER = logging.getLogger('router_bot.router_bot')
 
 
 def main():
-    logging.basicConfig(level=logging.DEBUG)
     arguments = docopt(DOC, version=__version__)
 
+    # Reports problems with configuration until handlers from the configuration take place.
+    early_handler = logging.StreamHandler()
+    early_handler.setLevel(logging.WARNING)
+    logging.getLogger().addHandler(early_handler)
     try:
         configuration = Configuration(arguments['CONFIGURATION'])
     except ConfigurationObtainingError as err:
         sys.exit(f'Can\'t obtain configuration. {err}')
+    finally:
+        logging.getLogger().removeHandler(early_handler)
 
     logging.config.dictConfig(configuration.logging)
+    if configuration.logging_queue_enabled:
+        logging_listeners = enqueue_handlers(
+            sample_rate=configuration.logging_sample_rate,
+            sampled_loggers=configuration.logging_sampled_loggers,
+            )
+    else:
+        logging_listeners = []
 
     try:
         db = Db(configuration)
     except DbError as err:
+        for listener in logging_listeners:
+            listener.stop()
         sys.exit(f'Can\'t construct DB. {err}')
 
     try:
@@ -61,27 +104,164 @@ def main():
                 db.install()
             except DbError as err:
                 sys.exit(f'Can\'t install databases. {err}')
+        elif arguments['migrate'] and arguments['--check']:
+            try:
+                print_schema_check(db)
+            except DbError as err:
+                sys.exit(f'Can\'t check databases. {err}')
+        elif arguments['transcript']:
+            print_transcript(configuration, arguments['TALK_ID'])
+        elif arguments['percentiles']:
+            try:
+                print_percentiles(arguments)
+            except DbError as err:
+                sys.exit(f'Can\'t obtain percentiles. {err}')
+        elif arguments['export']:
+            try:
+                export_talks(arguments)
+            except DbError as err:
+                sys.exit(f'Can\'t export talks. {err}')
+        elif arguments['migrate']:
+            LOGGER.info('Migrating router-bot')
+            try:
+                applied_versions = db.migrate()
+            except DbError as err:
+                sys.exit(f'Can\'t migrate databases. {err}')
+            LOGGER.info('Applied migrations: %s', applied_versions or 'none')
         else:
             LOGGER.info('Executing router-bot')
             loop = asyncio.get_event_loop()
+            DbExecutor(
+                max_workers=configuration.database_executor_workers,
+                release_connection=db.release_connection,
+                )
+
+            # Reaper should track waiting users and talks which are loaded at start.
+            reaper = Reaper(
+                talk_timeout=configuration.idle_talk_timeout,
+                search_timeout=configuration.idle_search_timeout,
+                )
+            asyncio.ensure_future(reaper.run())
+
+            UserService(matching_mode=configuration.matching_mode)
+
+            if configuration.transcripts_directory is not None:
+                transcript_recorder = TranscriptRecorder(
+                    configuration.transcripts_directory,
+                    buffer_size=configuration.transcripts_buffer_size,
+                    flush_interval=configuration.transcripts_flush_interval,
+                    segment_size=configuration.transcripts_segment_size,
+                    fsync=configuration.transcripts_fsync,
+                    )
+                asyncio.ensure_future(transcript_recorder.run())
+
+            # Load not ended talks before any message will be handled.
+            talk_service = TalkService.get_instance(configuration)
+            asyncio.ensure_future(talk_service.run())
+
+            send_scheduler = SendScheduler(
+                global_rate=configuration.sending_global_rate,
+                chat_rate=configuration.sending_chat_rate,
+                chat_burst=configuration.sending_chat_burst,
+                )
+            asyncio.ensure_future(send_scheduler.run())
 
             bot = Bot(configuration)
             asyncio.ensure_future(bot.run())
 
-            stats_service = StatsService.get_instance()
+            stats_service = StatsService(incremental=configuration.stats_incremental)
             asyncio.ensure_future(stats_service.run())
 
+            if configuration.archive_age is not None:
+                archive_service = ArchiveService(
+                    configuration.archive_age,
+                    interval=configuration.archive_interval,
+                    batch_size=configuration.archive_batch_size,
+                    )
+                asyncio.ensure_future(archive_service.run())
+
             update_service = SimpleUpdateService()
             bot_service = ClientBotService(update_service=update_service)
             server = Server(
+                bot=bot,
                 bot_service=bot_service,
                 configuration=configuration.server,
                 update_service=update_service,
                 )
 
+            add_services_gauges(db)
+
             try:
                 loop.run_forever()
             except KeyboardInterrupt:
                 LOGGER.info('Execution was finished by keyboard interrupt')
     finally:
+        # Wait for DB operations which are still in progress.
+        DbExecutor.get_instance().shutdown()
         db.flush()
+        try:
+            TranscriptRecorder.get_instance().close()
+        except TranscriptRecorderError:
+            # Transcripts weren't recorded.
+            pass
+        # Write the rest of log records.
+        for listener in logging_listeners:
+            listener.stop()
+
+
+def print_schema_check(db):
+    current_version, latest_version = db.get_schema_version()
+    print(f'Schema version: {current_version}, latest: {latest_version}')
+    for title, sql, plan in db.get_query_plans():
+        print(f'\n{title}:\n  {sql}')
+        for row in plan:
+            print('  ' + ', '.join(f'{column}={value}' for column, value in row.items()))
+
+
+def export_talks(arguments):
+    if arguments['--format'] not in FORMATS:
+        sys.exit(f'Format should be one of: {", ".join(FORMATS)}')
+    exporter = TalksExporter(
+        after=parse_datetime(arguments['--after']),
+        before=parse_datetime(arguments['--before']),
+        archived=arguments['--archived'],
+        )
+    if arguments['--output'] is None:
+        count = exporter.export(sys.stdout, arguments['--format'])
+    else:
+        with open(arguments['--output'], 'w', encoding='utf-8', newline='') as f:
+            count = exporter.export(f, arguments['--format'])
+    LOGGER.info('%d talks were exported', count)
+
+
+def print_transcript(configuration, talk_id):
+    if configuration.transcripts_directory is None:
+        sys.exit('Transcripts aren\'t configured')
+    try:
+        talk_id = int(talk_id)
+    except ValueError:
+        sys.exit(f'Wrong talk ID \"{talk_id}\"')
+    for record in TranscriptReader(configuration.transcripts_directory).get_transcript(talk_id):
+        print(json.dumps(record, ensure_ascii=False))
+
+
+def print_percentiles(arguments):
+    """Prints p50, p95 and p99 of waiting time, talk duration and messages per talk for the period. Percentiles are
+    obtained by merging sketches of saved stats, so talks aren't read.
+
+    """
+    after = parse_datetime(arguments['--after'])
+    before = parse_datetime(arguments['--before'])
+    percentiles = {name: StatsService.get_percentiles(name, after=after, before=before) for name in SKETCHED_VALUES}
+    print(json.dumps(percentiles, indent=4, sort_keys=True))
+
+
+def parse_datetime(value):
+    if value is None:
+        return None
+    for datetime_format in DATETIME_FORMATS:
+        try:
+            return datetime.datetime.strptime(value, datetime_format)
+        except ValueError:
+            pass
+    sys.exit(f'Can\'t parse datetime "{value}"')
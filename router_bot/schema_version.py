@@ -0,0 +1,32 @@
+# router-bot
+# Copyright (C) 2017 quasiyoke
+#
+# You should have received a copy of the GNU Affero General Public License v3
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import datetime
+import logging
+from peewee import DateTimeField, fn, IntegerField, Model, Proxy
+
+LOGGER = logging.getLogger('router_bot.schema_version')
+database_proxy = Proxy()
+
+
+class SchemaVersion(Model):
+    """Applied migration of the DB schema.
+
+    """
+    version = IntegerField(primary_key=True)
+    applied = DateTimeField(default=datetime.datetime.utcnow)
+
+    class Meta:
+        database = database_proxy
+
+    @classmethod
+    def get_current(cls):
+        """
+        Returns:
+            Version of the latest applied migration or 0 if no migrations were applied.
+
+        """
+        return cls.select(fn.MAX(cls.version)).scalar() or 0
@@ -0,0 +1,282 @@
+# router-bot
+# Copyright (C) 2017 quasiyoke
+#
+# You should have received a copy of the GNU Affero General Public License v3
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import collections
+import heapq
+import itertools
+import logging
+from .metrics import SEND_LATENCY
+from telepot.exception import TooManyRequestsError
+
+LOGGER = logging.getLogger('router_bot.send_scheduler')
+PRIORITY_MESSAGE = 0
+PRIORITY_NOTIFICATION = 1
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity, now):
+        self._rate = rate
+        self._capacity = capacity
+        self._tokens = capacity
+        self._updated = now
+        self._paused_until = now
+
+    def consume(self, now):
+        self._refill(now)
+        self._tokens -= 1
+
+    def get_delay(self, now):
+        """
+        Returns:
+            Seconds to wait for a token.
+
+        """
+        if now < self._paused_until:
+            return self._paused_until - now
+        self._refill(now)
+        return 0 if self._tokens >= 1 else (1 - self._tokens) / self._rate
+
+    def is_full(self, now):
+        self._refill(now)
+        return self._tokens >= self._capacity and now >= self._paused_until
+
+    def pause(self, until):
+        self._paused_until = max(self._paused_until, until)
+
+    def _refill(self, now):
+        if now > self._updated:
+            self._tokens = min(self._capacity, self._tokens + (now - self._updated) * self._rate)
+            self._updated = now
+
+
+class _Job:
+    __slots__ = ('priority', 'seq', 'method', 'kwargs', 'futures', 'enqueued', 'is_coalescible')
+
+    def __init__(self, priority, seq, method, kwargs, future, enqueued, is_coalescible):
+        self.priority = priority
+        self.seq = seq
+        self.method = method
+        self.kwargs = kwargs
+        self.futures = [future]
+        self.enqueued = enqueued
+        self.is_coalescible = is_coalescible
+
+
+class _Chat:
+    __slots__ = ('id', 'bucket', 'jobs', 'is_scheduled', 'is_sending')
+
+    def __init__(self, chat_id, bucket):
+        self.id = chat_id
+        self.bucket = bucket
+        self.jobs = collections.deque()
+        self.is_scheduled = False
+        self.is_sending = False
+
+
+class SendScheduler:
+    """Sends messages to Telegram respecting global and per-chat rate limits.
+
+    Every chat has its own FIFO queue of jobs. Chats which are allowed to send are picked by priority of their first
+    job, so partner's messages go before notifications. Notifications waiting in the same chat's queue are coalesced
+    into one message. When Telegram answers "Too Many Requests", sending is paused for `retry_after` seconds and the job
+    is retried.
+
+    """
+    COALESCING_SEPARATOR = '\n\n'
+    IDLE_CHATS_CLEANUP_INTERVAL = 60
+    MAX_TEXT_LENGTH = 4096
+    _instance = None
+
+    def __init__(self, global_rate=30, chat_rate=1, chat_burst=1):
+        """
+        Args:
+            global_rate (float): Messages per second for the whole bot.
+            chat_rate (float): Messages per second for one chat.
+            chat_burst (int): Number of messages which can be sent to one chat without waiting.
+
+        """
+        self._loop = asyncio.get_event_loop()
+        now = self._loop.time()
+        self._global_bucket = TokenBucket(global_rate, global_rate, now)
+        self._chat_rate = chat_rate
+        self._chat_burst = chat_burst
+        self._chats = {}
+        self._ready = []
+        self._delayed = []
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._idle_chats_cleaned = now
+        self._jobs_count = 0
+        self._sent_count = 0
+        self._coalesced_count = 0
+        self._retries_count = 0
+        type(self)._instance = self
+
+    @classmethod
+    def get_instance(cls):
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance
+
+    def get_queue_size(self):
+        return self._jobs_count
+
+    def get_stats(self):
+        return {
+            'queue_size': self._jobs_count,
+            'sent_count': self._sent_count,
+            'coalesced_count': self._coalesced_count,
+            'retries_count': self._retries_count,
+            }
+
+    async def run(self):
+        while True:
+            now = self._loop.time()
+            while self._delayed and self._delayed[0][0] <= now:
+                when, seq, chat_id = heapq.heappop(self._delayed)
+                self._push_ready(self._chats[chat_id])
+            if now - self._idle_chats_cleaned >= type(self).IDLE_CHATS_CLEANUP_INTERVAL:
+                self._clean_idle_chats(now)
+            if not self._ready:
+                self._wakeup.clear()
+                timeout = self._delayed[0][0] - now if self._delayed else None
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            delay = self._global_bucket.get_delay(now)
+            if delay:
+                await asyncio.sleep(delay)
+                continue
+            priority, seq, chat_id = heapq.heappop(self._ready)
+            chat = self._chats[chat_id]
+            chat.is_scheduled = False
+            if chat.bucket.get_delay(now):
+                # Chat's sending was paused after the chat had become ready.
+                self._schedule(chat)
+                continue
+            job = chat.jobs.popleft()
+            self._jobs_count -= 1
+            if all(future.done() for future in job.futures):
+                # Everybody who was waiting for the job has gone.
+                self._schedule(chat)
+                continue
+            self._global_bucket.consume(now)
+            chat.bucket.consume(now)
+            chat.is_sending = True
+            asyncio.ensure_future(self._send(chat, job))
+
+    async def send(self, chat_id, method, kwargs, priority=PRIORITY_NOTIFICATION):
+        """Enqueues calling of `method(**kwargs)` and waits for its result.
+
+        Args:
+            chat_id (int): ID of the chat where the message will be sent.
+            method (coroutine function): Telegram API method.
+            kwargs (dict): Method's arguments.
+            priority (int): `PRIORITY_MESSAGE` or `PRIORITY_NOTIFICATION`.
+
+        Raises:
+            TelegramError
+
+        """
+        future = self._loop.create_future()
+        chat = self._get_chat(chat_id)
+        is_coalescible = priority == PRIORITY_NOTIFICATION and kwargs.get('reply_markup') is None
+        if not (is_coalescible and self._coalesce(chat, kwargs, future)):
+            job = _Job(priority, next(self._seq), method, kwargs, future, self._loop.time(), is_coalescible)
+            chat.jobs.append(job)
+            self._jobs_count += 1
+            self._schedule(chat)
+        return await future
+
+    def _clean_idle_chats(self, now):
+        idle_chats_ids = [
+            chat.id
+            for chat in self._chats.values()
+            if not chat.jobs and not chat.is_sending and chat.bucket.is_full(now)
+            ]
+        for chat_id in idle_chats_ids:
+            del self._chats[chat_id]
+        self._idle_chats_cleaned = now
+
+    def _coalesce(self, chat, kwargs, future):
+        """Tries to append notification's text to the last job in the chat's queue.
+
+        Returns:
+            `True` if notification was coalesced.
+
+        """
+        if not chat.jobs:
+            return False
+        job = chat.jobs[-1]
+        if not job.is_coalescible:
+            return False
+        text = job.kwargs['text'] + type(self).COALESCING_SEPARATOR + kwargs['text']
+        if len(text) > type(self).MAX_TEXT_LENGTH:
+            return False
+        for key, value in kwargs.items():
+            if key != 'text' and job.kwargs.get(key) != value:
+                return False
+        job.kwargs['text'] = text
+        job.futures.append(future)
+        self._coalesced_count += 1
+        return True
+
+    def _get_chat(self, chat_id):
+        try:
+            return self._chats[chat_id]
+        except KeyError:
+            chat = _Chat(chat_id, TokenBucket(self._chat_rate, self._chat_burst, self._loop.time()))
+            self._chats[chat_id] = chat
+            return chat
+
+    def _push_ready(self, chat):
+        job = chat.jobs[0]
+        heapq.heappush(self._ready, (job.priority, job.seq, chat.id))
+        self._wakeup.set()
+
+    def _schedule(self, chat):
+        if chat.is_scheduled or chat.is_sending or not chat.jobs:
+            return
+        chat.is_scheduled = True
+        now = self._loop.time()
+        delay = chat.bucket.get_delay(now)
+        if delay:
+            heapq.heappush(self._delayed, (now + delay, next(self._seq), chat.id))
+            self._wakeup.set()
+        else:
+            self._push_ready(chat)
+
+    async def _send(self, chat, job):
+        try:
+            result = await job.method(**job.kwargs)
+        except TooManyRequestsError as err:
+            try:
+                retry_after = err.json['parameters']['retry_after']
+            except (KeyError, TypeError):
+                retry_after = 1
+            LOGGER.warning('Too many requests. Sending to %d will be retried after %s s', chat.id, retry_after)
+            until = self._loop.time() + retry_after
+            self._global_bucket.pause(until)
+            chat.bucket.pause(until)
+            chat.jobs.appendleft(job)
+            self._jobs_count += 1
+            self._retries_count += 1
+        except Exception as err:
+            for future in job.futures:
+                if not future.done():
+                    future.set_exception(err)
+        else:
+            self._sent_count += 1
+            SEND_LATENCY.observe(self._loop.time() - job.enqueued)
+            for future in job.futures:
+                if not future.done():
+                    future.set_result(result)
+        finally:
+            chat.is_sending = False
+            self._schedule(chat)
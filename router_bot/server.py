@@ -4,27 +4,141 @@
 # You should have received a copy of the GNU Affero General Public License v3
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import aiohttp.web
+import asyncio
+import hmac
 import logging
+from .bot import Bot
+from .error import DbError, MissingPartnerError, UnsupportedContentError, UserError
+from .logging_pipeline import SAMPLED
+from .message import Message
+from .metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, Metrics
 from telegram_bot_server import Response
+from telepot.exception import TelegramError
 from telegram_bot_server import Server as BaseServer
 
 LOGGER = logging.getLogger('router_bot.server')
 
 
 class Server(BaseServer):
-    async def _handle_send_message(self, request):
+    # Maximal number of messages which are being delivered to client bots simultaneously.
+    SENDING_CONCURRENCY = 16
+    # Seconds to wait for delivery to one bot.
+    SENDING_TIMEOUT = 10
+
+    def __init__(self, *args, bot=None, **kwargs):
+        """
+        Args:
+            bot (Bot): Bot which receives Telegram updates from the webhook, if it's enabled.
+
         """
+        super(Server, self).__init__(*args, **kwargs)
+        self._sending_semaphore = asyncio.Semaphore(type(self).SENDING_CONCURRENCY)
+        self._bot = bot
+        # Base server keeps its aiohttp application in `_app`.
+        self._app.router.add_route('GET', '/metrics', self._handle_metrics)
+        if bot is not None and bot.is_webhook_enabled():
+            self._app.router.add_route('POST', Bot.WEBHOOK_PATH, self._handle_telegram_update)
+
+    async def _handle_metrics(self, request):
+        return aiohttp.web.Response(
+            body=Metrics.get_instance().render().encode('utf-8'),
+            headers={'Content-Type': METRICS_CONTENT_TYPE},
+            )
+
+    async def _handle_send_message(self, request):
+        """Delivers the message to the bot's partner if `chat_id` is the private chat of a human. Otherwise delivers
+        the message to all other bots concurrently. Failure or slowness of one bot doesn't affect others.
+
         Raises:
             aiohttp.web.HTTPException
 
         """
-        LOGGER.info('"sendMessage" method. Bot ID %s. Text: "%s".', request.bot.id, request.data['text'])
-        for bot in await self._bot_service.get_all_bots():
-            if bot == request.bot:
-                continue
-            await bot.send_message(
-                chat=request.bot.chat_dict,
-                from_dict=request.bot.user_dict,
-                text=request.data['text'],
-                )
+        LOGGER.info(
+            '"sendMessage" method. Bot ID %s. Text: "%s".',
+            request.bot.id,
+            request.data['text'],
+            extra=SAMPLED,
+            )
+        chat_id = request.data.get('chat_id')
+        if chat_id is not None and await self._send_message_to_partner(request, chat_id):
+            return Response()
+        bots = [bot for bot in await self._bot_service.get_all_bots() if bot != request.bot]
+        results = await asyncio.gather(
+            *(self._send_message(bot, request) for bot in bots),
+            return_exceptions=True
+            )
+        for bot, result in zip(bots, results):
+            if isinstance(result, asyncio.TimeoutError):
+                LOGGER.warning('Sending message to bot %s has timed out', bot.id)
+            elif isinstance(result, Exception):
+                LOGGER.warning('Can\'t send message to bot %s: %s', bot.id, result)
         return Response()
+
+    async def _send_message_to_partner(self, request, chat_id):
+        """
+        Returns:
+            `True` if `chat_id` is the private chat of a human, so the message shouldn't be delivered to other bots.
+
+        Raises:
+            aiohttp.web.HTTPBadRequest if the message can't be delivered.
+
+        """
+        from .human import Human
+        from .user_service import UserService
+        user_service = UserService.get_instance()
+        try:
+            telegram_id = int(chat_id)
+        except (TypeError, ValueError):
+            return False
+        try:
+            human = await Human.get_human(telegram_id)
+        except DbError:
+            return False
+        bot_user = user_service.get_cached_user(request.bot.user)
+        partner = human.user
+        try:
+            message = Message({
+                'chat': {'id': telegram_id, 'type': 'private'},
+                'text': request.data['text'],
+                })
+            await bot_user.send_to_partner(message, partner=partner)
+        except MissingPartnerError:
+            # The talk has ended already.
+            LOGGER.info('Bot %s isn\'t talking with user %d now', request.bot.id, partner.id, extra=SAMPLED)
+            return True
+        except (TelegramError, UnsupportedContentError, UserError) as err:
+            LOGGER.warning('Can\'t send message of bot %s to user %d: %s', request.bot.id, partner.id, err)
+            raise aiohttp.web.HTTPBadRequest()
+        return True
+
+    async def _send_message(self, bot, request):
+        async with self._sending_semaphore:
+            await asyncio.wait_for(
+                bot.send_message(
+                    chat=request.bot.chat_dict,
+                    from_dict=request.bot.user_dict,
+                    text=request.data['text'],
+                    ),
+                type(self).SENDING_TIMEOUT,
+                )
+
+    async def _handle_telegram_update(self, request):
+        """Handles Telegram's webhook request. Secret part of the path prevents forging of updates.
+
+        Raises:
+            aiohttp.web.HTTPException
+
+        """
+        secret = request.match_info['secret'].encode('utf-8')
+        if not hmac.compare_digest(secret, self._bot.get_webhook_secret().encode('utf-8')):
+            LOGGER.warning('Webhook request with wrong secret')
+            raise aiohttp.web.HTTPNotFound()
+        try:
+            update = await request.json()
+            update['update_id']
+        except (KeyError, TypeError, ValueError) as err:
+            LOGGER.warning('Malformed webhook update: %s', err)
+            raise aiohttp.web.HTTPBadRequest()
+        self._bot.feed_update(update)
+        return aiohttp.web.Response()
@@ -7,6 +7,7 @@
 import datetime
 import json
 import logging
+from .quantile_sketch import QuantileSketch
 from peewee import *
 
 LOGGER = logging.getLogger('router_bot.stats')
@@ -28,6 +29,18 @@ class Stats(Model):
             self._data_cache = json.loads(self.data_json)
             return self._data_cache
 
+    def get_sketch(self, name):
+        """
+        Returns:
+            QuantileSketch of the value or `None` if the stats were saved without sketches.
+
+        """
+        try:
+            sketch_dict = self.get_data()[name]['sketch']
+        except KeyError:
+            return None
+        return QuantileSketch.from_dict(sketch_dict)
+
     def set_data(self, data):
         self._data_cache = data
         self.data_json = json.dumps(data)
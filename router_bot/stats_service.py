@@ -7,60 +7,122 @@
 import asyncio
 import datetime
 import logging
-from .error import HumanSenderServiceError
+from .db_executor import DbExecutor
+from .error import DbError, HumanSenderServiceError
+from .quantile_sketch import QuantileSketch
 from .stats import Stats
-from peewee import DoesNotExist
+from peewee import DatabaseError, DoesNotExist, fn, SqliteDatabase, SQL
+from playhouse.shortcuts import case
 
 COUNT_INTERVALS = (4, 16, 64, 256)
+PERCENTILES = (50, 95, 99)
+SKETCHED_VALUES = ('talks_duration', 'talks_sent', 'talks_waiting')
 LOGGER = logging.getLogger('router_bot.stats_service')
 
 
-def get_talks_stats(talks, get_value, intervals):
-    distribution = {interval: 0 for interval in intervals}
-    distribution['more'] = 0
-    average = 0
+def get_seconds_between(start, end):
+    """
+    Returns:
+        Expression which calculates number of seconds between two datetime fields in the DB including fractions of
+        a second.
+
+    """
+    if isinstance(Stats._meta.database.obj, SqliteDatabase):
+        return (fn.julianday(end) - fn.julianday(start)) * 86400
+    return fn.TIMESTAMPDIFF(SQL('MICROSECOND'), start, end) / 1e6
+
+
+def get_talks_stats(talks, value, intervals):
+    """Calculates distribution, average and count of talks' values by the DB itself using `GROUP BY` over the bucket
+    of the value.
+
+    Args:
+        talks (SelectQuery): Talks to aggregate.
+        value (Node): Expression for talk's value.
+        intervals (tuple): Ascending upper bounds of distribution's intervals.
+
+    """
+    bucket = case(None, [(value <= interval, i) for i, interval in enumerate(intervals)], len(intervals))
+    rows = talks \
+        .select(bucket.alias('bucket'), fn.COUNT(SQL('*')), fn.SUM(value)) \
+        .group_by(SQL('bucket')) \
+        .tuples()
+    keys = tuple(intervals) + ('more', )
+    distribution = {key: 0 for key in keys}
+    values_sum = 0
     count = 0
-    for talk in talks:
-        value = get_value(talk)
-        increment_distribution(distribution, value, intervals)
-        average += value
-        count += 1
-    try:
-        average /= count
-    except ZeroDivisionError:
-        pass
+    for bucket_index, bucket_count, bucket_sum in rows:
+        distribution[keys[int(bucket_index)]] = bucket_count
+        values_sum += float(bucket_sum or 0)
+        count += bucket_count
     return {
         'distribution': distribution,
-        'average': average,
+        'average': values_sum / count if count else 0,
         'count': count,
         }
 
 
-def increment(d, key):
-    try:
-        d[key] += 1
-    except KeyError:
-        d[key] = 1
+def merge_talks_stats(talks_stats_list):
+    """Merges results of `get_talks_stats` with the same intervals, e.g. for talks and archived talks.
 
+    """
+    distribution = {}
+    values_sum = 0
+    count = 0
+    for talks_stats in talks_stats_list:
+        for key, bucket_count in talks_stats['distribution'].items():
+            distribution[key] = distribution.get(key, 0) + bucket_count
+        values_sum += talks_stats['average'] * talks_stats['count']
+        count += talks_stats['count']
+    return {
+        'distribution': distribution,
+        'average': values_sum / count if count else 0,
+        'count': count,
+        }
+
+
+def get_percentiles(sketch):
+    return {str(percentile): sketch.get_quantile(percentile / 100) for percentile in PERCENTILES}
 
-def increment_distribution(d, value, intervals):
-    for interval in intervals:
-        if value <= interval:
-            break
-    else:
-        interval = 'more'
-    d[interval] += 1
+
+def merge_sketches(stats_list, name):
+    """Merges sketches of some value from several stats, e.g. to obtain percentiles for a day from hourly stats.
+
+    Args:
+        stats_list (iterable): Stats to merge. Stats without sketches are skipped.
+        name (str): One of `SKETCHED_VALUES`.
+
+    Returns:
+        QuantileSketch
+
+    """
+    sketch = QuantileSketch()
+    for stats in stats_list:
+        stats_sketch = stats.get_sketch(name)
+        if stats_sketch is not None:
+            sketch.merge(stats_sketch)
+    return sketch
 
 
 class StatsService:
     INTERVAL = datetime.timedelta(hours=1)
 
-    def __init__(self):
+    def __init__(self, incremental=False):
+        """
+        Args:
+            incremental (bool): Affects only the first aggregation, when there're no stats yet: aggregate talks only
+                for the last `INTERVAL` instead of the whole history. Every next aggregation takes talks since previous
+                stats anyway.
+
+        """
+        self._incremental = incremental
+        self._sketches = self._create_sketches()
         try:
             self._stats = Stats.select().order_by(Stats.created.desc()).get()
         except DoesNotExist:
             self._stats = None
-            self._update_stats()
+            self._stats = self._update_stats()
+        type(self)._instance = self
 
     @classmethod
     def get_instance(cls):
@@ -71,6 +133,36 @@ class StatsService:
             cls._instance = instance
         return instance
 
+    def add_talk_began(self, talk):
+        self._sketches['talks_waiting'].add((talk.begin - talk.searched_since).total_seconds())
+
+    def add_talk_ended(self, talk):
+        self._sketches['talks_duration'].add((talk.end - talk.begin).total_seconds())
+        self._sketches['talks_sent'].add(talk.partner1_sent + talk.partner2_sent)
+
+    @staticmethod
+    def get_percentiles(name, after=None, before=None):
+        """Blocking. Calculates percentiles of the value for the period using sketches from saved stats.
+
+        Args:
+            name (str): One of `SKETCHED_VALUES`.
+            after (datetime.datetime): Use stats created later than this moment.
+            before (datetime.datetime): Use stats created at this moment or earlier.
+
+        Raises:
+            DbError
+
+        """
+        stats_list = Stats.select()
+        if after is not None:
+            stats_list = stats_list.where(Stats.created > after)
+        if before is not None:
+            stats_list = stats_list.where(Stats.created <= before)
+        try:
+            return get_percentiles(merge_sketches(stats_list, name))
+        except DatabaseError as err:
+            raise DbError(f'DatabaseError during obtaining percentiles. {err}') from err
+
     def get_stats(self):
         return self._stats
 
@@ -80,39 +172,71 @@ class StatsService:
             now = datetime.datetime.utcnow()
             if next_stats_time > now:
                 await asyncio.sleep((next_stats_time - now).total_seconds())
-            self._update_stats()
+            # Sketches are swapped in the event loop's thread, so no values will be lost or counted twice.
+            sketches = self._sketches
+            self._sketches = self._create_sketches()
+            self._stats = await DbExecutor.get_instance().run(self._update_stats, sketches)
 
-    def _update_stats(self):
-        from .user_service import UserService
-        from .human_sender_service import HumanSenderService
-        from .talk import Talk
+    @staticmethod
+    def _create_sketches():
+        return {name: QuantileSketch() for name in SKETCHED_VALUES}
+
+    def _update_stats(self, sketches=None):
+        """Creates and saves stats for the period since previous stats. Doesn't change the service itself, so can be
+        executed in another thread.
+
+        Args:
+            sketches (dict): Sketches of values collected during the period.
+
+        Returns:
+            Stats
+
+        """
+        from .talk import ArchivedTalk, Talk
         stats = Stats()
-        user_service = UserService.get_instance()
+        if self._stats is not None:
+            after = self._stats.created
+        elif self._incremental:
+            after = stats.created - type(self).INTERVAL
+        else:
+            after = None
+        # Talks are aggregated up to the moment of stats creation, so next stats won't count them again.
+        before = stats.created
 
         talks_waiting = get_talks_stats(
-            Talk.get_not_ended_talks(after=None if self._stats is None else self._stats.created),
-            lambda talk: (talk.begin - talk.searched_since).total_seconds(),
+            Talk.get_not_ended_talks(after=after, before=before),
+            get_seconds_between(Talk.searched_since, Talk.begin),
             (10, 60, 60 * 5, 60 * 30, 60 * 60 * 3, ),
             )
 
-        ended_talks = Talk.get_ended_talks(after=None if self._stats is None else self._stats.created)
-        talks_duration = get_talks_stats(
-            ended_talks,
-            lambda talk: (talk.end - talk.begin).total_seconds(),
-            (10, 60, 60 * 5, 60 * 30, ),
-            )
-        talks_sent = get_talks_stats(
-            ended_talks,
-            lambda talk: talk.partner1_sent + talk.partner2_sent,
-            COUNT_INTERVALS,
-            )
+        talks_duration = []
+        talks_sent = []
+        # Archived talks ended long ago, so they're read only when the whole history is aggregated.
+        for model in (Talk, ) if after is not None else (Talk, ArchivedTalk):
+            ended_talks = Talk.get_ended_talks(after=after, before=before, archived=model is ArchivedTalk)
+            talks_duration.append(get_talks_stats(
+                ended_talks,
+                get_seconds_between(model.begin, model.end),
+                (10, 60, 60 * 5, 60 * 30, ),
+                ))
+            talks_sent.append(get_talks_stats(
+                ended_talks,
+                model.partner1_sent + model.partner2_sent,
+                COUNT_INTERVALS,
+                ))
+        talks_duration = merge_talks_stats(talks_duration)
+        talks_sent = merge_talks_stats(talks_sent)
 
         stats_dict = {
             'talks_duration': talks_duration,
             'talks_sent': talks_sent,
             'talks_waiting': talks_waiting,
             }
+        if sketches is not None:
+            for name, sketch in sketches.items():
+                stats_dict[name]['sketch'] = sketch.to_dict()
+                stats_dict[name]['percentiles'] = get_percentiles(sketch)
         stats.set_data(stats_dict)
         stats.save()
-        self._stats = stats
         LOGGER.info('Stats were updated')
+        return stats
@@ -15,38 +15,71 @@ LOGGER = logging.getLogger('router_bot.talk')
 database_proxy = Proxy()
 
 
+class PreciseDateTimeField(DateTimeField):
+    """Datetime which keeps fractions of a second in MySQL too, so durations calculated by the DB are precise. Column
+    type of this field is specified by `field_overrides` of DB classes.
+
+    """
+    db_field = 'datetime_precise'
+
+
 class Talk(Model):
     partner1 = ForeignKeyField(User, related_name='talks_as_partner1')
     partner1_sent = IntegerField(default=0)
     partner2 = ForeignKeyField(User, related_name='talks_as_partner2')
     partner2_sent = IntegerField(default=0)
-    searched_since = DateTimeField()
-    begin = DateTimeField(default=datetime.datetime.utcnow)
-    end = DateTimeField(index=True, null=True)
+    searched_since = PreciseDateTimeField()
+    begin = PreciseDateTimeField(default=datetime.datetime.utcnow)
+    end = PreciseDateTimeField(index=True, null=True)
 
     class Meta:
         database = database_proxy
+        indexes = (
+            (('partner1', 'end'), False),
+            (('partner2', 'end'), False),
+            )
 
     @classmethod
-    def get_ended_talks(cls, after=None):
-        talks = cls.select()
+    def get_ended_talks(cls, after=None, before=None, archived=False):
+        """
+        Args:
+            archived (bool): Whether talks should be selected from the archive instead of the talks which ended
+                recently.
+
+        """
+        model = ArchivedTalk if archived else cls
+        talks = model.select()
         if after is None:
-            talks = talks.where(Talk.end != None)
+            talks = talks.where(model.end != None)
         else:
-            talks = talks.where(Talk.end >= after)
+            talks = talks.where(model.end >= after)
+        if before is not None:
+            talks = talks.where(model.end < before)
         return talks
 
     @classmethod
-    def get_not_ended_talks(cls, after=None):
+    def get_not_ended_talks(cls, after=None, before=None):
         talks = cls.select().where(Talk.end == None)
         if after is not None:
             talks = talks.where(Talk.begin >= after)
+        if before is not None:
+            talks = talks.where(Talk.begin < before)
         return talks
 
     @classmethod
-    def get_talk(cls, user):
+    def get_talk(cls, user, partner=None):
+        """
+        Args:
+            partner (User): Partner of the talk. If it's omitted, any not ended talk of the user is returned.
+
+        """
+        if partner is None:
+            condition = (cls.partner1 == user) | (cls.partner2 == user)
+        else:
+            condition = ((cls.partner1 == user) & (cls.partner2 == partner)) | \
+                ((cls.partner1 == partner) & (cls.partner2 == user))
         try:
-            talk = cls.get(((cls.partner1 == user) | (cls.partner2 == user)) & (cls.end == None))
+            talk = cls.get(condition & (cls.end == None))
         except DoesNotExist:
             return None
         else:
@@ -84,14 +117,33 @@ class Talk(Model):
         else:
             raise WrongUserError()
 
-    def increment_sent(self, user):
+    def increment_sent(self, user, save=True):
         if user == self.partner1:
             self.partner1_sent += 1
         elif user == self.partner2:
             self.partner2_sent += 1
         else:
             raise WrongUserError()
-        self.save()
+        if save:
+            self.save()
 
     def is_successful(self):
         return self.partner1_sent and self.partner2_sent
+
+
+class ArchivedTalk(Model):
+    """Talk which ended long ago. Such talks are moved here from `Talk` by `ArchiveService`, so the table of talks
+    stays small. Archived talk keeps its ID.
+
+    """
+    id = IntegerField(primary_key=True)
+    partner1 = ForeignKeyField(User, related_name='archived_talks_as_partner1')
+    partner1_sent = IntegerField(default=0)
+    partner2 = ForeignKeyField(User, related_name='archived_talks_as_partner2')
+    partner2_sent = IntegerField(default=0)
+    searched_since = PreciseDateTimeField()
+    begin = PreciseDateTimeField()
+    end = PreciseDateTimeField(index=True)
+
+    class Meta:
+        database = database_proxy
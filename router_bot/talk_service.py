@@ -0,0 +1,574 @@
+# router-bot
+# Copyright (C) 2017 quasiyoke
+#
+# You should have received a copy of the GNU Affero General Public License v3
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import datetime
+import logging
+import time
+from .db_executor import DbExecutor
+from .error import ClientBotCapacityError, PartnerObtainingError, TalkServiceError
+from .reaper import Reaper
+from .stats_service import StatsService
+from .talk import Talk
+from .user import User
+from .user_service import UserService
+from peewee import DatabaseError
+from playhouse.shortcuts import case
+
+LOGGER = logging.getLogger('router_bot.talk_service')
+
+
+class TalkService:
+    """Keeps index of not ended talks by their partners' IDs, so obtaining of user's talk doesn't touch the DB. Human
+    has at most one talk while client bot can have several talks, one with every partner.
+
+    In write-behind mode counters of sent messages are accumulated in memory and are flushed to the DB in batches.
+
+    In shared mode talks can be begun and ended by other router-bot processes. Partners are claimed by the DB atomically
+    then. User's talk which is missing in the index is looked for in the DB and the index is synchronized with the DB
+    every `sync_interval` seconds, so talks ended by other processes are dropped from it.
+
+    """
+    # Number of attempts to claim a partner when other processes claim the same users simultaneously.
+    CLAIM_ATTEMPTS_COUNT = 3
+    # Number of the longest waiting users which are tried during one claiming attempt.
+    CLAIM_CANDIDATES_COUNT = 8
+    FLUSH_BATCH_SIZE = 500
+    # Seconds during which talk ended by this process isn't added to the index again from results of DB queries which
+    # could be started before its end was saved.
+    ENDED_TALKS_TTL = 60
+    _instance = None
+
+    def __init__(self, write_behind=False, flush_interval=5, max_loss_window=30, shared=False, sync_interval=1):
+        """
+        Args:
+            write_behind (bool): Whether counters of sent messages should be saved lazily.
+            flush_interval (float): Seconds between flushes of counters in write-behind mode.
+            max_loss_window (float): Maximal age (in seconds) of counters which weren't flushed yet. Reaching it leads
+                to immediate flush.
+            shared (bool): Whether other processes work with the same DB.
+            sync_interval (float): Seconds between synchronizations of the index with the DB in shared mode.
+
+        """
+        self._write_behind = write_behind
+        self._shared = shared
+        self._sync_interval = sync_interval
+        self._flush_interval = flush_interval
+        self._max_loss_window = max_loss_window
+        # Maps talk ID to the list `[partner1_sent delta, partner2_sent delta]`.
+        self._pending_sent = {}
+        self._pending_since = None
+        # Maps user ID to the dict which maps partner's ID to their talk.
+        self._talks = {}
+        # Maps ID of the talk ended by this process to the time of its end.
+        self._ended_talks_ids = {}
+        talks = self._cache_partners(self._select_partners(Talk.get_not_ended_talks()))
+        for talk in talks:
+            self.add_talk(talk)
+        LOGGER.info('%d not ended talks were loaded', len(talks))
+        type(self)._instance = self
+
+    @classmethod
+    def get_instance(cls, configuration=None):
+        if cls._instance is None:
+            if configuration is None:
+                raise TalkServiceError(
+                    'Instance wasn\'t initialized. Provide arguments to '
+                    'construct one.',
+                    )
+            else:
+                cls._instance = cls(
+                    write_behind=configuration.talks_write_behind,
+                    flush_interval=configuration.talks_flush_interval,
+                    max_loss_window=configuration.talks_max_loss_window,
+                    shared=configuration.matching_mode == 'database',
+                    sync_interval=configuration.matching_sync_interval,
+                    )
+        return cls._instance
+
+    def add_talk(self, talk):
+        self._index_talk(talk)
+        Reaper.get_instance().add_talk(talk)
+
+    async def begin_talk_with_waiting_user(self, user, is_client_bot=False, capacity=None):
+        """Claims the compatible user who is waiting for partner for the longest time and begins the talk with her.
+        Claiming and talk's creation are done in one DB transaction using conditional UPDATE, so one waiting user can't
+        be claimed by two router-bot processes.
+
+        Args:
+            is_client_bot (bool): The user is client bot which can have several talks, so her existing talks don't
+                mean that she was claimed. Any waiting user is compatible with client bot.
+            capacity (int): Maximal number of client bot's talks. They are counted by the DB in the same transaction,
+                so talks begun by other processes are taken into account.
+
+        Returns:
+            Talk with the user as `partner1` and claimed user as `partner2`. If the user was claimed by somebody else
+            meanwhile, that talk is returned, where the user is `partner2`.
+
+        Raises:
+            PartnerObtainingError if there's no waiting users.
+            ClientBotCapacityError if client bot has no free capacity.
+
+        """
+        result = await DbExecutor.get_instance().run(self._claim_partner, user.id, is_client_bot, capacity)
+        if result is None:
+            raise PartnerObtainingError()
+        talk, partner = result
+        partner = UserService.get_instance().get_cached_user(partner)
+        if talk.partner1_id == user.id:
+            talk.partner1 = user
+            talk.partner2 = partner
+        else:
+            talk.partner1 = partner
+            talk.partner2 = user
+        self.add_talk(talk)
+        return talk
+
+    async def cancel_talk(self, talk):
+        """Removes the talk which didn't take place, e.g. because one of partners couldn't be notified. Such talk wasn't
+        confirmed, so it isn't counted by stats.
+
+        """
+        self._pending_sent.pop(talk.id, None)
+        self.remove_talk(talk)
+        await DbExecutor.get_instance().run(talk.delete_instance)
+
+    async def change_talk(self, user, talk=None, partner=None):
+        """Ends the user's talk and begins her new talk with the partner. Talks and `looking_for_partner_from` of both
+        users are saved in one DB transaction, so a failure can't leave talks inconsistent with the users.
+
+        Args:
+            user (User)
+            talk (Talk): User's talk to end.
+            partner (User): New partner. Both users stop looking for partner then.
+
+        Returns:
+            New talk or `None`.
+
+        """
+        ended_talk = None
+        if talk is not None:
+            talk.end = datetime.datetime.utcnow()
+            partner1_sent, partner2_sent = self._pending_sent.pop(talk.id, (0, 0))
+            ended_talk = (talk.id, talk.end, partner1_sent, partner2_sent)
+            self.remove_talk(talk)
+            StatsService.get_instance().add_talk_ended(talk)
+        users = [user]
+        searched_since = None
+        if partner is not None:
+            searched_since = partner.looking_for_partner_from
+            users.append(partner)
+            for talk_partner in users:
+                talk_partner.looking_for_partner_from = None
+        # Both users have the same `looking_for_partner_from` after the transition, so they're saved by one UPDATE.
+        new_talk = await DbExecutor.get_instance().run(
+            self._save_transition,
+            ended_talk,
+            user.id,
+            None if partner is None else partner.id,
+            searched_since,
+            [talk_partner.id for talk_partner in users],
+            user.looking_for_partner_from,
+            )
+        if new_talk is not None:
+            new_talk.partner1 = user
+            new_talk.partner2 = partner
+            self.add_talk(new_talk)
+        return new_talk
+
+    def confirm_talk(self, talk):
+        """Should be called when both partners of the begun talk were notified, so the talk can't be cancelled anymore.
+        Adds the talk to stats.
+
+        """
+        StatsService.get_instance().add_talk_began(talk)
+
+    def flush(self):
+        """Synchronously saves accumulated counters of sent messages. Is used during shutdown.
+
+        """
+        pending_sent = self._take_pending_sent()
+        if pending_sent:
+            self._restore_pending_sent(self._save_pending_sent(pending_sent))
+
+    def get_talk(self, user, partner=None):
+        """
+        Args:
+            partner (User): Partner of the talk. If it's omitted, any talk of the user is returned, what is fine for
+                humans who have at most one talk.
+
+        Returns:
+            Not ended talk of the user from the index or `None`. In shared mode the talk begun by another process
+            could be missing in the index, use `obtain_talk` to look for it in the DB.
+
+        """
+        talks = self._talks.get(user.id)
+        if not talks:
+            return None
+        if partner is None:
+            return next(iter(talks.values()))
+        return talks.get(partner.id)
+
+    def get_talks_count(self):
+        return sum(len(talks) for talks in self._talks.values()) // 2
+
+    def get_user_talks_count(self, user_id):
+        """
+        Returns:
+            Number of not ended talks of the user known to this process.
+
+        """
+        return len(self._talks.get(user_id, ()))
+
+    def has_talk(self, user_id):
+        return user_id in self._talks
+
+    async def increment_sent(self, talk, user):
+        talk.increment_sent(user, save=False)
+        Reaper.get_instance().touch_talk(talk)
+        if user.id == talk.partner1_id:
+            sent = (1, 0)
+        else:
+            sent = (0, 1)
+        if not self._write_behind:
+            await DbExecutor.get_instance().run(self._save_sent, talk.id, *sent)
+            return
+        self._add_pending_sent(talk.id, *sent)
+        if time.monotonic() - self._pending_since >= self._max_loss_window:
+            await self._flush()
+
+    async def obtain_talk(self, user, partner=None):
+        """Like `get_talk` but in shared mode looks for the talk in the DB if it's missing in the index. Found talk is
+        added to the index.
+
+        """
+        talk = self.get_talk(user, partner)
+        if talk is not None or not self._shared:
+            return talk
+        talks = await DbExecutor.get_instance().run(self._load_talks, user.id, None if partner is None else partner.id)
+        for talk in self._cache_partners(talks):
+            # The index could be changed meanwhile.
+            if talk.id not in self._ended_talks_ids and self.get_talk(user, talk.get_partner(user)) is None:
+                self._index_talk(talk)
+        return self.get_talk(user, partner)
+
+    def remove_talk(self, talk):
+        if self._shared:
+            self._ended_talks_ids[talk.id] = time.monotonic()
+        self._unindex_talk(talk)
+
+    async def run(self):
+        coroutines = []
+        if self._write_behind:
+            coroutines.append(self._run_flushing())
+        if self._shared:
+            coroutines.append(self._run_syncing())
+        await asyncio.gather(*coroutines)
+
+    def _add_pending_sent(self, talk_id, partner1_sent, partner2_sent):
+        try:
+            pending_sent = self._pending_sent[talk_id]
+        except KeyError:
+            pending_sent = [0, 0]
+            self._pending_sent[talk_id] = pending_sent
+        pending_sent[0] += partner1_sent
+        pending_sent[1] += partner2_sent
+        if self._pending_since is None:
+            self._pending_since = time.monotonic()
+
+    def _cache_partners(self, talks):
+        """Replaces partners of talks obtained from the DB with cached users.
+
+        """
+        user_service = UserService.get_instance()
+        for talk in talks:
+            talk.partner1 = user_service.get_cached_user(talk.partner1)
+            talk.partner2 = user_service.get_cached_user(talk.partner2)
+        return talks
+
+    @classmethod
+    def _claim_partner(cls, user_id, is_client_bot=False, capacity=None):
+        """Blocking part of `begin_talk_with_waiting_user`.
+
+        Returns:
+            Pair `(talk, partner)` or `None` if there's no waiting users.
+
+        """
+        for attempt in range(cls.CLAIM_ATTEMPTS_COUNT):
+            try:
+                with Talk._meta.database.atomic():
+                    return cls._claim_partner_once(user_id, is_client_bot, capacity)
+            except _ClaimConflictError:
+                LOGGER.debug('Claiming partner for %d conflicted with another claim', user_id)
+        return None
+
+    @classmethod
+    def _claim_partner_once(cls, user_id, is_client_bot=False, capacity=None):
+        """
+        Raises:
+            _ClaimConflictError if some of the users was claimed by another transaction. Transaction should be rolled
+                back then.
+            ClientBotCapacityError if client bot has `capacity` not ended talks already.
+
+        """
+        users = User.select().where(User.id == user_id)
+        if capacity is not None:
+            # Client bot's row is locked, so concurrent claims for the same bot count its talks one after another.
+            users = users.for_update(Talk._meta.database.for_update)
+        user = users.get()
+        if is_client_bot:
+            talk = None
+            if capacity is not None:
+                talks_count = Talk.select() \
+                    .where(((Talk.partner1 == user_id) | (Talk.partner2 == user_id)) & (Talk.end == None)) \
+                    .count()
+                if talks_count >= capacity:
+                    raise ClientBotCapacityError(f'Client bot {user_id} has {talks_count} talks already.')
+        else:
+            talk = Talk.select() \
+                .where(((Talk.partner1 == user_id) | (Talk.partner2 == user_id)) & (Talk.end == None)) \
+                .first()
+        if talk is not None:
+            # Somebody has claimed the user already.
+            return talk, User.get(User.id == talk.get_partner_id(user))
+        candidates = User.select() \
+            .where((User.looking_for_partner_from != None) & (User.id != user_id))
+        if not is_client_bot:
+            candidates = candidates.where(user.get_partners_condition())
+        candidates = candidates \
+            .order_by(User.looking_for_partner_from) \
+            .limit(cls.CLAIM_CANDIDATES_COUNT)
+        for candidate in candidates:
+            # Both users are claimed by single statement, so concurrent claims lock rows in the same order.
+            condition = (User.id == candidate.id) & \
+                (User.looking_for_partner_from == candidate.looking_for_partner_from)
+            expected_count = 1
+            if user.looking_for_partner_from is not None:
+                condition |= (User.id == user_id) & (User.looking_for_partner_from == user.looking_for_partner_from)
+                expected_count = 2
+            claimed_count = User.update(looking_for_partner_from=None).where(condition).execute()
+            if claimed_count != expected_count:
+                raise _ClaimConflictError()
+            talk = Talk.create(
+                partner1=user_id,
+                partner2=candidate.id,
+                searched_since=candidate.looking_for_partner_from,
+                )
+            return talk, candidate
+        return None
+
+    async def _flush(self):
+        pending_sent = self._take_pending_sent()
+        if pending_sent:
+            self._restore_pending_sent(await DbExecutor.get_instance().run(self._save_pending_sent, pending_sent))
+
+    def _index_talk(self, talk):
+        self._talks.setdefault(talk.partner1_id, {})[talk.partner2_id] = talk
+        self._talks.setdefault(talk.partner2_id, {})[talk.partner1_id] = talk
+
+    @classmethod
+    def _load_not_ended_talks(cls, known_ids):
+        """Blocking part of `_sync`.
+
+        Args:
+            known_ids (set): IDs of talks from the index.
+
+        Returns:
+            Pair `(IDs of not ended talks, not ended talks which are missing in the index)`.
+
+        """
+        not_ended_ids = {talk_id for talk_id, in Talk.select(Talk.id).where(Talk.end == None).tuples()}
+        new_ids = not_ended_ids - known_ids
+        if new_ids:
+            new_talks = cls._select_partners(Talk.select().where(Talk.id << list(new_ids)))
+        else:
+            new_talks = []
+        return not_ended_ids, new_talks
+
+    @classmethod
+    def _load_talks(cls, user_id, partner_id=None):
+        """Blocking part of `obtain_talk`.
+
+        """
+        if partner_id is None:
+            condition = (Talk.partner1 == user_id) | (Talk.partner2 == user_id)
+        else:
+            condition = ((Talk.partner1 == user_id) & (Talk.partner2 == partner_id)) | \
+                ((Talk.partner1 == partner_id) & (Talk.partner2 == user_id))
+        return cls._select_partners(Talk.select().where(condition & (Talk.end == None)))
+
+    def _restore_pending_sent(self, pending_sent):
+        for talk_id, (partner1_sent, partner2_sent) in pending_sent.items():
+            self._add_pending_sent(talk_id, partner1_sent, partner2_sent)
+
+    async def _run_flushing(self):
+        while True:
+            await asyncio.sleep(self._flush_interval)
+            await self._flush()
+
+    async def _run_syncing(self):
+        while True:
+            await asyncio.sleep(self._sync_interval)
+            try:
+                await self._sync()
+            except DatabaseError as err:
+                LOGGER.error('Can\'t synchronize talks with the DB: %s', err)
+
+    @classmethod
+    def _save_end(cls, talk_id, end, partner1_sent, partner2_sent):
+        """Counters are saved as increments, so it doesn't matter if some flush of the talk is still in progress. The
+        talk is ended only if nobody has ended it yet, so end of the talk ended by another process isn't overwritten.
+
+        Returns:
+            `False` if the talk was ended already.
+
+        """
+        ended_count = Talk.update(
+            end=end,
+            partner1_sent=Talk.partner1_sent + partner1_sent,
+            partner2_sent=Talk.partner2_sent + partner2_sent,
+            ) \
+            .where((Talk.id == talk_id) & (Talk.end == None)) \
+            .execute()
+        if ended_count:
+            return True
+        LOGGER.info('Talk %d was ended by another process already', talk_id)
+        if partner1_sent or partner2_sent:
+            cls._save_sent(talk_id, partner1_sent, partner2_sent)
+        return False
+
+    @classmethod
+    def _save_pending_sent(cls, pending_sent):
+        """Saves counters using one UPDATE query per batch of talks.
+
+        Returns:
+            dict: Counters which weren't saved because of DB errors.
+
+        """
+        failed_pending_sent = {}
+        talks_ids = list(pending_sent)
+        for i in range(0, len(talks_ids), cls.FLUSH_BATCH_SIZE):
+            batch = talks_ids[i:i + cls.FLUSH_BATCH_SIZE]
+            try:
+                cls._save_pending_sent_batch(batch, pending_sent)
+            except DatabaseError as err:
+                LOGGER.error('Can\'t flush sent messages counters of %d talks: %s', len(batch), err)
+                for talk_id in batch:
+                    failed_pending_sent[talk_id] = pending_sent[talk_id]
+        LOGGER.debug('Sent messages counters of %d talks were flushed', len(talks_ids) - len(failed_pending_sent))
+        return failed_pending_sent
+
+    @staticmethod
+    def _save_pending_sent_batch(talks_ids, pending_sent):
+        fields = {}
+        for field, i in ((Talk.partner1_sent, 0), (Talk.partner2_sent, 1)):
+            deltas = [
+                (talk_id, pending_sent[talk_id][i])
+                for talk_id in talks_ids
+                if pending_sent[talk_id][i]
+                ]
+            if deltas:
+                fields[field] = field + case(Talk.id, deltas, 0)
+        Talk.update(fields).where(Talk.id << talks_ids).execute()
+
+    @classmethod
+    def _save_transition(cls, ended_talk, partner1_id, partner2_id, searched_since, users_ids,
+                         looking_for_partner_from):
+        """Blocking part of `change_talk`. Issues at most three statements in one transaction.
+
+        Args:
+            ended_talk (tuple): Arguments for `_save_end` or `None`.
+            users_ids (list): IDs of users whose `looking_for_partner_from` should be saved.
+            looking_for_partner_from (datetime.datetime): New value for all these users.
+
+        """
+        with Talk._meta.database.atomic():
+            if ended_talk is not None:
+                cls._save_end(*ended_talk)
+            if partner2_id is None:
+                talk = None
+            else:
+                talk = Talk.create(partner1=partner1_id, partner2=partner2_id, searched_since=searched_since)
+            User.update(looking_for_partner_from=looking_for_partner_from) \
+                .where(User.id << users_ids) \
+                .execute()
+        return talk
+
+    @staticmethod
+    def _save_sent(talk_id, partner1_sent, partner2_sent):
+        Talk.update(
+            partner1_sent=Talk.partner1_sent + partner1_sent,
+            partner2_sent=Talk.partner2_sent + partner2_sent,
+            ) \
+            .where(Talk.id == talk_id) \
+            .execute()
+
+    @staticmethod
+    def _select_partners(talks):
+        """Blocking. Obtains partners of the talks using one query.
+
+        """
+        talks = list(talks)
+        users_ids = set()
+        for talk in talks:
+            users_ids.add(talk.partner1_id)
+            users_ids.add(talk.partner2_id)
+        users = {}
+        if users_ids:
+            for user in User.select().where(User.id << list(users_ids)):
+                users[user.id] = user
+        for talk in talks:
+            talk.partner1 = users[talk.partner1_id]
+            talk.partner2 = users[talk.partner2_id]
+        return talks
+
+    async def _sync(self):
+        """Drops talks ended by other processes from the index and adds talks begun by them. Talks begun by other
+        processes aren't tracked by the reaper because their activity is seen by those processes.
+
+        """
+        now = time.monotonic()
+        for talk_id, ended in list(self._ended_talks_ids.items()):
+            if now - ended >= type(self).ENDED_TALKS_TTL:
+                del self._ended_talks_ids[talk_id]
+        known_talks = {
+            talk.id: talk
+            for talks in self._talks.values()
+            for talk in talks.values()
+            }
+        not_ended_ids, new_talks = await DbExecutor.get_instance().run(self._load_not_ended_talks, set(known_talks))
+        ended_count = 0
+        for talk_id, talk in known_talks.items():
+            if talk_id not in not_ended_ids:
+                self._unindex_talk(talk)
+                ended_count += 1
+        begun_count = 0
+        for talk in self._cache_partners(new_talks):
+            if talk.id in self._ended_talks_ids or self.get_talk(talk.partner1, talk.partner2) is not None:
+                continue
+            self._index_talk(talk)
+            begun_count += 1
+        if ended_count or begun_count:
+            LOGGER.debug('Talks were synchronized: %d ended and %d begun by other processes', ended_count, begun_count)
+
+    def _take_pending_sent(self):
+        pending_sent = self._pending_sent
+        self._pending_sent = {}
+        self._pending_since = None
+        return pending_sent
+
+    def _unindex_talk(self, talk):
+        for user_id, partner_id in ((talk.partner1_id, talk.partner2_id), (talk.partner2_id, talk.partner1_id)):
+            talks = self._talks.get(user_id)
+            # The talk could be obtained from the DB again, so it's compared by ID.
+            if talks is not None and partner_id in talks and talks[partner_id].id == talk.id:
+                del talks[partner_id]
+                if not talks:
+                    del self._talks[user_id]
+
+
+class _ClaimConflictError(Exception):
+    pass
@@ -0,0 +1,151 @@
+# router-bot
+# Copyright (C) 2017 quasiyoke
+#
+# You should have received a copy of the GNU Affero General Public License v3
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import csv
+import json
+import logging
+from .client_bot import ClientBot
+from .human import Human
+from .talk import ArchivedTalk, Talk
+
+LOGGER = logging.getLogger('router_bot.talks_exporter')
+COLUMNS = (
+    'id',
+    'searched_since',
+    'begin',
+    'end',
+    'partner1_id',
+    'partner1_kind',
+    'partner1_concrete_id',
+    'partner1_sent',
+    'partner2_id',
+    'partner2_kind',
+    'partner2_concrete_id',
+    'partner2_sent',
+    )
+FORMATS = ('jsonl', 'csv')
+
+
+def get_users_kinds(users_ids):
+    """Finds out concrete users like `User.get_concrete_user` does but with two queries for all users.
+
+    Returns:
+        dict which maps user ID to the pair `(kind, concrete ID)`, where kind is "human" with Telegram ID or "bot" with
+        bot ID. Users without concrete user are missing.
+
+    """
+    users_kinds = {}
+    if not users_ids:
+        return users_kinds
+    for user_id, telegram_id in Human.select(Human.user, Human.telegram_id).where(Human.user << users_ids).tuples():
+        users_kinds[user_id] = ('human', telegram_id)
+    for user_id, bot_id in ClientBot.select(ClientBot.user, ClientBot.bot_id) \
+            .where(ClientBot.user << users_ids) \
+            .tuples():
+        users_kinds.setdefault(user_id, ('bot', bot_id))
+    return users_kinds
+
+
+class TalksExporter:
+    """Streams talks page by page. Pages are selected by the last seen ID instead of offset, so every page takes the
+    same time and only one page is kept in memory.
+
+    """
+    PAGE_SIZE = 1000
+
+    def __init__(self, after=None, before=None, archived=False, page_size=PAGE_SIZE):
+        """
+        Args:
+            after (datetime.datetime): Export talks which began at this moment or later.
+            before (datetime.datetime): Export talks which began earlier.
+            archived (bool): Whether archived talks should be exported too.
+
+        """
+        self._after = after
+        self._before = before
+        self._archived = archived
+        self._page_size = page_size
+
+    def export(self, f, format):
+        """
+        Args:
+            f: Text file to write to.
+            format (str): One of `FORMATS`.
+
+        Returns:
+            Number of exported talks.
+
+        """
+        if format == 'csv':
+            writer = csv.DictWriter(f, COLUMNS)
+            writer.writeheader()
+            write_row = writer.writerow
+        else:
+            def write_row(row):
+                f.write(json.dumps(row, ensure_ascii=False))
+                f.write('\n')
+        count = 0
+        for row in self.get_rows():
+            write_row(row)
+            count += 1
+        return count
+
+    def get_rows(self):
+        """
+        Yields:
+            dicts with `COLUMNS` keys.
+
+        """
+        for model in (ArchivedTalk, Talk) if self._archived else (Talk, ):
+            for page in self._get_pages(model):
+                users_ids = {row[i] for row in page for i in (4, 6)}
+                users_kinds = get_users_kinds(list(users_ids))
+                for talk_id, searched_since, begin, end, partner1_id, partner1_sent, partner2_id, partner2_sent \
+                        in page:
+                    partner1_kind, partner1_concrete_id = users_kinds.get(partner1_id, (None, None))
+                    partner2_kind, partner2_concrete_id = users_kinds.get(partner2_id, (None, None))
+                    yield {
+                        'id': talk_id,
+                        'searched_since': _format_datetime(searched_since),
+                        'begin': _format_datetime(begin),
+                        'end': _format_datetime(end),
+                        'partner1_id': partner1_id,
+                        'partner1_kind': partner1_kind,
+                        'partner1_concrete_id': partner1_concrete_id,
+                        'partner1_sent': partner1_sent,
+                        'partner2_id': partner2_id,
+                        'partner2_kind': partner2_kind,
+                        'partner2_concrete_id': partner2_concrete_id,
+                        'partner2_sent': partner2_sent,
+                        }
+
+    def _get_pages(self, model):
+        talks = model.select(
+            model.id,
+            model.searched_since,
+            model.begin,
+            model.end,
+            model.partner1,
+            model.partner1_sent,
+            model.partner2,
+            model.partner2_sent,
+            )
+        if self._after is not None:
+            talks = talks.where(model.begin >= self._after)
+        if self._before is not None:
+            talks = talks.where(model.begin < self._before)
+        last_id = 0
+        while True:
+            page = list(talks.where(model.id > last_id).order_by(model.id).limit(self._page_size).tuples())
+            if page:
+                yield page
+            if len(page) < self._page_size:
+                return
+            last_id = page[-1][0]
+
+
+def _format_datetime(value):
+    return None if value is None else value.isoformat()
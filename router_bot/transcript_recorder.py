@@ -0,0 +1,376 @@
+# router-bot
+# Copyright (C) 2017 quasiyoke
+#
+# You should have received a copy of the GNU Affero General Public License v3
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Transcripts of talks are appended to segment files as JSON lines. Every segment has an index file with lines
+`<talk ID> <offset>`. When the segment is completed, its index is sorted by talks and is saved as binary entries, so
+records of one talk are found in every segment by binary search instead of scanning the whole index.
+
+"""
+
+import asyncio
+import datetime
+import json
+import logging
+import os
+import re
+import struct
+from concurrent.futures import ThreadPoolExecutor
+from .error import TranscriptRecorderError
+
+LOGGER = logging.getLogger('router_bot.transcript_recorder')
+FSYNC_POLICIES = ('batch', 'segment', 'none')
+SEGMENT_NAME_RE = re.compile('^segment-(\\d+)\\.jsonl$')
+# Entry of sorted index: talk ID and offset of the record.
+SORTED_INDEX_ENTRY = struct.Struct('<QQ')
+
+
+def get_segment_path(directory, number):
+    return os.path.join(directory, f'segment-{number:06d}.jsonl')
+
+
+def get_index_path(directory, number):
+    return os.path.join(directory, f'segment-{number:06d}.index')
+
+
+def get_sorted_index_path(directory, number):
+    return os.path.join(directory, f'segment-{number:06d}.sorted')
+
+
+def get_segments_numbers(directory):
+    numbers = []
+    for name in os.listdir(directory):
+        match = SEGMENT_NAME_RE.match(name)
+        if match:
+            numbers.append(int(match.group(1)))
+    return sorted(numbers)
+
+
+class TranscriptRecorder:
+    """Records messages relayed between partners. Messages are collected in memory and are written in batches on
+    a separate thread, so recording doesn't touch the DB and doesn't block the event loop.
+
+    Write errors don't break relaying: records which weren't written are returned to the buffer while there's room for
+    them and are dropped otherwise.
+
+    """
+    _instance = None
+
+    def __init__(self, directory, buffer_size=10000, flush_interval=1, segment_size=64 * 1024 * 1024,
+                 fsync='batch'):
+        """
+        Args:
+            directory (str): Directory with segments.
+            buffer_size (int): Maximal number of records in memory. When it's reached, senders wait for the flush.
+            flush_interval (float): Seconds between flushes.
+            segment_size (int): Size in bytes after which new segment is started.
+            fsync (str): One of `FSYNC_POLICIES`. "batch" syncs files after every flush, "segment" syncs them when
+                segment is completed and "none" leaves it to OS.
+
+        """
+        os.makedirs(directory, exist_ok=True)
+        self._directory = directory
+        self._buffer_size = buffer_size
+        self._flush_interval = flush_interval
+        self._segment_size = segment_size
+        self._fsync = fsync
+        self._records = []
+        self._flush_lock = asyncio.Lock()
+        # Single thread keeps records in order.
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        # Every start begins new segment, so a record torn by crash is never followed by new ones.
+        self._segment_number = max(get_segments_numbers(directory), default=0)
+        self._segment = None
+        self._index = None
+        self._index_lines = []
+        # Whether some records were committed to the current segment. `None` if there's no current segment.
+        self._is_segment_committed = None
+        # Size of the current segment's index after the last commit.
+        self._committed_index_size = 0
+        self._dropped_count = 0
+        # Segments completed by previous runs could be left without sorted index, e.g. after crash.
+        for number in get_segments_numbers(directory):
+            if not os.path.exists(get_sorted_index_path(directory, number)):
+                self._executor.submit(self._sort_index, number)
+        type(self)._instance = self
+
+    @classmethod
+    def get_instance(cls):
+        if cls._instance is None:
+            raise TranscriptRecorderError('Instance wasn\'t initialized.')
+        return cls._instance
+
+    def close(self):
+        """Blocking. Writes records which are still in memory and closes the segment. Should be called after the event
+        loop was stopped.
+
+        """
+        self._executor.shutdown()
+        records = self._records
+        self._records = []
+        failed_records = self._write(records)
+        if failed_records:
+            LOGGER.error('%d transcripts records were lost', len(failed_records))
+        if self._segment is not None:
+            try:
+                self._commit(is_final=True)
+                self._close_segment()
+            except OSError as err:
+                LOGGER.error('Can\'t complete transcripts segment %d: %s', self._segment_number, err)
+                self._abandon_segment()
+
+    def get_buffer_size(self):
+        return len(self._records)
+
+    def get_dropped_count(self):
+        return self._dropped_count
+
+    async def record(self, talk_id, user_id, message):
+        """Never raises because of write errors, so recording can't break relaying.
+
+        """
+        while len(self._records) >= self._buffer_size:
+            LOGGER.debug('Transcripts buffer is full')
+            if not await self._flush():
+                # The buffer is still full of records which can't be written.
+                self._dropped_count += 1
+                return
+        self._records.append((talk_id, user_id, datetime.datetime.utcnow(), message.type, message.sending_kwargs))
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self._flush_interval)
+            await self._flush()
+
+    async def _flush(self):
+        """
+        Returns:
+            `False` if some records weren't written.
+
+        """
+        async with self._flush_lock:
+            if not self._records:
+                return True
+            records = self._records
+            self._records = []
+            failed_records = await asyncio.get_event_loop().run_in_executor(self._executor, self._write, records)
+            if not failed_records:
+                return True
+            # Failed records are older than the ones recorded meanwhile, so they're returned to the buffer's beginning.
+            # The oldest of them are dropped when there's no room.
+            room = max(self._buffer_size - len(self._records), 0)
+            dropped_count = max(len(failed_records) - room, 0)
+            if dropped_count:
+                LOGGER.error('%d transcripts records were dropped', dropped_count)
+                self._dropped_count += dropped_count
+            self._records[:0] = failed_records[dropped_count:]
+            return False
+
+    def _abandon_segment(self):
+        """Blocking. Closes the segment after write error. Index is truncated to its size after the last commit, so
+        records which weren't committed are never read and aren't duplicated when they're written to new segment.
+        Segment without committed records is removed, so its number is used again and repeating errors don't produce
+        new files.
+
+        """
+        for f in (self._segment, self._index):
+            if f is None:
+                continue
+            try:
+                f.close()
+            except OSError:
+                pass
+        if self._is_segment_committed:
+            # Index lines of the failed commit could reach the file. Closing could flush them too.
+            index_path = get_index_path(self._directory, self._segment_number)
+            try:
+                os.truncate(index_path, self._committed_index_size)
+            except OSError as err:
+                LOGGER.error('Can\'t truncate index of transcripts segment %d: %s', self._segment_number, err)
+            self._sort_index(self._segment_number)
+        elif self._is_segment_committed is not None:
+            for path in (
+                    get_segment_path(self._directory, self._segment_number),
+                    get_index_path(self._directory, self._segment_number),
+                    ):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            self._segment_number -= 1
+        self._segment = None
+        self._index = None
+        self._index_lines = []
+        self._is_segment_committed = None
+
+    def _close_segment(self):
+        """Blocking. Closes committed segment and sorts its index.
+
+        """
+        self._segment.close()
+        self._index.close()
+        self._segment = None
+        self._index = None
+        self._is_segment_committed = None
+        self._sort_index(self._segment_number)
+
+    def _commit(self, is_final=False):
+        """Writes index lines for the records written to the segment. Data is flushed before the index, so the index
+        doesn't point to missing records.
+
+        """
+        should_sync = self._fsync == 'batch' or self._fsync == 'segment' and is_final
+        self._segment.flush()
+        if should_sync:
+            os.fsync(self._segment.fileno())
+        self._index.write(''.join(self._index_lines).encode('ascii'))
+        self._index.flush()
+        if should_sync:
+            os.fsync(self._index.fileno())
+        self._index_lines = []
+        self._committed_index_size = self._index.tell()
+        self._is_segment_committed = True
+
+    def _open_segment(self):
+        self._segment_number += 1
+        self._is_segment_committed = False
+        self._segment = open(get_segment_path(self._directory, self._segment_number), 'ab')
+        self._index = open(get_index_path(self._directory, self._segment_number), 'ab')
+        self._committed_index_size = self._index.tell()
+        LOGGER.info('Transcripts segment %d was started', self._segment_number)
+
+    def _sort_index(self, number):
+        """Blocking. Saves index of the completed segment sorted by talks. Records of one talk keep their order because
+        their offsets grow.
+
+        """
+        entries = []
+        try:
+            with open(get_index_path(self._directory, number), 'rb') as f:
+                for line in f:
+                    # The last line could be torn by crash.
+                    if line.endswith(b'\n'):
+                        talk_id, offset = line.split()
+                        entries.append((int(talk_id), int(offset)))
+            entries.sort()
+            path = get_sorted_index_path(self._directory, number)
+            with open(path + '.tmp', 'wb') as f:
+                f.write(b''.join(SORTED_INDEX_ENTRY.pack(*entry) for entry in entries))
+                f.flush()
+                if self._fsync != 'none':
+                    os.fsync(f.fileno())
+            os.replace(path + '.tmp', path)
+        except (OSError, ValueError) as err:
+            LOGGER.error('Can\'t sort index of transcripts segment %d: %s', number, err)
+
+    def _write(self, records):
+        """Blocking. Appends records to the segment.
+
+        Returns:
+            Records which weren't committed because of write error.
+
+        """
+        if not records:
+            return []
+        committed_count = 0
+        try:
+            for i, (talk_id, user_id, sent, content_type, content) in enumerate(records):
+                if self._segment is not None and self._segment.tell() >= self._segment_size:
+                    self._commit(is_final=True)
+                    committed_count = i
+                    self._close_segment()
+                if self._segment is None:
+                    self._open_segment()
+                self._index_lines.append(f'{talk_id} {self._segment.tell()}\n')
+                line = json.dumps({
+                    'talk_id': talk_id,
+                    'user_id': user_id,
+                    'sent': sent.isoformat(),
+                    'type': content_type,
+                    'content': content,
+                    }, ensure_ascii=False)
+                self._segment.write(line.encode('utf-8') + b'\n')
+            self._commit()
+        except OSError as err:
+            LOGGER.error('Can\'t write transcripts to segment %d: %s', self._segment_number, err)
+            self._abandon_segment()
+            return records[committed_count:]
+        return []
+
+
+class TranscriptReader:
+    def __init__(self, directory):
+        self._directory = directory
+
+    def get_transcript(self, talk_id):
+        """Blocking.
+
+        Returns:
+            List of records of the talk in order of sending. Records are dicts with "talk_id", "user_id", "sent",
+            "type" and "content" keys.
+
+        """
+        records = []
+        for number in get_segments_numbers(self._directory):
+            try:
+                offsets = self._get_sorted_offsets(number, talk_id)
+            except FileNotFoundError:
+                # The segment isn't completed yet.
+                try:
+                    offsets = self._get_offsets(number, talk_id)
+                except FileNotFoundError:
+                    continue
+            if not offsets:
+                continue
+            with open(get_segment_path(self._directory, number), 'rb') as f:
+                for offset in offsets:
+                    f.seek(offset)
+                    line = f.readline()
+                    try:
+                        records.append(json.loads(line.decode('utf-8')))
+                    except ValueError:
+                        LOGGER.warning('Record of talk %d at %d in segment %d is torn', talk_id, offset, number)
+        return records
+
+    def _get_offsets(self, number, talk_id):
+        """Scans index of the segment.
+
+        """
+        prefix = f'{talk_id} '.encode('ascii')
+        with open(get_index_path(self._directory, number), 'rb') as f:
+            return [
+                int(line[len(prefix):])
+                for line in f
+                if line.startswith(prefix) and line.endswith(b'\n')
+                ]
+
+    def _get_sorted_offsets(self, number, talk_id):
+        """Looks for the talk in sorted index of the segment using binary search.
+
+        """
+        with open(get_sorted_index_path(self._directory, number), 'rb') as f:
+            size = SORTED_INDEX_ENTRY.size
+
+            def read_entry(i):
+                f.seek(i * size)
+                return SORTED_INDEX_ENTRY.unpack(f.read(size))
+
+            low = 0
+            high = os.fstat(f.fileno()).st_size // size
+            entries_count = high
+            while low < high:
+                middle = (low + high) // 2
+                if read_entry(middle)[0] < talk_id:
+                    low = middle + 1
+                else:
+                    high = middle
+            offsets = []
+            f.seek(low * size)
+            for _ in range(low, entries_count):
+                entry_talk_id, offset = SORTED_INDEX_ENTRY.unpack(f.read(size))
+                if entry_talk_id != talk_id:
+                    break
+                offsets.append(offset)
+            return offsets
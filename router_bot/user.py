@@ -8,10 +8,13 @@ import asyncio
 import datetime
 import json
 import logging
-from .error import MissingPartnerError, UserError, HumanSenderError
+from .db_executor import DbExecutor
+from .error import MissingPartnerError, UserError, HumanSenderError, TranscriptRecorderError
 from .human_sender_service import HumanSenderService
+from .metrics import SEND_TO_PARTNER_LATENCY
 from .stats_service import StatsService
-from peewee import CharField, DateTimeField, IntegerField, Model, Proxy
+from .transcript_recorder import TranscriptRecorder
+from peewee import CharField, DateTimeField, DoesNotExist, IntegerField, Model, Proxy
 from telepot.exception import TelegramError
 
 LOGGER = logging.getLogger('router_bot.user')
@@ -19,11 +22,31 @@ WIZARD_CHOICES = (
     ('none', 'None'),
     ('setup', 'Setup'),
     )
+LANGUAGES_CHOICES = (
+    ('en', 'English'),
+    ('ru', 'Russian'),
+    ('de', 'German'),
+    ('es', 'Spanish'),
+    ('fr', 'French'),
+    ('it', 'Italian'),
+    ('pt', 'Portuguese'),
+    ('zh', 'Chinese'),
+    )
+SEX_CHOICES = (
+    ('female', 'Female'),
+    ('male', 'Male'),
+    ('not_specified', 'Not specified'),
+    )
 database_proxy = Proxy()
 
 
 class User(Model):
-    looking_for_partner_from = DateTimeField(null=True)
+    looking_for_partner_from = DateTimeField(index=True, null=True)
+    # JSON list of codes of languages which the user speaks. `None` means that any language is fine, e.g. for client
+    # bots.
+    languages_json = CharField(max_length=100, null=True)
+    sex = CharField(choices=SEX_CHOICES, max_length=20, null=True)
+    partner_sex = CharField(choices=SEX_CHOICES, max_length=20, null=True)
 
     LONG_WAITING_TIMEDELTA = datetime.timedelta(minutes=5)
     UNMUTE_BONUSES_NOTIFICATIONS_DELAY = 60 * 60
@@ -35,22 +58,42 @@ class User(Model):
         if self.looking_for_partner_from is not None:
             # If user is looking for partner
             self.looking_for_partner_from = None
-            await self.get_concrete_user(). \
-                notify_looking_for_partner_was_finished()
-        elif self.get_partner() is not None:
-            # If user is chatting now
             try:
-                await self.get_concrete_user(). \
-                    notify_talk_was_finished(by_self=True)
+                await (await self.get_concrete_user()). \
+                    notify_looking_for_partner_was_finished()
             except UserError as err:
-                LOGGER.warning('End chatting. Can\'t notify user %d: %s', self.id, err)
+                LOGGER.warning('End looking for partner. Can\'t notify user %d: %s', self.id, err)
+        else:
+            talk = await self.obtain_talk()
+            if talk is not None:
+                # If user is chatting now
+                try:
+                    await (await self.get_concrete_user()). \
+                        notify_talk_was_finished(by_self=True, partner=talk.get_partner(self))
+                except UserError as err:
+                    LOGGER.warning('End chatting. Can\'t notify user %d: %s', self.id, err)
         await self.set_partner(None)
 
-    def get_concrete_user(self):
-        """
+    async def get_concrete_user(self):
+        """Obtains human or client bot of the user from the cache or from the DB.
+
         Raises:
             UserError If there's no human or client bot of such user.
 
+        """
+        from .user_service import UserService
+        user_service = UserService.get_instance()
+        try:
+            concrete_user = user_service.get_cached_concrete_user(self.id)
+        except KeyError:
+            concrete_user = await DbExecutor.get_instance().run(self._get_concrete_user)
+            concrete_user = user_service.cache_concrete_user(concrete_user)
+        concrete_user.user = self
+        return concrete_user
+
+    def _get_concrete_user(self):
+        """Blocking part of `get_concrete_user`.
+
         """
         try:
             concrete_user = self.humen.get()
@@ -60,21 +103,70 @@ class User(Model):
             except DoesNotExist:
                 reason = f'User {self.id} doesn\'t have neither human nor client bot.'
                 LOGGER.error(reason)
-                raise UserError(reason=reason)
+                raise UserError(reason)
         return concrete_user
 
+    def get_languages(self):
+        """
+        Returns:
+            List of codes of languages which the user speaks or `None` if any language is fine.
+
+        """
+        if self.languages_json is None:
+            return None
+        return json.loads(self.languages_json)
+
     def get_partner(self):
+        """
+        Returns:
+            Partner of the user's talk. Client bot can have several talks, so one of partners is returned for it.
+
+        """
         talk = self.get_talk()
         return None if talk is None else talk.get_partner(self)
 
-    def get_talk(self):
-        from .talk import Talk
-        return Talk.get_talk(self)
+    def get_partner_sex(self):
+        return self.partner_sex or 'not_specified'
 
-    async def kick(self):
+    def get_partners_condition(self):
+        """
+        Returns:
+            Condition which selects users compatible with this one: speaking the same language and satisfying
+            preferences of each other about partner's sex. Preferences which weren't set are satisfied by anybody.
+
+        """
+        cls = type(self)
+        condition = (cls.partner_sex >> None) | (cls.partner_sex << ('not_specified', self.get_sex()))
+        partner_sex = self.get_partner_sex()
+        if partner_sex != 'not_specified':
+            condition &= cls.sex == partner_sex
+        languages = self.get_languages()
+        if languages is not None:
+            languages_condition = cls.languages_json >> None
+            for language in languages:
+                languages_condition |= cls.languages_json.contains(json.dumps(language))
+            condition &= languages_condition
+        return condition
+
+    def get_sex(self):
+        return self.sex or 'not_specified'
+
+    def get_talk(self, partner=None):
+        """
+        Args:
+            partner (User): Partner of the talk. Should be specified to obtain certain talk of client bot.
+
+        """
+        from .talk_service import TalkService
+        return TalkService.get_instance().get_talk(self, partner)
+
+    async def kick(self, partner):
+        """Notifies the user that the partner has left the talk.
+
+        """
         try:
-            await self.get_concrete_user(). \
-                notify_talk_was_finished(by_self=False)
+            await (await self.get_concrete_user()). \
+                notify_talk_was_finished(by_self=False, partner=partner)
         except UserError as err:
             LOGGER.warning('Kick. Can\'t notify user %d: %s', self.id, err)
 
@@ -84,40 +176,62 @@ class User(Model):
             UserError If there's no human or client bot of such user or if human we're changing has blocked the bot.
 
         """
-        await self.get_concrete_user(). \
+        await (await self.get_concrete_user()). \
             notify_partner_found(partner)
 
-    async def send(self, message):
+    async def obtain_talk(self, partner=None):
+        """Like `get_talk` but looks for the talk begun by another router-bot process in the DB.
+
         """
+        from .talk_service import TalkService
+        return await TalkService.get_instance().obtain_talk(self, partner)
+
+    async def send(self, message, sender):
+        """
+        Args:
+            sender (User): Partner who has sent the message.
+
         Raises:
             UserError if can't send message because of unknown content type.
             TelegramError if user has blocked the bot.
 
         """
-        await self.get_concrete_user(). \
-            send(message)
+        await (await self.get_concrete_user()). \
+            send(message, sender)
 
-    async def send_to_partner(self, message):
+    @SEND_TO_PARTNER_LATENCY.timed
+    async def send_to_partner(self, message, partner=None):
         """
+        Args:
+            partner (User): Partner of the talk. Should be specified when client bot sends the message.
+
         Raises:
             MissingPartnerError if there's no partner for this user.
             UserError if can't send content.
             TelegramError if the partner has blocked the bot.
 
         """
-        partner = self.get_partner()
-        if partner is None:
+        from .talk_service import TalkService
+        talk = await self.obtain_talk(partner)
+        if talk is None:
             raise MissingPartnerError()
+        partner = talk.get_partner(self)
+        await partner.send(message, self)
         try:
-            await partner.send(message)
-        except:
-            raise
+            transcript_recorder = TranscriptRecorder.get_instance()
+        except TranscriptRecorderError:
+            # Transcripts aren't recorded.
+            pass
         else:
-            self.get_talk().increment_sent(self)
+            await transcript_recorder.record(talk.id, self.id, message)
+        await TalkService.get_instance().increment_sent(talk, self)
+
+    def set_languages(self, languages):
+        self.languages_json = json.dumps(languages)
 
     async def set_looking_for_partner(self):
         try:
-            await self.get_concrete_user(). \
+            await (await self.get_concrete_user()). \
                 notify_looking_for_partner()
         except UserError as err:
             self.looking_for_partner_from = None
@@ -130,39 +244,27 @@ class User(Model):
         await self.set_partner(None)
 
     async def set_partner(self, partner):
-        """Sets partner for a user. Always saves the model.
+        """Sets partner for a user. Always saves the user and synchronizes waiting queue with her. Talks and both users
+        are saved in one DB transaction. Waiting users are matched with client bots afterwards.
 
         """
-        current_partner = self.get_partner()
+        from .talk_service import TalkService
+        from .user_service import UserService
+        talk = await self.obtain_talk()
+        current_partner = None if talk is None else talk.get_partner(self)
         if current_partner == partner:
-            self.save()
-            return
-        if current_partner is not None:
-            partners_partner = current_partner.get_partner()
-            # If partner isn't talking with the user because of some
-            # error, we shouldn't kick him.
-            if partners_partner == self:
-                await current_partner.kick()
-            else:
-                LOGGER.error(
-                    'User %d has a partner %d which partners with %d, not us!',
-                    self.id,
-                    current_partner.id,
-                    partners_partner.id,
-                    )
-            talk = self.get_talk()
-            if talk is not None:
-                talk.end = datetime.datetime.utcnow()
-                talk.save()
+            await TalkService.get_instance().change_talk(self)
+        else:
+            new_talk = await TalkService.get_instance().change_talk(self, talk, partner)
+            if new_talk is not None:
+                # Partners were notified before they were matched.
+                TalkService.get_instance().confirm_talk(new_talk)
+            if current_partner is not None:
+                await current_partner.kick(self)
+        user_service = UserService.get_instance()
         if partner is not None:
-            from .talk import Talk
-            Talk.create(
-                partner1=self,
-                partner2=partner,
-                searched_since=partner.looking_for_partner_from,
-                )
-            if self.looking_for_partner_from is not None:
-                self.looking_for_partner_from = None
-            partner.looking_for_partner_from = None
-            partner.save()
-        self.save()
+            user_service.update_waiting_user(partner)
+        user_service.update_waiting_user(self)
+        if self.looking_for_partner_from is not None or current_partner not in (None, partner):
+            # The user waits for partner now or former partner could be client bot which has got free capacity.
+            await user_service.match_waiting_user_with_client_bot()
@@ -5,18 +5,55 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import logging
-from .error import PartnerObtainingError, UserError, UserServiceError
+from .cache import LruCache
+from .db_executor import DbExecutor
+from .error import ClientBotCapacityError, PartnerObtainingError, TalkServiceError, UserError, UserServiceError
+from .logging_pipeline import SAMPLED
+from .metrics import MATCH_PARTNER_LATENCY
+from .reaper import Reaper
 from .user import User
+from .waiting_queue import WaitingQueue
 
 LOGGER = logging.getLogger('router_bot.user_service')
 
 
 class UserService:
-    def __init__(self):
+    CACHE_MAX_SIZE = 10000
+    CACHE_TTL = 60 * 60
+
+    def __init__(self, matching_mode='memory'):
+        """
+        Args:
+            matching_mode (str): `memory` to match partners using in-process waiting queue or `database` to claim
+                partners by the DB, so several router-bot processes can work with the same DB.
+
+        """
+        self._matching_mode = matching_mode
         # We need to lock users for matching to prevent attempts to create
         # second conversation with single partner.
         self._locked_users_ids = set()
-        self._users_cache = {}
+        # Maps client bot's user ID to the number of talks which are being begun with the bot now.
+        self._reserved_bots = {}
+        self._users_cache = LruCache(
+            type(self).CACHE_MAX_SIZE,
+            type(self).CACHE_TTL,
+            is_pinned=lambda user: self.is_pinned(user.id),
+            )
+        # Humans and client bots by users' IDs. Humans are cached by Telegram IDs too, both caches keep the same
+        # instances.
+        self._concrete_users_cache = LruCache(
+            type(self).CACHE_MAX_SIZE,
+            type(self).CACHE_TTL,
+            is_pinned=lambda concrete_user: self.is_pinned(concrete_user.user_id),
+            )
+        self._humans_cache = LruCache(
+            type(self).CACHE_MAX_SIZE,
+            type(self).CACHE_TTL,
+            is_pinned=lambda human: self.is_pinned(human.user_id),
+            )
+        self._waiting_queue = WaitingQueue()
+        for user in User.select().where(User.looking_for_partner_from != None):
+            self.update_waiting_user(self.get_cached_user(user))
         type(self)._instance = self
 
     @classmethod
@@ -31,21 +68,114 @@ class UserService:
     def admins_telegram_ids(self):
         return [user.id for user in User.select()]
 
+    def cache_concrete_user(self, concrete_user):
+        """Caches human or client bot obtained from the DB.
+
+        Returns:
+            Cached instance which could be obtained earlier or the given one.
+
+        """
+        from .human import Human
+        try:
+            return self._concrete_users_cache.get(concrete_user.user_id)
+        except KeyError:
+            pass
+        self._concrete_users_cache.put(concrete_user.user_id, concrete_user)
+        if isinstance(concrete_user, Human):
+            self._humans_cache.put(concrete_user.telegram_id, concrete_user)
+        return concrete_user
+
+    def discard_concrete_user(self, concrete_user):
+        """Should be called when human or client bot was changed or deleted not through the cached instance.
+
+        """
+        from .human import Human
+        self._concrete_users_cache.discard(concrete_user.user_id)
+        if isinstance(concrete_user, Human):
+            self._humans_cache.discard(concrete_user.telegram_id)
+
+    def get_cached_concrete_user(self, user_id):
+        """
+        Raises:
+            KeyError if there's no such human or client bot in the cache.
+
+        """
+        return self._concrete_users_cache.get(user_id)
+
+    def get_cached_human(self, telegram_id):
+        """
+        Raises:
+            KeyError if there's no such human in the cache.
+
+        """
+        human = self._humans_cache.get(telegram_id)
+        # Users are evicted from their cache independently, so the human's user could be cached again as another
+        # instance meanwhile.
+        try:
+            human.user = self._users_cache.get(human.user_id)
+        except KeyError:
+            self._users_cache.put(human.user_id, human.user)
+        return human
+
     def get_cached_user(self, user):
         try:
-            return self._users_cache[user.id]
+            cached_user = self._users_cache.get(user.id)
         except KeyError:
-            self._users_cache[user.id] = user
+            self._users_cache.put(user.id, user)
             return user
+        if self._matching_mode == 'database' and cached_user is not user:
+            # The user could be changed by another process, so cached instance is refreshed from just obtained one.
+            cached_user.looking_for_partner_from = user.looking_for_partner_from
+            self.update_waiting_user(cached_user)
+        return cached_user
 
     def get_cache_size(self):
-        return len(self._users_cache)
+        """
+        Returns:
+            dict with size of the cache and numbers of its hits, misses and evictions.
+
+        """
+        return self._users_cache.get_stats()
+
+    def get_concrete_users_cache_size(self):
+        return self._concrete_users_cache.get_stats()
+
+    def get_humans_cache_size(self):
+        return self._humans_cache.get_stats()
 
     def get_full_users(self):
         return User.select()
 
+    def get_waiting_users_count(self):
+        return len(self._waiting_queue)
+
+    def is_pinned(self, user_id):
+        """
+        Returns:
+            `True` if the user is waiting for partner, is being matched now or is talking. Such users should stay in
+            caches to keep single instance of every one of them.
+
+        """
+        from .talk_service import TalkService
+        if user_id in self._locked_users_ids or self._waiting_queue.contains_id(user_id):
+            return True
+        try:
+            talk_service = TalkService.get_instance()
+        except TalkServiceError:
+            return False
+        return talk_service.has_talk(user_id)
+
+    def update_waiting_user(self, user):
+        """Synchronizes waiting queue with user's `looking_for_partner_from`. Should be called after every change of
+        this field.
+
+        """
+        self._waiting_queue.update(user)
+        if user.looking_for_partner_from is not None:
+            Reaper.get_instance().add_waiting_user(user)
+
     def _match_partner(self, user):
-        """Tries to find a partner for obtained user or raises PartnerObtainingError.
+        """Tries to find a compatible partner for obtained user or raises PartnerObtainingError.
 
         Raises:
             PartnerObtainingError if there's no proper partner.
@@ -54,26 +184,92 @@ class UserService:
             User
 
         """
-        from .talk import Talk
-
-        possible_partners = User.select().where(
-            User.id != user.id,
-            User.looking_for_partner_from != None,
-            )
-        possible_partners = possible_partners.order_by(
-            User.looking_for_partner_from,
-            )
-
-        partner = None
-        for possible_partner in possible_partners:
-            if possible_partner.id not in self._locked_users_ids:
-                partner = possible_partner
-                break
+        excluded_ids = set(self._locked_users_ids)
+        excluded_ids.add(user.id)
+        partner = self._waiting_queue.pop(excluded_ids, compatible_with=user)
         if partner is None:
             raise PartnerObtainingError()
         self._locked_users_ids.add(partner.id)
         return self.get_cached_user(partner)
 
+    async def match_waiting_user_with_client_bot(self):
+        """Begins talks of users who are waiting for partner for the longest time with client bots which have free
+        capacity. Should be called when some user starts waiting or some client bot's talk ends.
+
+        """
+        from .client_bot_service import ClientBotService
+        excluded_ids = set()
+        while len(self._waiting_queue):
+            bot = await ClientBotService.get_free_bot(self._reserved_bots, excluded_ids)
+            if bot is None:
+                return
+            bot_user = self.get_cached_user(bot.user)
+            self._reserved_bots[bot_user.id] = self._reserved_bots.get(bot_user.id, 0) + 1
+            try:
+                await self._match_waiting_user_with_client_bot(bot_user, bot.capacity)
+            except PartnerObtainingError:
+                return
+            except ClientBotCapacityError as err:
+                # Other processes have begun talks with the bot.
+                LOGGER.debug('%s', err)
+                excluded_ids.add(bot_user.id)
+            except UserError as err:
+                LOGGER.info('Bad client bot %d. %s', bot_user.id, err)
+                excluded_ids.add(bot_user.id)
+            finally:
+                self._reserved_bots[bot_user.id] -= 1
+                if not self._reserved_bots[bot_user.id]:
+                    del self._reserved_bots[bot_user.id]
+
+    async def _match_waiting_user_with_client_bot(self, bot_user, capacity):
+        """Begins the talk of the user who is waiting for partner for the longest time with the client bot. Talk is
+        created before notifications, so it's cancelled if some partner can't be notified.
+
+        Raises:
+            PartnerObtainingError if there's no waiting users.
+            ClientBotCapacityError if the client bot has no free capacity in the DB.
+            UserError if the client bot can't be notified.
+
+        """
+        from .talk_service import TalkService
+        talk_service = TalkService.get_instance()
+        while True:
+            if self._matching_mode == 'database':
+                talk = await talk_service.begin_talk_with_waiting_user(bot_user, is_client_bot=True, capacity=capacity)
+                user = talk.partner2
+            else:
+                user = self._waiting_queue.pop(self._locked_users_ids)
+                if user is None:
+                    raise PartnerObtainingError()
+                user = self.get_cached_user(user)
+                talk = await talk_service.change_talk(bot_user, partner=user)
+            user.looking_for_partner_from = None
+            self.update_waiting_user(user)
+            try:
+                await user.notify_partner_found(bot_user)
+            except UserError as err:
+                # The user has blocked the bot. She was claimed already, so she isn't waiting anymore.
+                LOGGER.info('Bad potential partner for client bot %d. %s', bot_user.id, err)
+                await talk_service.cancel_talk(talk)
+                continue
+            break
+        try:
+            await bot_user.notify_partner_found(user)
+        except UserError:
+            await talk_service.cancel_talk(talk)
+            # The user is still waiting, so return her to the queue.
+            user.looking_for_partner_from = talk.searched_since
+            await DbExecutor.get_instance().run(
+                self._save_looking_for_partner_from,
+                user.id,
+                user.looking_for_partner_from,
+                )
+            self.update_waiting_user(user)
+            raise
+        talk_service.confirm_talk(talk)
+        LOGGER.debug('Found client bot: %d -> %d.', user.id, bot_user.id, extra=SAMPLED)
+
+    @MATCH_PARTNER_LATENCY.timed
     async def match_partner(self, user):
         """Finds partner for the user. Does handling of users who have blocked the bot.
 
@@ -82,6 +278,9 @@ class UserService:
             UserServiceError if the user has blocked the bot.
 
         """
+        if self._matching_mode == 'database':
+            await self._match_partner_in_database(user)
+            return
         while True:
             partner = self._match_partner(user)
             try:
@@ -98,8 +297,67 @@ class UserService:
             await user.notify_partner_found(partner)
         except UserError as err:
             self._locked_users_ids.discard(partner.id)
+            # Partner is still waiting, so return her to the queue.
+            self.update_waiting_user(partner)
             # User has blocked the bot.
             raise UserServiceError(f'Can\'t notify seeking for partner user: {err}')
         await user.set_partner(partner)
         self._locked_users_ids.discard(partner.id)
-        LOGGER.debug('Found partner: %d -> %d.', user.id, partner.id)
+        LOGGER.debug('Found partner: %d -> %d.', user.id, partner.id, extra=SAMPLED)
+
+    async def _match_partner_in_database(self, user):
+        """Finds partner for the user claiming her by the DB. Talk is created before notifications here, so it's
+        cancelled if some partner can't be notified.
+
+        Raises:
+            PartnerObtainingError if there's no proper partners.
+            UserServiceError if the user has blocked the bot.
+
+        """
+        from .talk_service import TalkService
+        talk_service = TalkService.get_instance()
+        db_executor = DbExecutor.get_instance()
+        # Finish current talk first: the user can't be in two talks.
+        await user.set_partner(None)
+        while True:
+            talk = await talk_service.begin_talk_with_waiting_user(user)
+            if talk.partner2_id == user.id:
+                LOGGER.debug('User %d was claimed by %d meanwhile', user.id, talk.partner1_id)
+                user.looking_for_partner_from = None
+                self.update_waiting_user(user)
+                return
+            partner = talk.partner2
+            try:
+                await partner.notify_partner_found(user)
+            except UserError as err:
+                # Potential partner has blocked the bot. She was claimed already, so she isn't waiting anymore.
+                LOGGER.info('Bad potential partner for %d. %s', user.id, err)
+                await talk_service.cancel_talk(talk)
+                partner.looking_for_partner_from = None
+                self.update_waiting_user(partner)
+                continue
+            break
+        try:
+            await user.notify_partner_found(partner)
+        except UserError as err:
+            await talk_service.cancel_talk(talk)
+            # Partner is still waiting, so return her to the queue. Only this field is saved because another process
+            # could change the rest of the row.
+            partner.looking_for_partner_from = talk.searched_since
+            await db_executor.run(self._save_looking_for_partner_from, partner.id, partner.looking_for_partner_from)
+            self.update_waiting_user(partner)
+            user.looking_for_partner_from = None
+            self.update_waiting_user(user)
+            # User has blocked the bot.
+            raise UserServiceError(f'Can\'t notify seeking for partner user: {err}')
+        for talk_partner in (partner, user):
+            talk_partner.looking_for_partner_from = None
+            self.update_waiting_user(talk_partner)
+        talk_service.confirm_talk(talk)
+        LOGGER.debug('Found partner: %d -> %d.', user.id, partner.id, extra=SAMPLED)
+
+    @staticmethod
+    def _save_looking_for_partner_from(user_id, looking_for_partner_from):
+        User.update(looking_for_partner_from=looking_for_partner_from) \
+            .where(User.id == user_id) \
+            .execute()
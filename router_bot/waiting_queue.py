@@ -0,0 +1,172 @@
+# router-bot
+# Copyright (C) 2017 quasiyoke
+#
+# You should have received a copy of the GNU Affero General Public License v3
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import heapq
+import itertools
+import logging
+from .user import LANGUAGES_CHOICES, SEX_CHOICES
+
+LOGGER = logging.getLogger('router_bot.waiting_queue')
+LANGUAGES = tuple(language for language, name in LANGUAGES_CHOICES)
+SEXES = tuple(sex for sex, name in SEX_CHOICES)
+
+
+def get_buckets_keys(user):
+    """
+    Returns:
+        Keys `(language, sex, partner_sex)` of buckets where the user waits. Language is `None` if any language is
+        fine for the user.
+
+    """
+    languages = user.get_languages()
+    if languages is None:
+        languages = (None, )
+    sex = user.get_sex()
+    partner_sex = user.get_partner_sex()
+    return tuple((language, sex, partner_sex) for language in languages)
+
+
+def get_compatible_buckets_keys(user):
+    """
+    Returns:
+        Keys of buckets with partners compatible with the user. Their number doesn't depend on the number of waiting
+        users.
+
+    """
+    languages = user.get_languages()
+    if languages is None:
+        languages = LANGUAGES
+    languages = tuple(languages) + (None, )
+    partner_sex = user.get_partner_sex()
+    partners_sexes = SEXES if partner_sex == 'not_specified' else (partner_sex, )
+    partners_partner_sexes = tuple({'not_specified', user.get_sex()})
+    return tuple(itertools.product(languages, partners_sexes, partners_partner_sexes))
+
+
+class WaitingQueue:
+    """In-memory queue of users looking for partner ordered by `looking_for_partner_from`.
+
+    Besides the queue of all users, every user is put to the buckets of her `(language, sex, partner_sex)` keys. Every
+    bucket is a queue too, so the longest waiting compatible partner is found by peeking a fixed number of buckets.
+
+    Removal is lazy: heap entries of users which were discarded or whose `looking_for_partner_from` has changed
+    are skipped during popping and are dropped during periodical compaction.
+
+    """
+
+    def __init__(self, users=()):
+        self._heap = []
+        # Maps bucket's key to the heap of entries `(looking_for_partner_from, user ID)`.
+        self._buckets = {}
+        # Maps user ID to the tuple `(looking_for_partner_from, user, buckets' keys)` which is valid for the user now.
+        self._entries = {}
+        for user in users:
+            self.update(user)
+
+    def __contains__(self, user):
+        return self.contains_id(user.id)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def contains_id(self, user_id):
+        return user_id in self._entries
+
+    def discard(self, user):
+        self._entries.pop(user.id, None)
+
+    def pop(self, excluded_ids=(), compatible_with=None):
+        """Removes the user which is waiting for the longest time from the queue.
+
+        Args:
+            excluded_ids (collection): IDs of users which shouldn't be popped. They are kept in the queue.
+            compatible_with (User): If specified, only users compatible with this one are popped.
+
+        Returns:
+            User or `None` if there's no proper user.
+
+        """
+        if compatible_with is None:
+            heap_entry = self._peek(self._heap, excluded_ids)
+        else:
+            heap_entry = None
+            for key in get_compatible_buckets_keys(compatible_with):
+                bucket = self._buckets.get(key)
+                if bucket is None:
+                    continue
+                bucket_heap_entry = self._peek(bucket, excluded_ids, key)
+                if bucket_heap_entry is not None and (heap_entry is None or bucket_heap_entry < heap_entry):
+                    heap_entry = bucket_heap_entry
+        if heap_entry is None:
+            return None
+        looking_for_partner_from, user_id = heap_entry
+        return self._entries.pop(user_id)[1]
+
+    def update(self, user):
+        """Puts the user to the queue or removes her from there according to her `looking_for_partner_from` and
+        preferences.
+
+        """
+        looking_for_partner_from = user.looking_for_partner_from
+        if looking_for_partner_from is None:
+            self.discard(user)
+            return
+        keys = get_buckets_keys(user)
+        entry = self._entries.get(user.id)
+        if entry is not None and entry[0] == looking_for_partner_from and entry[2] == keys:
+            return
+        self._entries[user.id] = (looking_for_partner_from, user, keys)
+        heap_entry = (looking_for_partner_from, user.id)
+        heapq.heappush(self._heap, heap_entry)
+        for key in keys:
+            heapq.heappush(self._buckets.setdefault(key, []), heap_entry)
+        # Buckets get a bounded number of entries for every entry of the queue of all users, so compaction triggered
+        # by the latter bounds them too.
+        if len(self._heap) > 2 * len(self._entries) + 64:
+            self._compact()
+
+    def _compact(self):
+        self._heap = []
+        self._buckets = {}
+        for user_id, (looking_for_partner_from, user, keys) in self._entries.items():
+            heap_entry = (looking_for_partner_from, user_id)
+            self._heap.append(heap_entry)
+            for key in keys:
+                self._buckets.setdefault(key, []).append(heap_entry)
+        heapq.heapify(self._heap)
+        for bucket in self._buckets.values():
+            heapq.heapify(bucket)
+        LOGGER.debug('Waiting queue was compacted. %d users are waiting.', len(self._entries))
+
+    def _is_valid(self, heap_entry, key):
+        looking_for_partner_from, user_id = heap_entry
+        entry = self._entries.get(user_id)
+        return entry is not None and entry[0] == looking_for_partner_from and (key is None or key in entry[2])
+
+    def _peek(self, heap, excluded_ids, key=None):
+        """Drops stale entries from the top of the heap.
+
+        Args:
+            key (tuple): Key of the bucket if the heap is a bucket.
+
+        Returns:
+            Entry of the longest waiting user in the heap who isn't excluded or `None`.
+
+        """
+        skipped = []
+        heap_entry = None
+        while heap:
+            if not self._is_valid(heap[0], key):
+                heapq.heappop(heap)
+                continue
+            if heap[0][1] in excluded_ids:
+                skipped.append(heapq.heappop(heap))
+                continue
+            heap_entry = heap[0]
+            break
+        for skipped_entry in skipped:
+            heapq.heappush(heap, skipped_entry)
+        return heap_entry
@@ -0,0 +1,136 @@
+# router-bot
+# Copyright (C) 2017 quasiyoke
+#
+# You should have received a copy of the GNU Affero General Public License v3
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests of claiming partners by the DB in `database` matching mode. Claims are run in separate threads with their own
+connections to a temporary SQLite DB, like claims of several router-bot processes.
+
+"""
+
+import datetime
+import os
+import tempfile
+import threading
+import unittest
+from unittest import mock
+from router_bot.db import Db
+from router_bot.error import ClientBotCapacityError
+from router_bot.talk import Talk
+from router_bot.talk_service import TalkService
+from router_bot.user import User
+
+
+class DbConfiguration:
+    database_engine = 'sqlite'
+    database_pragmas = {}
+    database_pool = None
+    database_executor_workers = 0
+
+    def __init__(self, path):
+        self.database_name = path
+
+
+def create_waiting_user():
+    return User.create(looking_for_partner_from=datetime.datetime.utcnow())
+
+
+def claim_concurrently(users_ids):
+    """
+    Returns:
+        dict which maps user ID to the result of `TalkService._claim_partner`.
+
+    """
+    barrier = threading.Barrier(len(users_ids))
+    results = {}
+
+    def claim(user_id):
+        barrier.wait()
+        results[user_id] = TalkService._claim_partner(user_id)
+
+    threads = [threading.Thread(target=claim, args=(user_id, )) for user_id in users_ids]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+class ClaimPartnerTestCase(unittest.TestCase):
+    CLAIMERS_COUNT = 8
+
+    def setUp(self):
+        self._directory = tempfile.TemporaryDirectory()
+        Db(DbConfiguration(os.path.join(self._directory.name, 'router-bot.db'))).install()
+
+    def tearDown(self):
+        self._directory.cleanup()
+
+    def test_concurrent_claims_of_waiting_user(self):
+        waiting_user = create_waiting_user()
+        claimers_ids = [User.create().id for i in range(type(self).CLAIMERS_COUNT)]
+        results = claim_concurrently(claimers_ids)
+        self.assertEqual(len(results), len(claimers_ids))
+        talks = list(Talk.select())
+        self.assertEqual(len(talks), 1)
+        self.assertEqual(talks[0].partner2_id, waiting_user.id)
+        claims = [result for result in results.values() if result is not None]
+        self.assertEqual(len(claims), 1)
+        talk, partner = claims[0]
+        self.assertEqual(talk.id, talks[0].id)
+        self.assertEqual(partner.id, waiting_user.id)
+        self.assertIsNone(User.get(User.id == waiting_user.id).looking_for_partner_from)
+
+    def test_mutual_claims_of_waiting_users(self):
+        user1 = create_waiting_user()
+        user2 = create_waiting_user()
+        results = claim_concurrently([user1.id, user2.id])
+        self.assertEqual(Talk.select().count(), 1)
+        # The user who was claimed obtains the talk begun by another one.
+        (talk1, partner1), (talk2, partner2) = results[user1.id], results[user2.id]
+        self.assertEqual(talk1.id, talk2.id)
+        self.assertEqual(partner1.id, user2.id)
+        self.assertEqual(partner2.id, user1.id)
+
+    def test_claim_conflicts_with_changed_candidate(self):
+        user = User.create()
+        waiting_user = create_waiting_user()
+        update = User.update
+
+        def update_after_concurrent_change(*args, **kwargs):
+            # SQLite runs claims one after another, so concurrent change of the selected candidate is simulated.
+            update(looking_for_partner_from=datetime.datetime.utcnow()) \
+                .where(User.id == waiting_user.id) \
+                .execute()
+            return update(*args, **kwargs)
+
+        with mock.patch.object(User, 'update', side_effect=update_after_concurrent_change):
+            self.assertIsNone(TalkService._claim_partner(user.id))
+        self.assertEqual(Talk.select().count(), 0)
+        self.assertIsNotNone(User.get(User.id == waiting_user.id).looking_for_partner_from)
+
+    def test_reclaim_returns_existing_talk(self):
+        user = User.create()
+        waiting_user = create_waiting_user()
+        talk, partner = TalkService._claim_partner(user.id)
+        self.assertEqual(partner.id, waiting_user.id)
+        reclaimed_talk, reclaimed_partner = TalkService._claim_partner(waiting_user.id)
+        self.assertEqual(reclaimed_talk.id, talk.id)
+        self.assertEqual(reclaimed_partner.id, user.id)
+        self.assertEqual(Talk.select().count(), 1)
+
+    def test_client_bot_capacity(self):
+        bot_user = User.create()
+        Talk.create(partner1=bot_user, partner2=User.create(), searched_since=datetime.datetime.utcnow())
+        waiting_user = create_waiting_user()
+        with self.assertRaises(ClientBotCapacityError):
+            TalkService._claim_partner(bot_user.id, is_client_bot=True, capacity=1)
+        self.assertIsNotNone(User.get(User.id == waiting_user.id).looking_for_partner_from)
+        talk, partner = TalkService._claim_partner(bot_user.id, is_client_bot=True, capacity=2)
+        self.assertEqual(partner.id, waiting_user.id)
+        self.assertEqual(Talk.select().where(Talk.end == None).count(), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()